@@ -0,0 +1,236 @@
+"""
+Admission control and rate limiting for the prediction endpoints.
+AdmissionController bounds how many requests run at once and how many may
+wait for a slot; everything beyond that is shed right away with a
+Retry-After estimate instead of piling up in the socket backlog.
+RateLimiter is a per-client token bucket, kept in memory or, to share the
+limits between worker processes, in a SQLite table.
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed; reason is a short label for metrics"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f'Server overloaded ({reason}); retry after {retry_after}s')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    At most max_in_flight requests hold a slot; up to max_queue more wait
+    for one, for at most queue_timeout seconds. acquire() returns a ticket
+    whose release() frees the slot, or raises Overloaded.
+    """
+
+    def __init__(self, max_in_flight=4, max_queue=16, queue_timeout=5.0):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.max_queue = max(0, int(max_queue))
+        self.queue_timeout = max(0.0, float(queue_timeout))
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+        # Smoothed time a request holds its slot, for Retry-After estimates
+        self._service_time = 1.0
+
+        self._admitted = 0
+        self._shed = {}
+        self._wait_total = 0.0
+
+    def in_flight(self):
+        return self._in_flight
+
+    def queue_depth(self):
+        return self._waiting
+
+    def retry_after(self):
+        """Seconds until a slot is likely to be free (at least 1)"""
+        backlog = (self._waiting + 1) / float(self.max_in_flight)
+        return max(1, int(math.ceil(self._service_time * backlog)))
+
+    def _shed_request(self, reason):
+        self._shed[reason] = self._shed.get(reason, 0) + 1
+        return Overloaded(reason, self.retry_after())
+
+    def acquire(self):
+        started = time.monotonic()
+        with self._cond:
+            if self._in_flight >= self.max_in_flight:
+                if self._waiting >= self.max_queue:
+                    raise self._shed_request('queue_full')
+                self._waiting += 1
+                try:
+                    deadline = started + self.queue_timeout
+                    while self._in_flight >= self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise self._shed_request('queue_timeout')
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_flight += 1
+            self._admitted += 1
+            waited = time.monotonic() - started
+            self._wait_total += waited
+        return _Ticket(self, waited)
+
+    def _release(self, held):
+        with self._cond:
+            self._in_flight -= 1
+            self._service_time = 0.8 * self._service_time + 0.2 * held
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'max_in_flight': self.max_in_flight,
+                'max_queue': self.max_queue,
+                'queue_timeout_s': self.queue_timeout,
+                'in_flight': self._in_flight,
+                'queue_depth': self._waiting,
+                'admitted': self._admitted,
+                'shed': dict(self._shed),
+                'mean_queue_wait_ms': self._wait_total / self._admitted * 1000.0 if self._admitted else 0.0,
+                'service_time_s': self._service_time,
+            }
+
+
+class _Ticket:
+    __slots__ = ('_controller', '_acquired', '_released', 'waited')
+
+    def __init__(self, controller, waited):
+        self._controller = controller
+        self._acquired = time.monotonic()
+        self._released = False
+        self.waited = waited
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(time.monotonic() - self._acquired)
+
+
+class RateLimiter:
+    """
+    Token bucket per client: rate_per_minute tokens are added per minute, up
+    to burst. allow(client) takes one token and returns (allowed,
+    retry_after_seconds). With db_path the buckets live in SQLite so every
+    worker process sees the same limits; if the database is unavailable the
+    request is allowed (limits fail open).
+    """
+
+    def __init__(self, rate_per_minute, burst=10, db_path=None, max_clients=10000):
+        self.rate = float(rate_per_minute) / 60.0
+        self.burst = max(1.0, float(burst))
+        self.db_path = db_path
+        self.max_clients = max_clients
+
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+        self._local = threading.local()
+        self._allowed = 0
+        self._limited = 0
+        self._errors = 0
+
+        if db_path:
+            conn = self._connection()
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limits (
+                    client TEXT PRIMARY KEY,
+                    tokens REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            ''')
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _connection(self):
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != pid:
+            # Autocommit mode: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.db_path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    def _take(self, tokens, updated, now):
+        """Refill a bucket and try to take one token: (allowed, tokens_left, retry_after)"""
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1.0:
+            return True, tokens - 1.0, 0
+        return False, tokens, max(1, int(math.ceil((1.0 - tokens) / self.rate)))
+
+    def _allow_memory(self, client, now):
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            allowed, tokens, retry_after = self._take(tokens, updated, now)
+            self._buckets[client] = (tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)  # Least recently seen client starts full again
+        return allowed, retry_after
+
+    def _allow_sqlite(self, client, now):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM rate_limits WHERE client = ?', (client,)).fetchone()
+            tokens, updated = row if row else (self.burst, now)
+            allowed, tokens, retry_after = self._take(tokens, updated, now)
+            conn.execute(
+                'INSERT INTO rate_limits (client, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT (client) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (client, tokens, now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, retry_after
+
+    def allow(self, client):
+        if not self.enabled:
+            return True, 0
+        now = time.time()
+        if self.db_path:
+            try:
+                allowed, retry_after = self._allow_sqlite(client, now)
+            except sqlite3.Error as e:
+                print(f"Rate limit database error, allowing request: {e}")
+                with self._lock:
+                    self._errors += 1
+                allowed, retry_after = True, 0
+        else:
+            allowed, retry_after = self._allow_memory(client, now)
+        with self._lock:
+            if allowed:
+                self._allowed += 1
+            else:
+                self._limited += 1
+        return allowed, retry_after
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'rate_per_minute': self.rate * 60.0,
+                'burst': self.burst,
+                'backend': 'sqlite' if self.db_path else 'memory',
+                'clients_tracked': len(self._buckets) if not self.db_path else None,
+                'allowed': self._allowed,
+                'limited': self._limited,
+                'errors': self._errors,
+            }
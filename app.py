@@ -4,59 +4,151 @@ This app allows users to submit their information and upload a picture.
 It detects emotions and stores data in SQLite database.
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash
-from werkzeug.utils import secure_filename
+from flask import Flask, Request, render_template, request, redirect, url_for, flash, Response, stream_with_context, g, send_file
 import os
-import sqlite3
 import numpy as np
 from PIL import Image
 import cv2
-import tensorflow as tf
-from tensorflow import keras
-from datetime import datetime
 import base64
+import functools
+import hmac
 import io
+import json
+import math
+import multiprocessing
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from inference_scheduler import BatchScheduler, DeadlineExceeded
+from preprocessing import EMOTION_LABELS, decode_image, image_size, prepare_face, normalize_image
+from prediction_cache import PredictionCache, hash_image
+from inference_backends import load_backend, preload_runtime, BACKENDS, DEFAULT_MODEL_PATHS
+from inference_pool import InferencePool
+from model_registry import ModelRegistry, ModelManager, ServingModel
+from face_detection import FaceDetector, crop_faces, DEFAULT_CASCADE
+from storage import Storage, GRANULARITIES, prune_directory
+from embedding_store import EmbeddingStores
+from video_analysis import iter_video_timeline
+from image_sources import iter_archive_images, is_archive, ArchiveError, ArchiveLimitError
+import metrics
+from admission import AdmissionController, RateLimiter, Overloaded
+import request_profiler
 
-# Configure TensorFlow to use minimal memory for Render free tier
-os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # Suppress TensorFlow warnings
-# Disable GPU if available to save memory on free tier
-try:
-    gpus = tf.config.list_physical_devices('GPU')
-    if gpus:
-        try:
-            for gpu in gpus:
-                tf.config.experimental.set_memory_growth(gpu, True)
-        except RuntimeError as e:
-            print(f"GPU configuration error: {e}")
-except Exception as e:
-    print(f"GPU check failed: {e}")
-
-# Limit TensorFlow to use only necessary memory and threads
-try:
-    tf.config.threading.set_inter_op_parallelism_threads(1)
-    tf.config.threading.set_intra_op_parallelism_threads(1)
-except Exception as e:
-    print(f"Threading config error: {e}")
+class InMemoryRequest(Request):
+    """
+    Keep image uploads in memory (bounded by MAX_CONTENT_LENGTH) instead of
+    spooling large ones to disk: they are decoded from memory anyway. Other
+    uploads (videos) keep Werkzeug's default of spooling to a temporary file.
+    """
+    in_memory_endpoints = ('submit', 'api_predict')
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint in self.in_memory_endpoints:
+            return io.BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
 
 app = Flask(__name__)
+app.request_class = InMemoryRequest
 app.config['SECRET_KEY'] = 'your-secret-key-here'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Inference backend: keras (TensorFlow), tflite, tflite-int8, onnx or onnx-int8
+# The lightweight backends never import TensorFlow (see export_model.py)
+app.config['MODEL_BACKEND'] = os.environ.get('MODEL_BACKEND', 'keras')
+app.config['MODEL_PATH'] = os.environ.get('MODEL_PATH') or DEFAULT_MODEL_PATHS.get(app.config['MODEL_BACKEND'])
+# Versioned model registry (see model_registry.py); MODEL_PATH is served while it
+# has no active version. Workers follow registry changes every MODEL_REGISTRY_POLL_S
+app.config['MODEL_REGISTRY_DIR'] = os.environ.get('MODEL_REGISTRY_DIR', 'models')
+app.config['MODEL_REGISTRY_POLL_S'] = float(os.environ.get('MODEL_REGISTRY_POLL_S', 5))
+# Shadow mode: share of requests also scored by the shadow version, and how many
+# shadow batches may wait before further ones are dropped
+app.config['SHADOW_SAMPLE_RATE'] = float(os.environ.get('SHADOW_SAMPLE_RATE', 1.0))
+app.config['SHADOW_MAX_PENDING'] = int(os.environ.get('SHADOW_MAX_PENDING', 4))
+# Bearer token for the /admin endpoints (unset disables them)
+app.config['ADMIN_TOKEN'] = os.environ.get('ADMIN_TOKEN') or None
+# Face localization before classification (FACE_DETECTION=0 classifies the whole image)
+app.config['FACE_DETECTION'] = os.environ.get('FACE_DETECTION', '1').lower() not in ('0', 'false', 'no')
+app.config['FACE_DETECT_MAX_SIDE'] = int(os.environ.get('FACE_DETECT_MAX_SIDE', 480))
+app.config['MAX_FACES'] = int(os.environ.get('MAX_FACES', 16))
+# The upload form downscales photos in the browser to this longest side (0 sends
+# originals); larger JPEGs that arrive anyway are decoded at reduced scale, never below it
+app.config['UPLOAD_MAX_SIDE'] = int(os.environ.get('UPLOAD_MAX_SIDE', 960))
+# Batch JSON API limits
+app.config['API_MAX_IMAGES'] = int(os.environ.get('API_MAX_IMAGES', 256))
+app.config['API_MAX_ARCHIVE_BYTES'] = int(os.environ.get('API_MAX_ARCHIVE_BYTES', 64 * 1024 * 1024))
+app.config['API_BATCH_SIZE'] = int(os.environ.get('API_BATCH_SIZE', 32))
+# Video timeline: sampled frames per second of video and EMA smoothing factor
+app.config['VIDEO_SAMPLE_FPS'] = float(os.environ.get('VIDEO_SAMPLE_FPS', 2))
+app.config['VIDEO_EMA_ALPHA'] = float(os.environ.get('VIDEO_EMA_ALPHA', 0.3))
+# A video holds an admission slot and a model while it streams: only the first
+# VIDEO_MAX_SECONDS of video are analyzed, within VIDEO_MAX_PROCESSING_S seconds
+app.config['VIDEO_MAX_SECONDS'] = float(os.environ.get('VIDEO_MAX_SECONDS', 600))
+app.config['VIDEO_MAX_PROCESSING_S'] = float(os.environ.get('VIDEO_MAX_PROCESSING_S', 300))
+# Prediction cache keyed by image hash + model version (size 0 disables it)
+app.config['PREDICTION_CACHE_SIZE'] = int(os.environ.get('PREDICTION_CACHE_SIZE', 1024))
+app.config['PREDICTION_CACHE_TTL'] = float(os.environ.get('PREDICTION_CACHE_TTL', 24 * 3600))
+app.config['PREDICTION_CACHE_PERSIST'] = os.environ.get('PREDICTION_CACHE_PERSIST', '0').lower() in ('1', 'true', 'yes')
+# Keep each submission's embedding (the model's last hidden layer; keras backend
+# without INFERENCE_WORKERS) for similarity search, per model version in EMBEDDINGS_DIR
+app.config['EMBEDDINGS'] = os.environ.get('EMBEDDINGS', '0').lower() in ('1', 'true', 'yes')
+app.config['EMBEDDINGS_DIR'] = os.environ.get('EMBEDDINGS_DIR', 'embeddings')
+app.config['EMBEDDING_DTYPE'] = os.environ.get('EMBEDDING_DTYPE', 'float16')  # float16 or int8
+# Coarse index lists scanned per query (only once embedding_store.py build-index has run)
+app.config['EMBEDDING_NPROBE'] = int(os.environ.get('EMBEDDING_NPROBE', 8))
+# Images are stored once in the database's blobs table; optionally also keep a
+# content-addressed copy in UPLOAD_FOLDER (written in the background)
+app.config['SAVE_UPLOADS'] = os.environ.get('SAVE_UPLOADS', '0').lower() in ('1', 'true', 'yes')
+# Stored images are re-encoded to at most IMAGE_MAX_SIDE pixels plus a thumbnail
+app.config['IMAGE_MAX_SIDE'] = int(os.environ.get('IMAGE_MAX_SIDE', 1024))
+app.config['IMAGE_JPEG_QUALITY'] = int(os.environ.get('IMAGE_JPEG_QUALITY', 90))
+app.config['THUMBNAIL_SIDE'] = int(os.environ.get('THUMBNAIL_SIDE', 128))
+# Retention of stored images (and saved uploads) by age and total size; 0 disables a limit
+app.config['RETENTION_MAX_AGE_DAYS'] = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))
+app.config['RETENTION_MAX_MB'] = float(os.environ.get('RETENTION_MAX_MB', 0))
+app.config['RETENTION_INTERVAL_S'] = float(os.environ.get('RETENTION_INTERVAL_S', 3600))
+# SQLite writer: inserts are grouped into one transaction per batch
+app.config['DATABASE_PATH'] = os.environ.get('DATABASE_PATH', 'database.db')
+app.config['DB_WRITE_BATCH_SIZE'] = int(os.environ.get('DB_WRITE_BATCH_SIZE', 64))
+app.config['DB_WRITE_MAX_DELAY_MS'] = float(os.environ.get('DB_WRITE_MAX_DELAY_MS', 20))
+# Set by gunicorn.conf.py when the app is preloaded in the gunicorn master:
+# work that is not fork-safe is deferred to warm_up() in each worker
+app.config['PREFORK'] = os.environ.get('PREFORK', '0').lower() in ('1', 'true', 'yes')
+# Micro-batching: concurrent requests are grouped into one forward pass
+app.config['INFERENCE_MAX_BATCH_SIZE'] = int(os.environ.get('INFERENCE_MAX_BATCH_SIZE', 16))
+app.config['INFERENCE_MAX_WAIT_MS'] = float(os.environ.get('INFERENCE_MAX_WAIT_MS', 5))
+# Model threads, and optionally a pool of separate model processes (0 runs the
+# model inside the web process); e.g. 4 cores: 4 workers x 1 thread or 1 x 4
+app.config['INFERENCE_WORKERS'] = int(os.environ.get('INFERENCE_WORKERS', 0))
+app.config['INFERENCE_THREADS'] = int(os.environ.get('INFERENCE_THREADS', 1))
+# Admission control for the prediction endpoints (per worker process): at most
+# ADMISSION_MAX_IN_FLIGHT run at once, ADMISSION_MAX_QUEUE more wait up to
+# ADMISSION_QUEUE_TIMEOUT_S; the rest get 503 + Retry-After (0 disables). Each
+# queued request holds a server thread, so the queue stays below gunicorn.conf.py's
+# spare threads
+app.config['ADMISSION_MAX_IN_FLIGHT'] = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 4))
+app.config['ADMISSION_MAX_QUEUE'] = int(os.environ.get('ADMISSION_MAX_QUEUE', 2))
+app.config['ADMISSION_QUEUE_TIMEOUT_S'] = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT_S', 5))
+# Work for a request is abandoned once it is this old (keep below the gunicorn timeout)
+app.config['INFERENCE_DEADLINE_S'] = float(os.environ.get('INFERENCE_DEADLINE_S', 30))
+# Per-client token bucket (0 disables); RATE_LIMIT_DB shares buckets between workers
+app.config['RATE_LIMIT_PER_MIN'] = float(os.environ.get('RATE_LIMIT_PER_MIN', 0))
+app.config['RATE_LIMIT_BURST'] = float(os.environ.get('RATE_LIMIT_BURST', 10))
+app.config['RATE_LIMIT_DB'] = os.environ.get('RATE_LIMIT_DB') or None
+# Identify clients by the first X-Forwarded-For address (only behind a trusted proxy)
+app.config['TRUST_PROXY_HEADERS'] = os.environ.get('TRUST_PROXY_HEADERS', '0').lower() in ('1', 'true', 'yes')
+# Request profiling (see request_profiler.py): a random sample of requests, plus any request sent
+# with the admin token and an X-Profile header, is traced to PROFILE_DIR (the newest PROFILE_MAX_TRACES kept)
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+app.config['PROFILE_TENSORFLOW'] = os.environ.get('PROFILE_TENSORFLOW', '0').lower() in ('1', 'true', 'yes')
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_MAX_TRACES'] = int(os.environ.get('PROFILE_MAX_TRACES', 50))
 
 # Allowed image extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
-# Emotion labels mapping
-EMOTION_LABELS = {
-    0: 'Angry',
-    1: 'Disgust',
-    2: 'Fear',
-    3: 'Happy',
-    4: 'Sad',
-    5: 'Surprise',
-    6: 'Neutral'
-}
-
 # Emotion messages mapping
 EMOTION_MESSAGES = {
     'Angry': "You look angry. What's making you upset?",
@@ -68,128 +160,754 @@ EMOTION_MESSAGES = {
     'Neutral': "You have a neutral expression. How are you feeling?"
 }
 
-# Load the trained model with memory optimization
-print("Loading emotion recognition model...")
-model = None
-try:
-    model_path = 'face_emotionModel.h5'
-    if os.path.exists(model_path):
-        # Load model with custom object scope to minimize memory
-        # Don't compile on load - we only need inference, not training
-        with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues on free tier
-            model = keras.models.load_model(model_path, compile=False)
-        print("Model loaded successfully!")
+# Prometheus metrics served on /metrics (per process; see metrics.py)
+registry = metrics.Registry()
+STAGE_LATENCY = registry.histogram(
+    'emotion_stage_duration_seconds',
+    'Time spent in each stage of a submission',
+    ['stage']
+)
+UPLOAD_BYTES = registry.histogram(
+    'emotion_upload_bytes',
+    'Size of analyzed images, by payload (compact: within UPLOAD_MAX_SIDE, full: larger or unknown)',
+    ['payload'],
+    buckets=(16384, 65536, 262144, 1048576, 4194304, 16777216)
+)
+DECODE_LATENCY = registry.histogram(
+    'emotion_decode_duration_seconds',
+    'Time to decode an analyzed image, by payload',
+    ['payload']
+)
+REQUEST_LATENCY = registry.histogram(
+    'emotion_http_request_duration_seconds',
+    'HTTP request latency by endpoint',
+    ['endpoint']
+)
+INFERENCE_BATCH_SIZE = registry.histogram(
+    'emotion_inference_batch_size',
+    'Images per model forward pass',
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+EMOTIONS_PREDICTED = registry.counter(
+    'emotion_predictions',
+    'Faces classified, by predicted emotion',
+    ['emotion']
+)
+ERRORS = registry.counter(
+    'emotion_errors',
+    'Errors by type',
+    ['type']
+)
+IN_FLIGHT = registry.gauge(
+    'emotion_requests_in_flight',
+    'Requests currently being handled'
+)
+SHED_REQUESTS = registry.counter(
+    'emotion_shed_requests',
+    'Requests rejected or abandoned by admission control, by reason',
+    ['reason']
+)
+ADMISSION_WAIT = registry.histogram(
+    'emotion_admission_wait_seconds',
+    'Time admitted requests waited for a slot'
+)
+MODEL_LOAD_SECONDS = registry.gauge(
+    'emotion_model_load_seconds',
+    'Time taken to load the most recently loaded model version'
+)
+MODEL_INFO = registry.gauge(
+    'emotion_model_info',
+    'Model versions loaded in this worker (1 while loaded), by role',
+    ['role', 'version']
+)
+MODEL_SWAPS = registry.counter(
+    'emotion_model_swaps',
+    'Times the active model version was replaced at runtime'
+)
+SHADOW_COMPARISONS = registry.counter(
+    'emotion_shadow_comparisons',
+    'Faces sent to the shadow model, by outcome (agree, disagree, dropped, error)',
+    ['outcome']
+)
+PROFILED_REQUESTS = registry.counter(
+    'emotion_profiled_requests',
+    'Requests traced by the request profiler, by reason (header, sampled)',
+    ['reason']
+)
+WARMUP_SECONDS = registry.gauge(
+    'emotion_warmup_seconds',
+    'Time taken by the synthetic warm-up inference'
+)
+READY_SECONDS = registry.gauge(
+    'emotion_ready_seconds',
+    'Time from process start (or fork) to the first successful prediction'
+)
+registry.gauge(
+    'process_resident_memory_bytes',
+    'Resident memory size of this worker',
+    function=metrics.process_rss_bytes
+)
+registry.gauge(
+    'process_proportional_memory_bytes',
+    'Proportional set size of this worker (shared pages split between processes)',
+    function=lambda: metrics.process_memory().get('pss', 0)
+)
+registry.gauge(
+    'process_private_memory_bytes',
+    'Memory private to this worker',
+    function=lambda: metrics.process_memory().get('private', 0)
+)
+
+PROCESS_STARTED = time.monotonic()
+
+def predict_batch(model, images, embeddings=False):
+    """
+    Run one forward pass over a (n, 48, 48, 1) uint8 batch of face crops.
+    Called from the inference scheduler threads; returns softmax outputs,
+    or (outputs, embeddings) with embeddings.
+    """
+    INFERENCE_BATCH_SIZE.observe(len(images))
+    with STAGE_LATENCY.time(stage='model_forward'):
+        if embeddings:
+            return model.predict_with_embeddings(images)
+        return model.predict(images)
+
+def load_serving_model(metadata):
+    """Load one model version with its own micro-batching scheduler"""
+    print(f"Loading emotion recognition model {metadata['version']} ({metadata['backend']} backend)...")
+    load_started = time.perf_counter()
+    if app.config['INFERENCE_WORKERS'] > 0:
+        # Worker processes are spawned on first use (see warm_up)
+        model = InferencePool(
+            metadata['backend'], metadata['path'],
+            num_workers=app.config['INFERENCE_WORKERS'],
+            threads_per_worker=app.config['INFERENCE_THREADS'],
+            slot_capacity=max(app.config['INFERENCE_MAX_BATCH_SIZE'], app.config['API_BATCH_SIZE'])
+        )
+    else:
+        model = load_backend(metadata['backend'], metadata['path'], num_threads=app.config['INFERENCE_THREADS'])
+    MODEL_LOAD_SECONDS.set(time.perf_counter() - load_started)
+    embeddings = app.config['EMBEDDINGS'] and hasattr(model, 'predict_with_embeddings')
+    if app.config['EMBEDDINGS'] and not embeddings:
+        print(f"Model {metadata['version']} cannot return embeddings ({metadata['backend']} backend"
+              f"{' in an inference pool' if isinstance(model, InferencePool) else ''}); none will be stored")
+    scheduler = BatchScheduler(
+        functools.partial(predict_batch, model, embeddings=embeddings),
+        max_batch_size=app.config['INFERENCE_MAX_BATCH_SIZE'],
+        max_wait_ms=app.config['INFERENCE_MAX_WAIT_MS'],
+        # One batch in flight per pool process; an in-process model runs one at a time
+        concurrency=max(1, app.config['INFERENCE_WORKERS'])
+    )
+    print(f"Model {metadata['version']} loaded successfully!")
+    return ServingModel(metadata['version'], model, scheduler, metadata, embeddings=embeddings)
+
+def warm_up_model(serving):
+    """Run one full-size batch and one scheduled request before a version takes traffic"""
+    batch = np.zeros((app.config['INFERENCE_MAX_BATCH_SIZE'], 48, 48, 1), dtype=np.uint8)
+    if serving.embeddings:
+        serving.model.predict_with_embeddings(batch)
     else:
-        print(f"Warning: Model file '{model_path}' not found. Emotion detection will not work.")
-        print("Please ensure face_emotionModel.h5 is in the project root directory.")
-except Exception as e:
-    print(f"Error loading model: {e}")
-    import traceback
-    print(traceback.format_exc())
-    print("Please train the model first using model_training.py")
-    model = None
+        serving.model.predict(batch)
+    serving.predict(np.zeros((1, 48, 48, 1), dtype=np.uint8))
+    serving.scheduler.reset_stats()  # Keep /stats about real traffic
+
+def record_swap(role, previous, serving):
+    if previous is not None:
+        MODEL_INFO.set(0, role=role, version=previous.version)
+        if role == 'active' and serving is not None:
+            MODEL_SWAPS.inc()
+    if serving is not None:
+        MODEL_INFO.set(1, role=role, version=serving.version)
+
+# New versions are loaded and warmed up next to the serving one, then swapped in;
+# requests finish on the version they started with
+model_registry = ModelRegistry(app.config['MODEL_REGISTRY_DIR'])
+models = ModelManager(
+    model_registry, load_serving_model,
+    warm_fn=warm_up_model,
+    fallback_path=app.config['MODEL_PATH'],
+    fallback_backend=app.config['MODEL_BACKEND'],
+    poll_interval=app.config['MODEL_REGISTRY_POLL_S'],
+    on_swap=record_swap
+)
+
+def load_models():
+    """Load the active (and shadow) model version into this process"""
+    models.sync(warm=False)
+    if models.active is None:
+        print(f"Warning: no model to serve ('{app.config['MODEL_REGISTRY_DIR']}' has no active version and "
+              f"'{app.config['MODEL_PATH']}' is missing or failed to load). Emotion detection will not work.")
+        print("Please train the model first using model_training.py, then place face_emotionModel.h5 in the "
+              "project root directory or register it with model_registry.py.")
+        print("For tflite/onnx backends, run export_model.py first.")
+
+# In the gunicorn master only fork-safe models are loaded (and then shared
+# copy-on-write); TensorFlow is imported but each worker loads its own model
+planned_backends = models.planned_backends() or [app.config['MODEL_BACKEND']]
+model_deferred = (app.config['PREFORK'] and not app.config['INFERENCE_WORKERS']
+                  and any(name in BACKENDS and not BACKENDS[name].fork_safe for name in planned_backends))
+if model_deferred:
+    for name in sorted(set(planned_backends)):
+        print(f"Preloading {name} runtime; the model is loaded in each worker")
+        preload_runtime(name)
+else:
+    load_models()
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# Long-lived WAL connections per worker plus a background batch writer
+storage = Storage(
+    app.config['DATABASE_PATH'],
+    batch_size=app.config['DB_WRITE_BATCH_SIZE'],
+    max_batch_delay_ms=app.config['DB_WRITE_MAX_DELAY_MS'],
+    on_commit=lambda seconds, writes: STAGE_LATENCY.observe(seconds, stage='database_insert'),
+    on_error=lambda error: ERRORS.inc(type='database')
+)
+
 def init_database():
     """Initialize SQLite database with required tables"""
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
-    
-    # Create table for storing user data and images
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            emotion_detected TEXT,
-            image_path TEXT,
-            image_blob BLOB
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    storage.init_schema()
     print("Database initialized successfully!")
 
-def detect_emotion(image_path):
+admission = AdmissionController(
+    max_in_flight=app.config['ADMISSION_MAX_IN_FLIGHT'] or 1,
+    max_queue=app.config['ADMISSION_MAX_QUEUE'],
+    queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT_S']
+) if app.config['ADMISSION_MAX_IN_FLIGHT'] > 0 else None
+rate_limiter = RateLimiter(
+    app.config['RATE_LIMIT_PER_MIN'],
+    burst=app.config['RATE_LIMIT_BURST'],
+    db_path=app.config['RATE_LIMIT_DB']
+)
+registry.gauge(
+    'emotion_admission_in_flight',
+    'Requests holding an admission slot',
+    function=lambda: admission.in_flight() if admission else 0
+)
+registry.gauge(
+    'emotion_admission_queue_depth',
+    'Requests waiting for an admission slot',
+    function=lambda: admission.queue_depth() if admission else 0
+)
+registry.gauge(
+    'emotion_inference_queue_depth',
+    'Requests queued for the inference scheduler',
+    function=lambda: active_queue_depth()
+)
+
+def active_queue_depth():
+    serving = models.active
+    return serving.scheduler.queue_depth() if serving is not None else 0
+
+def client_id():
+    """The address rate limits are applied to"""
+    if app.config['TRUST_PROXY_HEADERS'] and request.access_route:
+        return request.access_route[0]
+    return request.remote_addr or 'unknown'
+
+def overloaded_response(error, status, retry_after):
+    response = app.make_response(({'error': error, 'retry_after': retry_after}, status))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def admission_controlled(view):
     """
-    Detect emotion from an image file.
-    Preprocesses the image and uses the trained model for prediction.
-    Optimized for Render free tier with minimal memory usage.
+    Rate limit the client, then hold an admission slot while the view runs
+    (for streamed responses, until the body has been sent). Shed requests get
+    429 or 503 with Retry-After right away. Sets g.deadline for the work.
     """
-    if model is None:
-        return None, "Model not loaded. Please train the model first."
-    
-    try:
-        # Load and preprocess image
-        img = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
-        
-        if img is None:
-            return None, "Could not load image. Please ensure the file is a valid image."
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        allowed, retry_after = rate_limiter.allow(client_id())
+        if not allowed:
+            SHED_REQUESTS.inc(reason='rate_limited')
+            return overloaded_response('Rate limit exceeded; please slow down.', 429, retry_after)
         
-        # Resize to 48x48 (model input size)
-        img = cv2.resize(img, (48, 48))
-        
-        # Normalize pixel values to [0, 1]
-        img = img.astype('float32') / 255.0
-        
-        # Reshape for model input: (1, 48, 48, 1)
-        img = img.reshape(1, 48, 48, 1)
+        ticket = None
+        if admission is not None:
+            try:
+                ticket = admission.acquire()
+            except Overloaded as e:
+                SHED_REQUESTS.inc(reason=e.reason)
+                return overloaded_response('Server is busy; please retry shortly.', 503, e.retry_after)
+            ADMISSION_WAIT.observe(ticket.waited)
+            trace = request_profiler.current()
+            if trace is not None:
+                now = time.perf_counter()
+                trace.add('admission_wait', now - ticket.waited, now)
+        # The deadline counts from arrival, so time spent queued for a slot is included
+        g.deadline = time.monotonic() - (time.perf_counter() - g.request_started) + app.config['INFERENCE_DEADLINE_S']
         
-        # Predict emotion with CPU device and minimal memory
-        # Use predict_on_batch for better memory efficiency
         try:
-            with tf.device('/CPU:0'):  # Force CPU usage to avoid GPU memory issues
-                # Use predict_on_batch for single prediction - more memory efficient
-                predictions = model.predict_on_batch(img)
-                emotion_idx = np.argmax(predictions[0])
-                confidence = float(predictions[0][emotion_idx])
-                emotion = EMOTION_LABELS[emotion_idx]
+            response = app.make_response(view(*args, **kwargs))
+        except BaseException:
+            if ticket is not None:
+                ticket.release()
+            raise
+        if ticket is not None:
+            if response.is_streamed:
+                response.call_on_close(ticket.release)
+            else:
+                ticket.release()
+        return response
+    return wrapper
+
+# Faces are found on a downscaled copy; boxes are mapped back to full resolution
+face_detector = None
+if app.config['FACE_DETECTION']:
+    try:
+        face_detector = FaceDetector(
+            cascade_path=os.environ.get('FACE_CASCADE_PATH', DEFAULT_CASCADE),
+            detect_max_side=app.config['FACE_DETECT_MAX_SIDE']
+        )
+    except Exception as e:
+        print(f"Face detector unavailable, classifying whole images: {e}")
+
+# Repeated uploads are answered from the cache; it is invalidated when the active model version changes
+prediction_cache = PredictionCache(
+    models.active_version,
+    max_entries=app.config['PREDICTION_CACHE_SIZE'],
+    ttl_seconds=app.config['PREDICTION_CACHE_TTL'],
+    storage=storage if app.config['PREDICTION_CACHE_PERSIST'] else None
+)
+
+# Submission embeddings, one append-only store per model version (see embedding_store.py)
+embedding_stores = EmbeddingStores(app.config['EMBEDDINGS_DIR'], dtype=app.config['EMBEDDING_DTYPE'])
+
+def locate_faces(image_bytes):
+    """
+    Decode an uploaded image in memory and find its faces.
+    Returns (crops, boxes, face_detected, timings): crops is a uint8 batch of
+    shape (n, 48, 48, 1) with one entry per (x, y, w, h) box. Without a
+    detectable face the whole image is used. Raises ValueError if the bytes
+    are not a valid image.
+    """
+    # Decode straight from memory as grayscale. Compact payloads (already within
+    # UPLOAD_MAX_SIDE, e.g. downscaled by the upload form) decode as they are;
+    # larger JPEGs decode at reduced scale instead of at full resolution
+    started = time.perf_counter()
+    max_side = app.config['UPLOAD_MAX_SIDE']
+    size = image_size(image_bytes)
+    payload = 'compact' if size is not None and max_side and max(size) <= max_side else 'full'
+    img = decode_image(image_bytes, min_side=max_side if payload == 'full' else None, size=size)
+    
+    if img is None:
+        raise ValueError("Could not load image. Please ensure the file is a valid image.")
+    decoded = time.perf_counter()
+    UPLOAD_BYTES.observe(len(image_bytes), payload=payload)
+    DECODE_LATENCY.observe(decoded - started, payload=payload)
+    
+    # Localize faces; fall back to the whole image when none is found
+    boxes = []
+    if face_detector is not None:
+        boxes = face_detector.detect(img)[:app.config['MAX_FACES']]
+    face_detected = bool(boxes)
+    if not boxes:
+        boxes = [(0, 0, img.shape[1], img.shape[0])]
+    detected = time.perf_counter()
+    
+    # Resize each crop to 48x48 and stack into one uint8 batch (the model rescales)
+    crops = np.stack([prepare_face(face) for face in crop_faces(img, boxes)])
+    prepared = time.perf_counter()
+    timings = {
+        'decode_ms': (decoded - started) * 1000.0,
+        'detect_ms': (detected - decoded) * 1000.0
+    }
+    STAGE_LATENCY.observe((decoded - started) + (prepared - detected), stage='decode_resize')
+    STAGE_LATENCY.observe(detected - decoded, stage='face_detect')
+    trace = request_profiler.current()
+    if trace is not None:
+        trace.add('decode', started, decoded, payload=payload, bytes=len(image_bytes),
+                  width=img.shape[1], height=img.shape[0])
+        trace.add('face_detect', decoded, detected, faces=len(boxes) if face_detected else 0)
+        trace.add('resize', detected, prepared, crops=len(crops))
+    return crops, boxes, face_detected, timings
+
+DEADLINE_MESSAGE = "Request deadline exceeded; the server is overloaded, please retry."
+
+def analyze_images(images, deadline=None, embeddings=False):
+    """
+    Detect every face in a list of encoded images and classify all of them
+    in one batched forward pass.
+    Returns one (result, None) or (None, error_message) pair per image, in
+    input order. A result holds the primary (largest) face's emotion and
+    confidence, a 'faces' list with each face's box and prediction, and
+    per-stage timings in ms (only cache_lookup_ms for cached results), and
+    the model_version that produced it. Past
+    deadline (time.monotonic()) remaining images are not processed.
+    With embeddings, freshly classified results also hold the primary face's
+    'embedding' (a NumPy array, not JSON) when the model captures them.
+    """
+    serving = models.acquire()
+    if serving is None:
+        ERRORS.inc(len(images), type='model_not_loaded')
+        return [(None, "Model not loaded. Please train the model first.")] * len(images)
+    try:
+        return analyze_with_model(serving, images, deadline, embeddings)
+    finally:
+        serving.release()
+
+def analyze_with_model(serving, images, deadline=None, embeddings=False):
+    """analyze_images() on one model version, held by the caller"""
+    outcomes = [None] * len(images)
+    pending = []
+    trace = request_profiler.current()
+    for index, image_bytes in enumerate(images):
+        if deadline is not None and time.monotonic() >= deadline:
+            SHED_REQUESTS.inc(reason='deadline')
+            outcomes[index] = (None, DEADLINE_MESSAGE)
+            continue
+        try:
+            # Answer repeated uploads without decoding or running the model
+            lookup_started = time.perf_counter()
+            image_hash = hash_image(image_bytes)
+            cached = prediction_cache.get(image_hash)
+            if cached is not None and embeddings and serving.embeddings and \
+                    embedding_stores.get(serving.version).row(image_hash) is None:
+                cached = None  # Classified before its embedding was stored: run the model for it
+            looked_up = time.perf_counter()
+            if trace is not None:
+                trace.add('cache_lookup', lookup_started, looked_up, hit=cached is not None)
+            if cached is not None:
+                cached['cached'] = True
+                # The stored timings are the original request's; this one only looked it up
+                cached['timings'] = {'cache_lookup_ms': (looked_up - lookup_started) * 1000.0}
+                cached['image_hash'] = image_hash
+                for face in cached['faces']:
+                    EMOTIONS_PREDICTED.inc(emotion=face['emotion'])
+                outcomes[index] = (cached, None)
+                continue
             
-            return emotion, confidence
-        except Exception as pred_error:
-            print(f"Prediction error: {pred_error}")
+            crops, boxes, face_detected, timings = locate_faces(image_bytes)
+            pending.append((index, image_hash, crops, boxes, face_detected, timings))
+        except ValueError as e:
+            ERRORS.inc(type='invalid_image')
+            outcomes[index] = (None, str(e))
+        except Exception as e:
             import traceback
+            ERRORS.inc(type=type(e).__name__)
+            print(f"Error in analyze_images: {str(e)}")
             print(traceback.format_exc())
-            # Try alternative prediction method
-            try:
-                with tf.device('/CPU:0'):
-                    predictions = model(img, training=False).numpy()
-                    emotion_idx = np.argmax(predictions[0])
-                    confidence = float(predictions[0][emotion_idx])
-                    emotion = EMOTION_LABELS[emotion_idx]
-                return emotion, confidence
-            except Exception as alt_error:
-                return None, f"Error during prediction: {str(pred_error)}"
+            outcomes[index] = (None, str(e))
+    
+    if not pending:
+        return outcomes
+    
+    started = time.perf_counter()
+    try:
+        predictions, face_embeddings = predict_faces(serving, np.concatenate([item[2] for item in pending]), deadline)
+    except DeadlineExceeded:
+        SHED_REQUESTS.inc(len(pending), reason='deadline')
+        for item in pending:
+            outcomes[item[0]] = (None, DEADLINE_MESSAGE)
+        return outcomes
+    except Exception as pred_error:
+        ERRORS.inc(len(pending), type='prediction')
+        for item in pending:
+            outcomes[item[0]] = (None, f"Error during prediction: {str(pred_error)}")
+        return outcomes
+    classify_ms = (time.perf_counter() - started) * 1000.0
+    
+    offset = 0
+    for index, image_hash, crops, boxes, face_detected, timings in pending:
+        primary = offset
+        faces = []
+        for box, probabilities in zip(boxes, predictions[offset:offset + len(crops)]):
+            emotion_idx = int(np.argmax(probabilities))
+            faces.append({
+                'box': [int(v) for v in box],
+                'emotion': EMOTION_LABELS[emotion_idx],
+                'confidence': float(probabilities[emotion_idx])
+            })
+        offset += len(crops)
+        for face in faces:
+            EMOTIONS_PREDICTED.inc(emotion=face['emotion'])
         
+        timings['classify_ms'] = classify_ms
+        result = {
+            'emotion': faces[0]['emotion'],
+            'confidence': faces[0]['confidence'],
+            'face_detected': face_detected,
+            'faces': faces,
+            'timings': timings,
+            'cached': False,
+            'model_version': serving.version
+        }
+        prediction_cache.put(image_hash, result, version=serving.version)
+        result['image_hash'] = image_hash
+        if embeddings and face_embeddings is not None:
+            result['embedding'] = face_embeddings[primary]  # Boxes are ordered largest first
+        outcomes[index] = (result, None)
+    
+    submit_shadow(serving.version, pending, predictions)
+    return outcomes
+
+def predict_faces(serving, crops, deadline=None):
+    """
+    serving.predict() with embeddings. For a profiled request, also records
+    the queue wait and forward pass of its batch, within a TensorFlow trace
+    if one was asked for.
+    """
+    trace = request_profiler.current()
+    if trace is None:
+        return serving.predict(crops, deadline=deadline, with_embeddings=True)
+    timings = {}
+    started = time.perf_counter()
+    try:
+        with trace.tensorflow_trace(profile_store.tf_logdir(trace)):
+            return serving.predict(crops, deadline=deadline, with_embeddings=True, timings=timings)
+    finally:
+        trace.add('inference', started, time.perf_counter(), faces=len(crops), model_version=serving.version)
+        if timings:
+            trace.add('queue_wait', timings['enqueued'], timings['started'])
+            trace.add('model_forward', timings['started'], timings['finished'], batch_size=timings['batch_size'],
+                      backend=serving.backend)
+
+# Shadow scoring runs off the request path, one batch at a time; when
+# SHADOW_MAX_PENDING batches are already waiting, further ones are dropped
+shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shadow')
+shadow_slots = threading.BoundedSemaphore(max(1, app.config['SHADOW_MAX_PENDING']))
+
+def submit_shadow(model_version, pending, predictions):
+    """Mirror a sample of classified faces to the shadow model version, if there is one"""
+    if models.shadow is None or random.random() >= app.config['SHADOW_SAMPLE_RATE']:
+        return
+    shadow = models.acquire_shadow()
+    if shadow is None:
+        return
+    faces = [(image_hash, face_index) for _, image_hash, crops, _, _, _ in pending for face_index in range(len(crops))]
+    if not shadow_slots.acquire(blocking=False):
+        shadow.release()
+        SHADOW_COMPARISONS.inc(len(faces), outcome='dropped')
+        return
+    crops = np.concatenate([item[2] for item in pending])
+    shadow_executor.submit(score_shadow, shadow, model_version, crops, faces, predictions)
+
+def score_shadow(shadow, model_version, crops, faces, predictions):
+    """Classify crops with the shadow version and record how it compares (shadow thread)"""
+    try:
+        rows = []
+        for (image_hash, face_index), served, candidate in zip(faces, predictions, shadow.predict(crops)):
+            served_idx, candidate_idx = int(np.argmax(served)), int(np.argmax(candidate))
+            SHADOW_COMPARISONS.inc(outcome='agree' if served_idx == candidate_idx else 'disagree')
+            rows.append((image_hash, face_index, model_version, EMOTION_LABELS[served_idx],
+                         float(served[served_idx]), shadow.version, EMOTION_LABELS[candidate_idx],
+                         float(candidate[candidate_idx])))
+        storage.insert_shadow_predictions(rows)
     except Exception as e:
-        import traceback
-        print(f"Error in detect_emotion: {str(e)}")
-        print(traceback.format_exc())
-        return None, str(e)
-
-def save_to_database(name, emotion, image_path):
-    """Save user data and image to database"""
-    conn = sqlite3.connect('database.db')
-    cursor = conn.cursor()
+        SHADOW_COMPARISONS.inc(len(faces), outcome='error')
+        print(f"Shadow scoring on model {shadow.version} failed: {e}")
+    finally:
+        shadow.release()
+        shadow_slots.release()
+
+def analyze_image(image_bytes, deadline=None, embeddings=False):
+    """
+    Detect every face in the encoded bytes of an uploaded image and classify
+    them all in one batched forward pass.
+    Returns (result, None) on success or (None, error_message).
+    """
+    return analyze_images([image_bytes], deadline=deadline, embeddings=embeddings)[0]
+
+def detect_emotion(image_bytes):
+    """
+    Detect emotion from the encoded bytes of an uploaded image.
+    Returns (emotion, confidence) for the primary face, or (None, error_message).
+    """
+    result, error = analyze_image(image_bytes)
+    if result is None:
+        return None, error
+    return result['emotion'], result['confidence']
+
+def save_to_database(name, emotion, image_path, image_blob, image_hash=None, confidence=None, model_version=None,
+                     embedding=None):
+    """
+    Normalize the uploaded image (bounded resolution plus a thumbnail) and
+    queue it with the user data for the database writer. Identical uploads
+    are stored, and normalized, only once. The embedding, if any, is added
+    to the model version's embedding store.
+    """
+    try:
+        thumbnail = None
+        original_size = len(image_blob) if image_blob else None
+        if image_blob and image_hash and storage.has_blob(image_hash):
+            image_blob = None  # Refer to the stored copy
+        elif image_blob:
+            with STAGE_LATENCY.time(stage='image_normalize'):
+                normalized = normalize_image(image_blob, max_side=app.config['IMAGE_MAX_SIDE'],
+                                             quality=app.config['IMAGE_JPEG_QUALITY'],
+                                             thumbnail_side=app.config['THUMBNAIL_SIDE'])
+            if normalized is not None:
+                image_blob, thumbnail = normalized
+        storage.insert_submission(name, emotion, image_path, image_blob, image_hash=image_hash,
+                                  confidence=confidence, thumbnail=thumbnail, original_size=original_size,
+                                  model_version=model_version)
+    except Exception as e:
+        ERRORS.inc(type='database')
+        print(f"Database error: {e}")
+    if embedding is not None:
+        try:
+            embedding_stores.get(model_version).append([image_hash], embedding)
+        except Exception as e:
+            ERRORS.inc(type='embedding_store')
+            print(f"Embedding store error: {e}")
+
+# Single background thread for upload ingest (normalizing images, writing
+# originals), so it never blocks a request
+upload_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-writer')
+
+def write_upload(filepath, image_bytes):
+    """Write an original upload to disk (runs on the upload writer thread)"""
+    try:
+        if os.path.exists(filepath):
+            return  # Content-addressed name: identical upload already stored
+        with STAGE_LATENCY.time(stage='file_save'):
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            with open(filepath, 'wb') as f:
+                f.write(image_bytes)
+        print(f"File saved to: {filepath}")  # Debug log
+    except Exception as e:
+        ERRORS.inc(type='file_save')
+        print(f"Error saving upload {filepath}: {e}")
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    IN_FLIGHT.inc()
+
+@app.teardown_request
+def record_request(exc=None):
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    IN_FLIGHT.dec()
+    # Streamed responses are timed until the view returns, not until the body is sent
+    REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=request.endpoint or 'unknown')
+
+# Finished traces are written to the ring off the request path
+profile_store = request_profiler.ProfileStore(app.config['PROFILE_DIR'], max_traces=app.config['PROFILE_MAX_TRACES'])
+profile_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='profile-writer')
+
+@app.before_request
+def start_profiling():
+    """
+    Trace this request if it is sampled, or if it carries X-Profile (1, or
+    tf to add a TensorFlow trace of the forward pass) with the admin token.
+    Unprofiled requests pay for one header lookup.
+    """
+    header = request.headers.get('X-Profile')
+    if header and admin_authorized():
+        reason, tensorflow = 'header', header.lower() == 'tf'
+    elif app.config['PROFILE_SAMPLE_RATE'] and random.random() < app.config['PROFILE_SAMPLE_RATE']:
+        reason, tensorflow = 'sampled', app.config['PROFILE_TENSORFLOW']
+    else:
+        return
+    PROFILED_REQUESTS.inc(reason=reason)
+    g.trace = request_profiler.Trace(reason, tensorflow=tensorflow).start()
+    g.trace.info.update(method=request.method, path=request.path, endpoint=request.endpoint, pid=os.getpid())
+
+@app.after_request
+def tag_profiled_response(response):
+    trace = g.get('trace')
+    if trace is not None:
+        trace.info['status'] = response.status_code
+        response.headers['X-Profile-Id'] = trace.id
+        if response.is_streamed:
+            # Keep tracing until the body has been sent
+            g.pop('trace')
+            response.call_on_close(functools.partial(finish_profiling, trace))
+    return response
+
+@app.teardown_request
+def finish_request_profiling(exc=None):
+    trace = g.pop('trace', None)
+    if trace is not None:
+        finish_profiling(trace, exc)
+
+def finish_profiling(trace, exc=None):
+    trace.finish()
+    trace.info['error'] = type(exc).__name__ if exc is not None else None
+    profile_writer.submit(save_profile, trace)
+
+def save_profile(trace):
+    """Write a finished trace to the ring (runs on the profile writer thread)"""
+    try:
+        profile_store.save(trace)
+    except Exception as e:
+        ERRORS.inc(type='profile_save')
+        print(f"Error saving profile {trace.id}: {e}")
+
+# Filled in by warm_up(); /health reports ready only once it has run
+startup = {'ready': False, 'pid': None, 'warmup_s': None, 'ready_s': None, 'memory': None}
+
+def apply_retention():
+    """Evict stored images (and saved uploads) beyond the configured age and size"""
+    max_age_days = app.config['RETENTION_MAX_AGE_DAYS']
+    max_bytes = int(app.config['RETENTION_MAX_MB'] * 1024 * 1024)
+    result = storage.apply_retention(max_age_days, max_bytes)
+    if app.config['SAVE_UPLOADS']:
+        result['uploads'] = prune_directory(app.config['UPLOAD_FOLDER'], max_age_days, max_bytes)
+    return result
+
+def retention_loop():
+    while True:
+        try:
+            result = apply_retention()
+            if result['images_evicted'] or result.get('uploads', {}).get('files_deleted'):
+                print(f"Retention: {result}")
+        except Exception as e:
+            print(f"Retention failed: {e}")
+        time.sleep(app.config['RETENTION_INTERVAL_S'])
+
+def start_retention():
+    """Run the retention policy periodically in this process, if any limit is set"""
+    if app.config['RETENTION_MAX_AGE_DAYS'] or app.config['RETENTION_MAX_MB']:
+        threading.Thread(target=retention_loop, name='retention', daemon=True).start()
+
+def warm_up(process_started=None):
+    """
+    Load a deferred model and run synthetic inference through the real
+    request path (decode, face detection, scheduler, model) plus one
+    full-size batch, so graph tracing happens before the first request.
+    Also starts following the model registry in this process.
+    process_started is a time.monotonic() value, e.g. when the worker forked.
+    """
+    global model_deferred
+    started = time.monotonic()
+    if model_deferred:
+        model_deferred = False
+        load_models()
     
-    # Read image as binary
-    image_blob = None
-    if os.path.exists(image_path):
-        with open(image_path, 'rb') as f:
-            image_blob = f.read()
+    for serving in (models.acquire(), models.acquire_shadow()):
+        if serving is None:
+            continue
+        try:
+            gradient = np.tile(np.linspace(0, 255, 96, dtype=np.uint8), (96, 1))
+            crops, _, _, _ = locate_faces(cv2.imencode('.png', gradient)[1].tobytes())
+            serving.predict(crops)
+            warm_up_model(serving)
+        except Exception as e:
+            print(f"Warm-up inference failed: {e}")
+        finally:
+            serving.release()
     
-    # Insert into database
-    cursor.execute('''
-        INSERT INTO users (name, emotion_detected, image_path, image_blob)
-        VALUES (?, ?, ?, ?)
-    ''', (name, emotion, image_path, image_blob))
+    models.start_polling()
+    start_retention()
     
-    conn.commit()
-    conn.close()
+    finished = time.monotonic()
+    startup.update({
+        'ready': True,
+        'pid': os.getpid(),
+        'warmup_s': finished - started,
+        'ready_s': finished - (process_started if process_started is not None else PROCESS_STARTED),
+        'memory': metrics.process_memory()
+    })
+    WARMUP_SECONDS.set(startup['warmup_s'])
+    READY_SECONDS.set(startup['ready_s'])
+    print(f"Worker {startup['pid']} ready in {startup['ready_s']:.2f}s "
+          f"(warm-up {startup['warmup_s']:.2f}s, memory {startup['memory']})")
 
 @app.route('/')
 def index():
@@ -198,15 +916,51 @@ def index():
 
 @app.route('/health')
 def health():
-    """Health check endpoint to keep service alive"""
-    return {'status': 'healthy', 'model_loaded': model is not None}, 200
+    """Health check endpoint to keep service alive; 503 until warm-up has finished"""
+    return {
+        'status': 'healthy' if startup['ready'] else 'starting',
+        'ready': startup['ready'],
+        'model_loaded': models.active is not None,
+        'model_version': models.active_version(),
+        'backend': models.active.backend if models.active is not None else app.config['MODEL_BACKEND']
+    }, 200 if startup['ready'] else 503
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Prometheus scrape endpoint (text exposition format)"""
+    return Response(registry.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route('/stats')
+def stats():
+    """Inference batching and prediction cache statistics"""
+    serving = models.active
+    return {
+        'batching': serving.scheduler.stats() if serving is not None else None,
+        'models': dict(models.status(), shadow_comparisons={
+            outcome: SHADOW_COMPARISONS.value(outcome=outcome)
+            for outcome in ('agree', 'disagree', 'dropped', 'error')
+        }),
+        'prediction_cache': prediction_cache.stats(),
+        'embeddings': embedding_stores.get(serving.version).stats()
+                      if app.config['EMBEDDINGS'] and serving is not None else None,
+        'storage': storage.stats(),
+        'admission': admission.stats() if admission else None,
+        'rate_limit': rate_limiter.stats(),
+        'inference_pool': serving.model.stats() if serving is not None and isinstance(serving.model, InferencePool) else None,
+        'startup': dict(startup, memory_now=metrics.process_memory())
+    }, 200
 
 @app.route('/submit', methods=['POST'])
+@admission_controlled
 def submit():
     """Handle form submission"""
     try:
         print("Form submission received")  # Debug log
         
+        # Receive and parse the multipart body (the upload is buffered in memory)
+        with STAGE_LATENCY.time(stage='upload_receive'), request_profiler.span('upload_receive'):
+            request.files
+        
         # Get form data
         name = request.form.get('name', '').strip()
         
@@ -235,43 +989,34 @@ def submit():
             flash('Invalid file type. Please upload a valid image (PNG, JPG, JPEG, GIF, BMP).', 'error')
             return redirect(url_for('index'))
         
-        # Create uploads directory if it doesn't exist
-        if not os.path.exists(app.config['UPLOAD_FOLDER']):
-            os.makedirs(app.config['UPLOAD_FOLDER'])
-            print(f"Created uploads directory: {app.config['UPLOAD_FOLDER']}")
+        # Read the upload once; the same bytes feed inference and persistence
+        image_bytes = file.read()
         
-        # Save uploaded file
-        filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        unique_filename = f"{timestamp}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        print(f"File saved to: {filepath}")  # Debug log
-        
-        # Detect emotion
+        # Detect faces and emotions
         print("Starting emotion detection...")  # Debug log
-        emotion, confidence = detect_emotion(filepath)
+        result, error = analyze_image(image_bytes, deadline=g.get('deadline'), embeddings=app.config['EMBEDDINGS'])
         
-        if emotion is None:
-            print(f"Emotion detection failed: {confidence}")  # Debug log
-            flash(f'Error detecting emotion: {confidence}', 'error')
-            # Clean up uploaded file
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-            except:
-                pass
+        if result is None:
+            print(f"Emotion detection failed: {error}")  # Debug log
+            flash(f'Error detecting emotion: {error}', 'error')
             return redirect(url_for('index'))
         
-        print(f"Emotion detected: {emotion} with confidence: {confidence}")  # Debug log
+        emotion, confidence = result['emotion'], result['confidence']
+        print(f"Emotion detected: {emotion} with confidence: {confidence} "
+              f"({len(result['faces'])} face(s), timings: {result['timings']})")  # Debug log
         
-        # Save to database
-        try:
-            save_to_database(name, emotion, filepath)
-            print("Data saved to database")  # Debug log
-        except Exception as db_error:
-            print(f"Database error: {db_error}")  # Debug log
-            # Continue even if database save fails
+        # Optionally keep the original on disk without waiting for the write
+        filepath = None
+        if app.config['SAVE_UPLOADS']:
+            extension = file.filename.rsplit('.', 1)[1].lower()  # Validated by allowed_file
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{result['image_hash']}.{extension}")
+            upload_writer.submit(write_upload, filepath, image_bytes)
+        
+        # Save to database; normalizing the image runs on the upload writer thread
+        upload_writer.submit(save_to_database, name, emotion, filepath, image_bytes,
+                             image_hash=result['image_hash'], confidence=confidence,
+                             model_version=result.get('model_version'), embedding=result.pop('embedding', None))
+        print("Data queued for the database")  # Debug log
         
         # Get emotion message
         message = EMOTION_MESSAGES.get(emotion, f"You look {emotion.lower()}.")
@@ -280,24 +1025,376 @@ def submit():
         flash(f'Success! Emotion detected: {emotion} (Confidence: {confidence:.2%})', 'success')
         flash(f'{message}', 'info')
         
-        return render_template('index.html', 
-                             emotion=emotion, 
-                             message=message, 
-                             confidence=f"{confidence:.2%}",
-                             name=name)
+        with STAGE_LATENCY.time(stage='template_render'), request_profiler.span('template_render'):
+            return render_template('index.html', 
+                                 emotion=emotion, 
+                                 message=message, 
+                                 confidence=f"{confidence:.2%}",
+                                 faces=result['faces'] if len(result['faces']) > 1 else None,
+                                 name=name)
         
     except Exception as e:
         import traceback
+        ERRORS.inc(type=type(e).__name__)
         error_trace = traceback.format_exc()
         print(f"Error in submit: {str(e)}")  # Debug log
         print(f"Traceback: {error_trace}")  # Debug log
         flash(f'An error occurred: {str(e)}', 'error')
         return redirect(url_for('index'))
 
+# Raw request bodies accepted by the batch API, mapped to the archive type they carry
+ARCHIVE_MIMETYPES = {
+    'application/zip': 'upload.zip',
+    'application/x-zip-compressed': 'upload.zip',
+    'application/x-tar': 'upload.tar',
+    'application/gzip': 'upload.tar',
+    'application/x-gzip': 'upload.tar',
+    'application/x-gtar': 'upload.tar'
+}
+
+@app.route('/api/v1/predict', methods=['POST'])
+@admission_controlled
+def api_predict():
+    """
+    Batch prediction API.
+    Accepts images as multipart file parts (any field name) and/or zip/tar
+    archives, sent as parts or as the raw request body. Images are run
+    through the model in batches and one JSON object per image is streamed
+    back as newline-delimited JSON, followed by a summary line.
+    """
+    if models.active is None:
+        return {'error': 'Model not loaded. Please train the model first.'}, 503
+    
+    # Parts are read up front (bounded by MAX_CONTENT_LENGTH): Werkzeug closes the
+    # uploaded files when the view returns, before the streamed body is produced
+    sources = [(f.filename, io.BytesIO(f.read())) for _, f in request.files.items(multi=True) if f.filename]
+    if not sources and request.mimetype in ARCHIVE_MIMETYPES:
+        sources = [(ARCHIVE_MIMETYPES[request.mimetype], io.BytesIO(request.get_data()))]
+    if not sources:
+        return {'error': 'No images found. Send multipart file parts or a zip/tar archive.'}, 400
+    
+    max_images = app.config['API_MAX_IMAGES']
+    if sum(1 for name, _ in sources if not is_archive(name)) > max_images:
+        return {'error': f'Too many images; the limit is {max_images} per request.'}, 400
+    
+    def iter_images():
+        count = 0
+        for name, stream in sources:
+            if is_archive(name):
+                members = iter_archive_images(
+                    stream, name,
+                    max_images=max_images - count,
+                    max_image_bytes=app.config['MAX_CONTENT_LENGTH'],
+                    max_total_bytes=app.config['API_MAX_ARCHIVE_BYTES']
+                )
+            else:
+                members = [(name, stream.read())]
+            for member in members:
+                count += 1
+                if count > max_images:
+                    raise ArchiveLimitError(f'Too many images; the limit is {max_images} per request.')
+                yield member
+    
+    def process(batch, first_index):
+        outcomes = analyze_images([data for _, data in batch], deadline=g.get('deadline'))
+        for offset, ((name, _), (result, error)) in enumerate(zip(batch, outcomes)):
+            line = {'index': first_index + offset, 'filename': name}
+            if result is None:
+                line['error'] = error
+            else:
+                line.update(result)
+            yield json.dumps(line) + '\n'
+    
+    def generate():
+        started = time.perf_counter()
+        processed = 0
+        batch = []
+        limit_error = None
+        try:
+            for item in iter_images():
+                batch.append(item)
+                if len(batch) >= app.config['API_BATCH_SIZE']:
+                    yield from process(batch, processed)
+                    processed += len(batch)
+                    batch = []
+        except ArchiveError as e:
+            # Stop reading, but still report the images already collected
+            limit_error = str(e)
+        if batch:
+            yield from process(batch, processed)
+            processed += len(batch)
+        
+        summary = {'images': processed, 'elapsed_ms': (time.perf_counter() - started) * 1000.0}
+        if limit_error:
+            summary['error'] = limit_error
+        yield json.dumps({'summary': summary}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# The only forms accepted for analytics start/end; they are compared as strings with the rollup's hour keys
+ANALYTICS_TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M')
+
+def valid_analytics_time(value):
+    """True for a zero-padded time in one of ANALYTICS_TIME_FORMATS (no offset)"""
+    for time_format in ANALYTICS_TIME_FORMATS:
+        try:
+            # strptime also takes unpadded fields such as 2024-5-1; require the canonical form
+            if datetime.strptime(value, time_format).strftime(time_format) == value:
+                return True
+        except ValueError:
+            continue
+    return False
+
+@app.route('/api/v1/analytics/emotions')
+def api_emotion_analytics():
+    """
+    Emotion counts over time from the pre-aggregated rollup.
+    Query parameters: start and end (UTC, 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM',
+    end exclusive, hour resolution), granularity (hour, day, week, month or
+    total; default day) and emotion (repeatable filter).
+    """
+    start = request.args.get('start')
+    end = request.args.get('end')
+    granularity = request.args.get('granularity', 'day')
+    emotions = request.args.getlist('emotion')
+    if granularity not in GRANULARITIES:
+        return {'error': f"granularity must be one of: {', '.join(GRANULARITIES)}"}, 400
+    for value in (start, end):
+        if value and not valid_analytics_time(value):
+            return {'error': f"'{value}' is not a UTC time as 'YYYY-MM-DD' or 'YYYY-MM-DDTHH:MM'."}, 400
+    
+    rows = storage.emotion_counts(start=start, end=end, granularity=granularity, emotions=emotions)
+    series = {}
+    totals = {}
+    for row in rows:
+        period = series.setdefault(row['period'], {'period': row['period'], 'total': 0, 'emotions': {}})
+        period['total'] += row['count']
+        period['emotions'][row['emotion']] = {
+            'count': row['count'],
+            'mean_confidence': row['mean_confidence'],
+            'confidence_buckets': row['confidence_buckets']
+        }
+        totals[row['emotion']] = totals.get(row['emotion'], 0) + row['count']
+    
+    return {
+        'start': start,
+        'end': end,
+        'granularity': granularity,
+        'series': list(series.values()),
+        'totals': totals,
+        'total': sum(totals.values())
+    }, 200
+
+@app.route('/api/v1/video', methods=['POST'])
+@admission_controlled
+def api_video():
+    """
+    Per-second emotion timeline for an uploaded video ('video' file part).
+    Streams newline-delimited JSON: progress events, one line per second of
+    video and a final summary. Optional form fields: sample_fps, ema_alpha.
+    """
+    if models.active is None:
+        return {'error': 'Model not loaded. Please train the model first.'}, 503
+    
+    file = request.files.get('video')
+    if file is None or file.filename == '':
+        return {'error': "Send the video as a multipart file part named 'video'."}, 400
+    
+    try:
+        sample_fps = float(request.form.get('sample_fps', app.config['VIDEO_SAMPLE_FPS']))
+        ema_alpha = float(request.form.get('ema_alpha', app.config['VIDEO_EMA_ALPHA']))
+    except ValueError:
+        return {'error': 'sample_fps and ema_alpha must be numbers.'}, 400
+    if not (math.isfinite(sample_fps) and sample_fps > 0):
+        return {'error': 'sample_fps must be a positive number.'}, 400
+    if not 0.0 <= ema_alpha <= 1.0:
+        return {'error': 'ema_alpha must be between 0 and 1.'}, 400
+    
+    # cv2.VideoCapture needs a path; the upload is copied to a temporary file
+    suffix = os.path.splitext(file.filename)[1].lower() or '.mp4'
+    handle, video_path = tempfile.mkstemp(suffix=suffix)
+    with os.fdopen(handle, 'wb') as f:
+        file.save(f)
+    
+    def generate():
+        # The whole video is classified by the version that was active when it started
+        serving = models.acquire()
+        deadline = time.monotonic() + app.config['VIDEO_MAX_PROCESSING_S']
+        try:
+            if serving is None:
+                raise ValueError('Model not loaded. Please train the model first.')
+            for event in iter_video_timeline(
+                video_path, functools.partial(serving.predict, deadline=deadline),
+                sample_fps=sample_fps,
+                batch_size=app.config['API_BATCH_SIZE'],
+                ema_alpha=ema_alpha,
+                face_detector=face_detector,
+                max_seconds=app.config['VIDEO_MAX_SECONDS'] or None
+            ):
+                if event['type'] == 'summary':
+                    event['model_version'] = serving.version
+                yield json.dumps(event) + '\n'
+                if time.monotonic() >= deadline:
+                    raise DeadlineExceeded('Video processing time limit exceeded')
+        except Exception as e:
+            # The response has started streaming: report the failure as the last event
+            print(f"Video analysis failed: {e!r}")
+            yield json.dumps({'type': 'error', 'error': str(e) or type(e).__name__}) + '\n'
+        finally:
+            if serving is not None:
+                serving.release()
+    
+    response = Response(generate(), mimetype='application/x-ndjson')
+    # Runs even if the client disconnects before the generator starts
+    response.call_on_close(functools.partial(remove_file, video_path))
+    return response
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def admin_authorized():
+    """True if the request carries ADMIN_TOKEN (as a bearer token or X-Admin-Token)"""
+    token = app.config['ADMIN_TOKEN']
+    if not token:
+        return False
+    given = request.headers.get('X-Admin-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        given = authorization[len('Bearer '):]
+    return hmac.compare_digest(given.encode(), token.encode())
+
+def admin_required(view):
+    """Require ADMIN_TOKEN as a bearer token (or X-Admin-Token); 404 when it is not set"""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not app.config['ADMIN_TOKEN']:
+            return {'error': 'Not found'}, 404
+        if not admin_authorized():
+            return {'error': 'Invalid admin token.'}, 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def models_response(status):
+    return {
+        'versions': model_registry.versions(),
+        'registry': model_registry.state(),
+        'serving': models.status()
+    }, status
+
+@app.route('/admin/models')
+@admin_required
+def admin_models():
+    """Registered model versions, the registry state and what this worker serves"""
+    return models_response(200)
+
+@app.route('/admin/models/<action>', methods=['POST'])
+@admin_required
+def admin_model_action(action):
+    """
+    Change the served model: activate ({"version": "v3"}), rollback, or
+    shadow ({"version": "v4"}, or null to stop). The change is saved in the
+    registry; this worker loads it right away (with {"wait": true}, before
+    responding) and the other workers on their next registry poll.
+    """
+    body = request.get_json(silent=True) or {}
+    try:
+        if action == 'activate':
+            model_registry.activate(body.get('version'))
+        elif action == 'rollback':
+            model_registry.rollback()
+        elif action == 'shadow':
+            model_registry.set_shadow(body.get('version') or None)
+        else:
+            return {'error': f"Unknown action '{action}'."}, 404
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    if body.get('wait'):
+        models.sync()
+        return models_response(200)
+    models.sync_in_background()
+    return models_response(202)
+
+@app.route('/admin/submissions/<int:submission_id>/similar')
+@admin_required
+def admin_similar_submissions(submission_id):
+    """
+    The k (?k=, default 10) past submissions most similar to this one by
+    cosine similarity of their embeddings, from the model version that
+    classified it. For auditing mispredictions and finding near-duplicates.
+    """
+    k = request.args.get('k', default=10, type=int)
+    if not 1 <= k <= 1000:
+        return {'error': 'k must be between 1 and 1000.'}, 400
+    submission = storage.get_submission(submission_id)
+    if submission is None:
+        return {'error': f'Submission {submission_id} not found.'}, 404
+    store = embedding_stores.get(submission['model_version']) if submission['model_version'] else None
+    query = store.vector(submission['image_hash']) if store is not None and submission['image_hash'] else None
+    if query is None:
+        return {'error': f'No embedding stored for submission {submission_id}.'}, 404
+    
+    started = time.perf_counter()
+    neighbors = store.search(query, k=k, exclude_hash=submission['image_hash'],
+                             nprobe=app.config['EMBEDDING_NPROBE'])
+    search_ms = (time.perf_counter() - started) * 1000.0
+    latest = storage.submissions_by_hash([image_hash for image_hash, _ in neighbors])
+    return {
+        'submission': submission,
+        'model_version': submission['model_version'],
+        'store': store.stats(),
+        'search_ms': search_ms,
+        'neighbors': [
+            {'image_hash': image_hash, 'similarity': similarity, 'submission': latest.get(image_hash)}
+            for image_hash, similarity in neighbors
+        ]
+    }, 200
+
+@app.route('/admin/profiles')
+@admin_required
+def admin_profiles():
+    """Stored request traces, newest first (?limit=, default 50), with per-stage totals"""
+    limit = request.args.get('limit', default=50, type=int)
+    if limit < 1:
+        return {'error': 'limit must be at least 1.'}, 400
+    return {
+        'directory': os.path.abspath(profile_store.directory),
+        'max_traces': profile_store.max_traces,
+        'sample_rate': app.config['PROFILE_SAMPLE_RATE'],
+        'profiles': profile_store.list(limit)
+    }, 200
+
+@app.route('/admin/profiles/<profile_id>')
+@admin_required
+def admin_profile(profile_id):
+    """One trace: its spans and cProfile hot spots"""
+    trace = profile_store.load(profile_id)
+    if trace is None:
+        return {'error': f"Profile '{profile_id}' not found."}, 404
+    if request_profiler.TF_TRACE_DIR in trace['files']:
+        # Open with: tensorboard --logdir <tensorflow_logdir> (needs the profile plugin)
+        trace['tensorflow_logdir'] = os.path.abspath(profile_store.path(profile_id, request_profiler.TF_TRACE_DIR))
+    return trace, 200
+
+@app.route('/admin/profiles/<profile_id>/profile.prof')
+@admin_required
+def admin_profile_cprofile(profile_id):
+    """The trace's cProfile dump, for pstats or snakeviz"""
+    path = profile_store.path(profile_id, request_profiler.CPROFILE_FILE)
+    if path is None or not os.path.exists(path):
+        return {'error': f"No cProfile dump for profile '{profile_id}'."}, 404
+    return send_file(os.path.abspath(path), mimetype='application/octet-stream', as_attachment=True,
+                     download_name=f'{profile_id}.prof')
+
 # Initialize database and uploads directory on app startup
 # This runs when the module is imported (works with gunicorn)
 init_database()
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
+# Not in an inference pool process, which re-imports the main script while it starts
+if not app.config['PREFORK'] and multiprocessing.current_process().name == 'MainProcess':
+    warm_up()
+if app.config['SAVE_UPLOADS'] and not os.path.exists(app.config['UPLOAD_FOLDER']):
     os.makedirs(app.config['UPLOAD_FOLDER'])
     print(f"Created uploads directory: {app.config['UPLOAD_FOLDER']}")
 
@@ -0,0 +1,367 @@
+"""
+Offline benchmark suite for inference, ingest and training data loading.
+Everything runs against synthetic images, a generated FER2013-format CSV and
+throwaway databases in a temporary directory, so results are reproducible
+on any machine. Results are written as JSON; --compare checks them against a
+stored baseline and exits non-zero when a metric regressed.
+
+Usage:
+    python benchmark.py --output baseline.json
+    python benchmark.py --output current.json --compare baseline.json --threshold 0.10
+
+Without a trained model file the Keras backend benchmarks a freshly
+initialized create_model() network (same architecture, same cost).
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+SECTIONS = ('single_image', 'batched', 'submit', 'upload', 'db_insert', 'dataset_parse')
+
+
+def percentiles(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    return {
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p90_ms': float(np.percentile(samples, 90)),
+        'p99_ms': float(np.percentile(samples, 99)),
+        'samples': int(samples.size)
+    }
+
+
+def synthetic_images(count, size, seed):
+    """Encoded JPEGs of low-frequency noise with a bright ellipse, roughly photo-like for decode and detection"""
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(count):
+        noise = rng.integers(0, 256, (max(2, size // 16), max(2, size // 16)), dtype=np.uint8)
+        img = cv2.resize(noise, (size, size), interpolation=cv2.INTER_CUBIC)
+        center = (int(rng.integers(size // 3, 2 * size // 3)), int(rng.integers(size // 3, 2 * size // 3)))
+        cv2.ellipse(img, center, (size // 6, size // 5), 0, 0, 360, 200, -1)
+        images.append(cv2.imencode('.jpg', img)[1].tobytes())
+    return images
+
+
+def write_fer_csv(path, rows, seed):
+    """Write a FER2013-format CSV (emotion, pixels, Usage) with random pixels"""
+    rng = np.random.default_rng(seed)
+    usages = rng.choice(['Training', 'PublicTest', 'PrivateTest'], size=rows, p=[0.8, 0.1, 0.1])
+    with open(path, 'w') as f:
+        f.write('emotion,pixels,Usage\n')
+        for usage in usages:
+            pixels = ' '.join(map(str, rng.integers(0, 256, 48 * 48)))
+            f.write(f"{int(rng.integers(0, 7))},{pixels},{usage}\n")
+
+
+def prepare_model(args, workdir):
+    """Return (model_path, description), creating an untrained Keras model when no file exists"""
+    from inference_backends import DEFAULT_MODEL_PATHS
+    model_path = args.model or DEFAULT_MODEL_PATHS.get(args.backend)
+    description = model_path
+    if not model_path or not os.path.exists(model_path):
+        if args.backend != 'keras':
+            raise SystemExit(f"Model file '{model_path}' not found; run export_model.py first")
+        model_path = os.path.join(workdir, 'untrained_model.h5')
+        # Built in a child process so TensorFlow here is first initialized by the app,
+        # with the same thread settings as in production
+        script = ('import sys; from tensorflow import keras; from model_training import create_model; '
+                  'keras.utils.set_random_seed(int(sys.argv[2])); create_model().save(sys.argv[1])')
+        subprocess.run([sys.executable, '-c', script, model_path, str(args.seed)],
+                       cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        description = 'untrained create_model()'
+    return model_path, description
+
+
+def bench_single_image(app_module, images, warmup):
+    """Latency of analyze_image (the path behind detect_emotion), with a per-stage breakdown"""
+    for image_bytes in images[:warmup]:
+        app_module.analyze_image(image_bytes)
+    timings = []
+    stages = {}
+    for image_bytes in images[warmup:]:
+        started = time.perf_counter()
+        result, error = app_module.analyze_image(image_bytes)
+        timings.append((time.perf_counter() - started) * 1000.0)
+        if result is None:
+            raise RuntimeError(f'analyze_image failed during the benchmark: {error}')
+        for stage, value in result['timings'].items():
+            stages.setdefault(stage, []).append(value)
+    results = percentiles(timings)
+    for stage, values in stages.items():
+        results[f'mean_{stage}'] = float(np.mean(values))
+    return results
+
+
+def bench_batched(app_module, batch_sizes, repeats, seed):
+    rng = np.random.default_rng(seed)
+    results = {}
+    for batch_size in batch_sizes:
+        batch = rng.integers(0, 256, (batch_size, 48, 48, 1), dtype=np.uint8)
+        model = app_module.models.active.model
+        model.predict(batch)  # Warm-up / graph build for this shape
+        started = time.perf_counter()
+        for _ in range(repeats):
+            model.predict(batch)
+        elapsed = time.perf_counter() - started
+        results[f'batch_{batch_size}_images_per_s'] = batch_size * repeats / elapsed
+        results[f'batch_{batch_size}_ms'] = elapsed * 1000.0 / repeats
+    return results
+
+
+def bench_submit(app_module, images, warmup):
+    client = app_module.app.test_client()
+
+    def post(image_bytes):
+        response = client.post('/submit', data={'name': 'benchmark', 'image': (io.BytesIO(image_bytes), 'face.jpg')},
+                               content_type='multipart/form-data')
+        if response.status_code != 200:
+            raise RuntimeError(f'/submit returned {response.status_code}')
+
+    for image_bytes in images[:warmup]:
+        post(image_bytes)
+    timings = []
+    for image_bytes in images[warmup:]:
+        started = time.perf_counter()
+        post(image_bytes)
+        timings.append((time.perf_counter() - started) * 1000.0)
+    app_module.storage.flush()
+    return percentiles(timings)
+
+
+def client_downscale(image_bytes, max_side, quality=90):
+    """What the upload form does in the browser (canvas resize, JPEG at quality 0.9), done with OpenCV"""
+    img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    height, width = img.shape[:2]
+    scale = max_side / float(max(height, width))
+    if scale >= 1.0:
+        return image_bytes
+    img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    return cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def bench_upload(app_module, images, warmup, upload_mbps):
+    """
+    Full-size photos as sent without scripting vs. the upload form's downscaled
+    copies: upload bytes, server decode time and end-to-end latency (client
+    resize + transfer at upload_mbps + /submit)
+    """
+    client = app_module.app.test_client()
+    max_side = app_module.app.config['UPLOAD_MAX_SIDE']
+    results = {}
+    for payload in ('full', 'compact'):
+        sizes, client_ms, decode_ms, submit_ms, e2e_ms = [], [], [], [], []
+        for index, original in enumerate(images):
+            started = time.perf_counter()
+            image_bytes = client_downscale(original, max_side) if payload == 'compact' else original
+            prepared = time.perf_counter()
+            result, error = app_module.analyze_image(image_bytes)
+            if result is None:
+                raise RuntimeError(f'analyze_image failed during the benchmark: {error}')
+            posted = time.perf_counter()
+            response = client.post('/submit', data={'name': 'benchmark', 'image': (io.BytesIO(image_bytes), 'photo.jpg')},
+                                   content_type='multipart/form-data')
+            if response.status_code != 200:
+                raise RuntimeError(f'/submit returned {response.status_code}')
+            finished = time.perf_counter()
+            if index < warmup:
+                continue
+            transfer_ms = len(image_bytes) * 8 / (upload_mbps * 1e6) * 1000.0
+            sizes.append(len(image_bytes))
+            client_ms.append((prepared - started) * 1000.0)
+            decode_ms.append(result['timings']['decode_ms'])
+            submit_ms.append((finished - posted) * 1000.0)
+            e2e_ms.append(client_ms[-1] + transfer_ms + submit_ms[-1])
+        results.update({
+            f'{payload}_upload_bytes': float(np.mean(sizes)),
+            f'{payload}_client_resize_ms': float(np.mean(client_ms)),
+            f'{payload}_decode_ms': float(np.mean(decode_ms)),
+            f'{payload}_submit_ms': float(np.mean(submit_ms)),
+            f'{payload}_e2e_p50_ms': float(np.percentile(e2e_ms, 50)),
+            f'{payload}_e2e_p90_ms': float(np.percentile(e2e_ms, 90)),
+        })
+    app_module.storage.flush()
+    results['upload_mbps'] = upload_mbps
+    return results
+
+
+def bench_db_insert(workdir, rows, seed):
+    from storage import Storage
+    rng = np.random.default_rng(seed)
+    blobs = [rng.integers(0, 256, 16 * 1024, dtype=np.uint8).tobytes() for _ in range(rows)]
+    storage = Storage(os.path.join(workdir, 'insert_bench.db'))
+    storage.init_schema()
+    started = time.perf_counter()
+    for index, blob in enumerate(blobs):
+        storage.insert_submission(f'user{index}', 'Happy', None, blob, confidence=0.5)
+    storage.flush()
+    elapsed = time.perf_counter() - started
+    stats = storage.stats()
+    storage.close()
+    return {
+        'rows': rows,
+        'rows_per_s': rows / elapsed,
+        'total_ms': elapsed * 1000.0,
+        'transactions': stats['transactions']
+    }
+
+
+def bench_dataset_parse(workdir, rows, seed):
+    import pandas as pd
+    from model_training import parse_pixels, build_dataset_cache, load_fer2013_cached
+    csv_path = os.path.join(workdir, 'fer2013_bench.csv')
+    cache_dir = os.path.join(workdir, 'fer2013_bench_cache')
+    write_fer_csv(csv_path, rows, seed)
+
+    started = time.perf_counter()
+    parse_pixels(pd.read_csv(csv_path)['pixels'])
+    parsed = time.perf_counter()
+    build_dataset_cache(csv_path, cache_dir)
+    built = time.perf_counter()
+    data = load_fer2013_cached(csv_path, cache_dir)
+    sum(int(X[-1].sum()) for X, _ in data.values())  # Touch the memory-mapped pages
+    loaded = time.perf_counter()
+    return {
+        'rows': rows,
+        'csv_parse_ms': (parsed - started) * 1000.0,
+        'build_cache_ms': (built - parsed) * 1000.0,
+        'load_cached_ms': (loaded - built) * 1000.0
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='emotion_bench_')
+    try:
+        model_path, model_description = prepare_model(args, workdir)
+        # The app reads its configuration at import time
+        os.environ.update({
+            'MODEL_BACKEND': args.backend,
+            'MODEL_PATH': model_path,
+            'MODEL_REGISTRY_DIR': os.path.join(workdir, 'models'),  # Empty: serve MODEL_PATH
+            'DATABASE_PATH': os.path.join(workdir, 'app_bench.db'),
+            'PREDICTION_CACHE_SIZE': '0',
+            'PREDICTION_CACHE_PERSIST': '0',
+            'SAVE_UPLOADS': '0'
+        })
+        import app as app_module
+        if app_module.models.active is None:
+            raise SystemExit('Model failed to load; see the output above')
+
+        images = synthetic_images(args.iterations + args.warmup, args.image_size, args.seed)
+        results = {}
+        for section in args.sections:
+            print(f"Running {section}...")
+            if section == 'single_image':
+                results[section] = bench_single_image(app_module, images, args.warmup)
+            elif section == 'batched':
+                results[section] = bench_batched(app_module, args.batch_sizes, args.batch_repeats, args.seed)
+            elif section == 'submit':
+                results[section] = bench_submit(app_module, images, args.warmup)
+            elif section == 'upload':
+                photos = synthetic_images(args.upload_iterations + args.warmup, args.upload_size, args.seed)
+                results[section] = bench_upload(app_module, photos, args.warmup, args.upload_mbps)
+            elif section == 'db_insert':
+                results[section] = bench_db_insert(workdir, args.db_rows, args.seed)
+            elif section == 'dataset_parse':
+                results[section] = bench_dataset_parse(workdir, args.csv_rows, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'backend': args.backend,
+            'model': model_description,
+            'seed': args.seed,
+            'image_size': args.image_size,
+            'iterations': args.iterations
+        },
+        'results': results
+    }
+
+
+def metric_direction(name):
+    """+1 if higher is better, -1 if lower is better, 0 if not compared"""
+    if name.endswith('_per_s'):
+        return 1
+    if name.endswith('_ms') or name.endswith('_bytes'):
+        return -1
+    return 0
+
+
+def compare(current, baseline, threshold):
+    """Print current vs baseline per metric and return the list of regressions"""
+    regressions = []
+    print("=" * 78)
+    print(f"{'Metric':<40}{'Baseline':>12}{'Current':>12}{'Change':>10}")
+    print("=" * 78)
+    for section, metrics in current['results'].items():
+        for name, value in metrics.items():
+            direction = metric_direction(name)
+            old = baseline.get('results', {}).get(section, {}).get(name)
+            if not direction or old is None or old == 0:
+                continue
+            change = (value - old) / old
+            regressed = direction * change < -threshold
+            flag = '  REGRESSION' if regressed else ''
+            print(f"{section + '.' + name:<40}{old:>12.2f}{value:>12.2f}{change:>+10.1%}{flag}")
+            if regressed:
+                regressions.append(f'{section}.{name}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark inference, ingest and dataset loading')
+    parser.add_argument('--output', default='benchmark_results.json', help='Where to write the results JSON')
+    parser.add_argument('--compare', default=None, help='Baseline results JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative change counted as a regression (default 0.10 = 10%%)')
+    parser.add_argument('--sections', nargs='+', choices=SECTIONS, default=list(SECTIONS))
+    parser.add_argument('--backend', default='keras', help='Inference backend (see inference_backends.py)')
+    parser.add_argument('--model', default=None, help='Model file (defaults to the backend artifact)')
+    parser.add_argument('--iterations', type=int, default=100, help='Timed images for latency benchmarks')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--image-size', type=int, default=480, help='Side of the synthetic square images')
+    parser.add_argument('--upload-size', type=int, default=3000, help='Side of the synthetic photos for upload')
+    parser.add_argument('--upload-iterations', type=int, default=20, help='Timed photos per upload path')
+    parser.add_argument('--upload-mbps', type=float, default=10.0, help='Client upload bandwidth for upload')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 64])
+    parser.add_argument('--batch-repeats', type=int, default=20)
+    parser.add_argument('--db-rows', type=int, default=2000)
+    parser.add_argument('--csv-rows', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+    print(json.dumps(report['results'], indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed by more than {args.threshold:.0%}: "
+                  f"{', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""
+Offline bulk scoring of large image collections.
+Reads images from directories, zip/tar archives or the users table of the
+app database as a stream, decodes and localizes faces in a thread pool
+(same preprocessing as the web app), classifies them in large batches and
+writes one row per image with the full 7-class probability vector to CSV
+or Parquet. Progress is checkpointed, so an interrupted run resumes where
+it stopped when started again with the same arguments.
+
+Usage:
+    python bulk_score.py photos/ archive.tar.gz --output scores.csv
+    python bulk_score.py --database database.db --output rescored.parquet --backend tflite
+"""
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from face_detection import FaceDetector, DEFAULT_CASCADE
+from image_sources import iter_archive_images, iter_directory_images, is_archive, is_image_name
+from preprocessing import EMOTION_LABELS, decode_image, prepare_face
+
+COLUMNS = (
+    ['source', 'emotion', 'confidence', 'face_detected', 'box_x', 'box_y', 'box_w', 'box_h']
+    + [f'prob_{EMOTION_LABELS[i].lower()}' for i in range(len(EMOTION_LABELS))]
+    + ['error']
+)
+
+CHECKPOINT_VERSION = 1
+
+
+def iter_inputs(paths, database=None, skip=0):
+    """
+    Yield (source, data) for every input image in a stable order, after the
+    first `skip`. data is either the encoded bytes or a file path that the
+    decode pool reads, so skipped directory entries are never opened (skipped
+    archive members are still decompressed; database rows are skipped in SQL).
+    """
+    seen = 0
+    for path in paths:
+        if os.path.isdir(path):
+            members = ((image_path, image_path) for image_path in iter_directory_images(path))
+        elif is_archive(path):
+            members = _iter_archive(path)
+        elif is_image_name(path):
+            members = [(path, path)]
+        else:
+            raise ValueError(f"'{path}' is not a directory, archive or image file")
+        for source, data in members:
+            seen += 1
+            if seen > skip:
+                yield source, data
+    if database:
+        yield from iter_database_images(database, offset=max(0, skip - seen))
+
+
+def _iter_archive(path):
+    # Bulk runs are trusted input: no per-archive count or size limits
+    with open(path, 'rb') as f:
+        for name, data in iter_archive_images(f, path, max_images=float('inf'), max_total_bytes=float('inf')):
+            yield f'{path}:{name}', data
+
+
+def iter_database_images(db_path, offset=0):
+    """Yield ('users:<id>', image) for every submission, oldest first"""
+    conn = sqlite3.connect(db_path)
+    try:
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+        image = 'COALESCE(b.data, u.image_blob)' if 'image_sha256' in columns else 'u.image_blob'
+        join = 'LEFT JOIN blobs b ON b.sha256 = u.image_sha256' if 'image_sha256' in columns else ''
+        cursor = conn.execute(
+            f'SELECT u.id, {image}, u.image_path FROM users u {join} ORDER BY u.id LIMIT -1 OFFSET ?',
+            (offset,)
+        )
+        for row_id, data, image_path in cursor:
+            yield f'users:{row_id}', bytes(data) if data is not None else image_path
+    finally:
+        conn.close()
+
+
+class _Prepared:
+    __slots__ = ('crop', 'box', 'face_detected', 'error')
+
+    def __init__(self, crop=None, box=None, face_detected=False, error=None):
+        self.crop = crop
+        self.box = box
+        self.face_detected = face_detected
+        self.error = error
+
+
+def prepare(data, face_detector):
+    """Read (if needed), decode and crop the largest face, as the web app does"""
+    try:
+        if data is None:
+            return _Prepared(error='No image stored')
+        if isinstance(data, str):
+            with open(data, 'rb') as f:
+                data = f.read()
+        gray = decode_image(data)
+        if gray is None:
+            return _Prepared(error='Could not decode image')
+        boxes = face_detector.detect(gray) if face_detector is not None else []
+        box = boxes[0] if boxes else (0, 0, gray.shape[1], gray.shape[0])
+        x, y, w, h = box
+        return _Prepared(prepare_face(gray[y:y + h, x:x + w]), box, bool(boxes))
+    except Exception as e:
+        return _Prepared(error=f'{type(e).__name__}: {e}')
+
+
+def score(items, predict_fn, face_detector=None, batch_size=256, decode_workers=4, prefetch=2):
+    """
+    Yield a list of result rows (dicts with COLUMNS) per batch of items.
+    Decoding of the next `prefetch` batches overlaps with inference.
+    """
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=decode_workers, thread_name_prefix='bulk-decode') as pool:
+        pending = deque()
+
+        def submit_next():
+            chunk = list(islice(items, batch_size))
+            if chunk:
+                pending.append([(source, pool.submit(prepare, data, face_detector)) for source, data in chunk])
+
+        for _ in range(prefetch + 1):
+            submit_next()
+        while pending:
+            chunk = pending.popleft()
+            submit_next()
+            prepared = [(source, future.result()) for source, future in chunk]
+            crops = [p.crop for _, p in prepared if p.crop is not None]
+            outputs = iter(predict_fn(np.stack(crops)) if crops else [])
+
+            rows = []
+            for source, p in prepared:
+                row = dict.fromkeys(COLUMNS)
+                row['source'] = source
+                if p.crop is None:
+                    row['error'] = p.error
+                else:
+                    probabilities = next(outputs)
+                    idx = int(np.argmax(probabilities))
+                    row.update({
+                        'emotion': EMOTION_LABELS[idx],
+                        'confidence': float(probabilities[idx]),
+                        'face_detected': p.face_detected,
+                        'box_x': int(p.box[0]), 'box_y': int(p.box[1]),
+                        'box_w': int(p.box[2]), 'box_h': int(p.box[3])
+                    })
+                    for i, value in enumerate(probabilities):
+                        row[f'prob_{EMOTION_LABELS[i].lower()}'] = float(value)
+                rows.append(row)
+            yield rows
+
+
+class CsvOutput:
+    """Appends to one CSV file; a checkpoint records its committed length"""
+
+    def __init__(self, path, state=None):
+        self.path = path
+        if state is not None:
+            # Drop rows written after the last checkpoint
+            os.truncate(path, state['bytes'])
+            self.file = open(path, 'a', newline='')
+        else:
+            self.file = open(path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=COLUMNS)
+        if state is None:
+            self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def commit(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return {'bytes': self.file.tell()}
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetOutput:
+    """Writes a directory of part files, one per checkpoint"""
+
+    def __init__(self, path, state=None):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow. Install 'pyarrow' or write a .csv file.")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.path = path
+        self.parts = state['parts'] if state is not None else 0
+        os.makedirs(path, exist_ok=True)
+        for name in os.listdir(path):
+            # Remove parts written after the last checkpoint
+            if name.startswith('part-') and int(name[5:10]) >= self.parts:
+                os.remove(os.path.join(path, name))
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+
+    def commit(self):
+        if self.rows:
+            columns = {name: [row[name] for row in self.rows] for name in COLUMNS}
+            table = self._pa.table(columns)
+            self._pq.write_table(table, os.path.join(self.path, f'part-{self.parts:05d}.parquet'))
+            self.parts += 1
+            self.rows = []
+        return {'parts': self.parts}
+
+    def close(self):
+        pass
+
+
+def _write_json_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score image directories, archives or the users table in bulk')
+    parser.add_argument('inputs', nargs='*', help='Image directories, zip/tar archives or image files')
+    parser.add_argument('--database', default=None, help='Also score every row of this app database')
+    parser.add_argument('--output', required=True, help='.csv file, or .parquet directory of part files')
+    parser.add_argument('--backend', default='keras', help='Inference backend (see inference_backends.py)')
+    parser.add_argument('--model', default=None, help='Model file (defaults to the backend artifact)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='Model threads')
+    parser.add_argument('--decode-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=256)
+    parser.add_argument('--checkpoint-every', type=int, default=20, help='Batches between checkpoints')
+    parser.add_argument('--no-face-detection', action='store_true', help='Classify whole images')
+    parser.add_argument('--restart', action='store_true', help='Ignore an existing checkpoint and start over')
+    args = parser.parse_args()
+
+    if not args.inputs and not args.database:
+        parser.error('give at least one input path or --database')
+
+    checkpoint_path = args.output + '.checkpoint.json'
+    run_config = {
+        'inputs': [os.path.abspath(p) for p in args.inputs],
+        'database': os.path.abspath(args.database) if args.database else None,
+        'backend': args.backend,
+        'model': args.model,
+        'face_detection': not args.no_face_detection
+    }
+    checkpoint = None
+    if os.path.exists(checkpoint_path) and not args.restart:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('version') != CHECKPOINT_VERSION or checkpoint.get('config') != run_config:
+            raise SystemExit(f"{checkpoint_path} belongs to a run with different arguments; "
+                             "use --restart to start over")
+        if checkpoint.get('finished'):
+            print(f"{args.output} is already complete ({checkpoint['position']} images)")
+            return
+        print(f"Resuming after {checkpoint['position']} images")
+    elif os.path.exists(args.output) and not args.restart:
+        raise SystemExit(f"{args.output} already exists; use --restart to overwrite it")
+
+    from inference_backends import load_backend
+    backend = load_backend(args.backend, args.model, num_threads=args.threads)
+    face_detector = None
+    if not args.no_face_detection:
+        try:
+            face_detector = FaceDetector(cascade_path=os.environ.get('FACE_CASCADE_PATH', DEFAULT_CASCADE))
+        except Exception as e:
+            print(f"Face detector unavailable, classifying whole images: {e}")
+
+    output_class = ParquetOutput if args.output.lower().endswith('.parquet') else CsvOutput
+    output = output_class(args.output, checkpoint['output'] if checkpoint else None)
+    position = checkpoint['position'] if checkpoint else 0
+    errors = checkpoint['errors'] if checkpoint else 0
+
+    def save_checkpoint(finished=False):
+        _write_json_atomic(checkpoint_path, {
+            'version': CHECKPOINT_VERSION,
+            'config': run_config,
+            'position': position,
+            'errors': errors,
+            'output': output.commit(),
+            'finished': finished,
+            'updated': time.strftime('%Y-%m-%dT%H:%M:%S')
+        })
+
+    started = time.perf_counter()
+    scored = 0
+    try:
+        items = iter_inputs(args.inputs, args.database, skip=position)
+        for batch_number, rows in enumerate(score(items, backend.predict, face_detector,
+                                                  batch_size=args.batch_size,
+                                                  decode_workers=args.decode_workers), 1):
+            output.write(rows)
+            position += len(rows)
+            scored += len(rows)
+            errors += sum(1 for row in rows if row['error'])
+            if batch_number % args.checkpoint_every == 0:
+                save_checkpoint()
+                elapsed = time.perf_counter() - started
+                print(f"{position} images ({scored / elapsed:.0f}/s, {errors} errors), checkpoint saved")
+        save_checkpoint(finished=True)
+    finally:
+        output.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"Scored {scored} images in {elapsed:.1f}s ({scored / elapsed if elapsed else 0:.0f}/s); "
+          f"{position} total, {errors} errors -> {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,384 @@
+"""
+Embedding store for similarity search over past submissions.
+Each model version gets its own directory (embeddings from different
+versions are not comparable) holding an append-only matrix of unit-length
+embeddings as float16 or int8 (vectors.bin), the SHA-256 of the image each
+row belongs to (hashes.bin) and meta.json. Both files are memory-mapped for
+search, so the matrix never has to fit in memory, and appends from several
+worker processes are serialized with a lock file.
+
+Search is a brute-force cosine similarity (dot product of unit vectors)
+over the whole matrix, in vectorized chunks. For millions of rows, build an
+optional coarse index (IVF: k-means centroids with a list of rows per
+centroid); searches then only score the rows of the nprobe closest lists,
+plus any rows appended after the index was built.
+
+Usage:
+    python embedding_store.py list
+    python embedding_store.py build-index v3 --min-rows 1000000
+"""
+
+import argparse
+import json
+import os
+import re
+import threading
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: appends are not locked between processes
+    fcntl = None
+
+META_FILE = 'meta.json'
+VECTORS_FILE = 'vectors.bin'
+HASHES_FILE = 'hashes.bin'
+INDEX_FILE = 'index.npz'
+DTYPES = ('float16', 'int8')
+# int8 rows hold round(unit_vector * INT8_SCALE)
+INT8_SCALE = 127.0
+# Rows converted to float32 at a time during brute-force search
+SEARCH_CHUNK_ROWS = 16384
+# A SHA-256 digest viewed as four uint64 words, so lookups are vectorized
+_HASH_WORDS = 4
+# float32 value of every float16 bit pattern: a table lookup converts sparse
+# (ReLU) embeddings about twice as fast as astype()
+_FLOAT16_TABLE = np.arange(65536, dtype=np.uint16).view(np.float16).astype(np.float32)
+
+
+def _hash_key(image_hash):
+    return np.frombuffer(bytes.fromhex(image_hash), dtype='<u8')
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _top_k(scores, k):
+    """Indices of the k highest scores, best first"""
+    if k < len(scores):
+        top = np.argpartition(-scores, k)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class EmbeddingStore:
+    """
+    Embeddings of one model version. dim and dtype are fixed by the first
+    append (or read from meta.json); append() and search() are safe to call
+    from several threads and processes.
+    """
+
+    def __init__(self, path, dtype='float16'):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown embedding dtype '{dtype}'. Choose from: {', '.join(DTYPES)}")
+        self.path = path
+        self.dim = None
+        self.dtype = dtype
+        self._lock = threading.RLock()
+        self._maps = None
+        self._index = None
+        self._index_mtime = None
+        # Complete rows seen so far and the last row of each image hash
+        self._count = 0
+        self._rows = {}
+        self._read_meta()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _read_meta(self):
+        """Load meta.json once it exists (it is written by the first append, maybe in another process)"""
+        try:
+            with open(self._file(META_FILE)) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return
+        self.dim = meta['dim']
+        self.dtype = meta['dtype']
+
+    @property
+    def _row_bytes(self):
+        return self.dim * np.dtype(self.dtype).itemsize
+
+    def _refresh(self):
+        """
+        Index rows appended since the last call, by this or another process.
+        Costs one stat() when nothing was appended; otherwise only the new
+        hashes are read.
+        """
+        try:
+            # Vectors are written before hashes: a row is complete once its hash is
+            count = os.path.getsize(self._file(HASHES_FILE)) // (8 * _HASH_WORDS)
+        except FileNotFoundError:
+            return
+        if count <= self._count:
+            return
+        with self._lock:
+            if count <= self._count:
+                return
+            if self.dim is None:
+                self._read_meta()
+            row_bytes = 8 * _HASH_WORDS
+            with open(self._file(HASHES_FILE), 'rb') as f:
+                f.seek(self._count * row_bytes)
+                data = f.read((count - self._count) * row_bytes)
+            for row in range(len(data) // row_bytes):
+                self._rows[data[row * row_bytes:(row + 1) * row_bytes]] = self._count + row
+            self._count += len(data) // row_bytes
+
+    def __len__(self):
+        self._refresh()
+        return self._count
+
+    def _locked(self):
+        """Exclusive lock across processes for appends and index builds"""
+        lock = open(self._file('.lock'), 'a')
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def append(self, image_hashes, vectors):
+        """Add one row per (image hash, embedding); embeddings are normalized to unit length"""
+        vectors = _normalize(np.atleast_2d(vectors))
+        keys = np.stack([_hash_key(image_hash) for image_hash in image_hashes])
+        if len(keys) != len(vectors):
+            raise ValueError('Need one image hash per embedding')
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, self._locked():
+            self._refresh()
+            if self.dim is None:
+                self._read_meta()
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                tmp = self._file(META_FILE + '.tmp')
+                with open(tmp, 'w') as f:
+                    json.dump({'dim': self.dim, 'dtype': self.dtype}, f)
+                os.replace(tmp, self._file(META_FILE))
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f'Embedding has {vectors.shape[1]} dimensions; the store holds {self.dim}')
+            if self.dtype == 'int8':
+                rows = np.round(vectors * INT8_SCALE).astype(np.int8)
+            else:
+                rows = vectors.astype(np.float16)
+
+            # Drop a partially written row left by a crash so the files stay aligned
+            count = self._count
+            for name, row_bytes, data in ((VECTORS_FILE, self._row_bytes, rows), (HASHES_FILE, 8 * _HASH_WORDS, keys)):
+                with open(self._file(name), 'ab') as f:
+                    f.truncate(count * row_bytes)
+                    f.write(np.ascontiguousarray(data).tobytes())
+            for row, key in enumerate(keys):
+                self._rows[key.tobytes()] = count + row
+            self._count = count + len(keys)
+
+    def _arrays(self):
+        """Memory-mapped (vectors, hashes), remapped when rows were appended"""
+        count = len(self)
+        if count == 0:
+            return None, None
+        maps = self._maps
+        if maps is None or len(maps[0]) != count:
+            vectors = np.memmap(self._file(VECTORS_FILE), dtype=self.dtype, mode='r', shape=(count, self.dim))
+            hashes = np.memmap(self._file(HASHES_FILE), dtype='<u8', mode='r', shape=(count, _HASH_WORDS))
+            maps = self._maps = (vectors, hashes)
+        return maps
+
+    def _scores(self, vectors, query):
+        if self.dtype == 'int8':
+            return (vectors.astype(np.float32) @ query) / INT8_SCALE
+        return _FLOAT16_TABLE[vectors.view(np.uint16)] @ query
+
+    def row(self, image_hash):
+        """Row of the most recent embedding stored for an image, or None"""
+        self._refresh()
+        return self._rows.get(bytes.fromhex(image_hash))
+
+    def vector(self, image_hash):
+        """The most recent embedding stored for an image, or None"""
+        row = self.row(image_hash)
+        if row is None:
+            return None
+        vectors, _ = self._arrays()
+        vector = vectors[row].astype(np.float32)
+        return vector / INT8_SCALE if self.dtype == 'int8' else vector
+
+    def search(self, query, k=10, exclude_hash=None, nprobe=8):
+        """
+        The k rows most similar to query by cosine similarity, as a list of
+        (image_hash, similarity), best first. Each image appears once (its
+        best row); exclude_hash leaves out the query image itself. Uses the
+        coarse index when there is one, else scans every row.
+        """
+        vectors, hashes = self._arrays()
+        if vectors is None or k <= 0:
+            return []
+        query = _normalize(query).reshape(-1)
+        if query.shape[0] != self.dim:
+            raise ValueError(f'Query has {query.shape[0]} dimensions; the store holds {self.dim}')
+
+        index = self._load_index()
+        if index is not None and index['rows'] <= len(vectors):
+            candidates = self._candidates(index, query, nprobe, len(vectors))
+            scores = self._scores(vectors[candidates], query)
+        else:
+            candidates = None
+            scores = np.empty(len(vectors), dtype=np.float32)
+            for start in range(0, len(vectors), SEARCH_CHUNK_ROWS):
+                scores[start:start + SEARCH_CHUNK_ROWS] = self._scores(vectors[start:start + SEARCH_CHUNK_ROWS], query)
+
+        # Take extra rows so duplicates of one image (and the excluded one) can be dropped
+        results = []
+        seen = set()
+        want = k + 1 if exclude_hash else k
+        while True:
+            top = _top_k(scores, min(len(scores), want * 2))
+            for position in top:
+                row = candidates[position] if candidates is not None else position
+                image_hash = hashes[row].astype('<u8').tobytes().hex()
+                if image_hash in seen or image_hash == exclude_hash:
+                    continue
+                seen.add(image_hash)
+                results.append((image_hash, float(scores[position])))
+                if len(results) == k:
+                    return results
+            if len(top) == len(scores):
+                return results
+            results, seen, want = [], set(), want * 4
+
+    def _candidates(self, index, query, nprobe, count):
+        """Rows in the nprobe lists closest to query, plus rows added since the index was built"""
+        lists = _top_k(index['centroids'] @ query, min(nprobe, len(index['centroids'])))
+        offsets = index['offsets']
+        parts = [index['order'][offsets[i]:offsets[i + 1]] for i in lists]
+        parts.append(np.arange(index['rows'], count))
+        return np.sort(np.concatenate(parts))
+
+    def _load_index(self):
+        try:
+            mtime = os.path.getmtime(self._file(INDEX_FILE))
+        except FileNotFoundError:
+            self._index = self._index_mtime = None
+            return None
+        if mtime != self._index_mtime:
+            with np.load(self._file(INDEX_FILE)) as data:
+                self._index = {name: data[name] for name in data.files}
+            self._index['rows'] = int(self._index['rows'])
+            self._index_mtime = mtime
+        return self._index
+
+    def build_index(self, nlist=None, iterations=10, sample_size=None, seed=0):
+        """
+        Build the coarse index: spherical k-means with nlist centroids
+        (default 4 * sqrt(rows)) trained on a sample, then every row assigned
+        to its closest centroid. Rows appended later are scanned by search()
+        until the index is rebuilt. Returns the number of lists.
+        """
+        vectors, _ = self._arrays()
+        if vectors is None:
+            raise ValueError('The store is empty')
+        count = len(vectors)
+        nlist = max(1, min(count, int(nlist or 4 * np.sqrt(count))))
+        rng = np.random.default_rng(seed)
+        sample_size = min(count, sample_size or nlist * 64)
+        sample = vectors[np.sort(rng.choice(count, sample_size, replace=False))].astype(np.float32)
+        sample = _normalize(sample)
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            empty = np.bincount(assignment, minlength=nlist) == 0
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()))]  # Reseed empty lists
+            centroids = _normalize(sums)
+
+        assignment = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SEARCH_CHUNK_ROWS):
+            chunk = vectors[start:start + SEARCH_CHUNK_ROWS].astype(np.float32)
+            assignment[start:start + SEARCH_CHUNK_ROWS] = np.argmax(chunk @ centroids.T, axis=1)
+        order = np.argsort(assignment, kind='stable').astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+
+        with self._locked():
+            tmp = self._file('index.tmp.npz')
+            np.savez(tmp, centroids=centroids, order=order, offsets=offsets, rows=np.int64(count))
+            os.replace(tmp, self._file(INDEX_FILE))
+        return nlist
+
+    def stats(self):
+        index = self._load_index()
+        return {
+            'rows': len(self),
+            'dim': self.dim,
+            'dtype': self.dtype,
+            'bytes': len(self) * self._row_bytes if self.dim else 0,
+            'index_lists': len(index['centroids']) if index is not None else None,
+            'index_rows': index['rows'] if index is not None else None,
+        }
+
+
+class EmbeddingStores:
+    """One EmbeddingStore per model version under a root directory"""
+
+    def __init__(self, root, dtype='float16'):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unknown embedding dtype '{dtype}'. Choose from: {', '.join(DTYPES)}")
+        self.root = root
+        self.dtype = dtype
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, version):
+        with self._lock:
+            store = self._stores.get(version)
+            if store is None:
+                # Fallback versions look like face_emotionModel.h5@0123abcd
+                directory = re.sub(r'[^A-Za-z0-9._@-]', '_', version)
+                store = self._stores[version] = EmbeddingStore(os.path.join(self.root, directory), self.dtype)
+            return store
+
+    def versions(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, META_FILE)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect embedding stores and build their coarse indexes')
+    parser.add_argument('--dir', default=os.environ.get('EMBEDDINGS_DIR', 'embeddings'),
+                        help='Embeddings directory (default: EMBEDDINGS_DIR or embeddings/)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('list', help='Show the store of each model version')
+    build = commands.add_parser('build-index', help='Build (or rebuild) the coarse index of a version')
+    build.add_argument('version')
+    build.add_argument('--min-rows', type=int, default=0,
+                       help='Skip stores smaller than this (brute force is fast enough below ~1M rows)')
+    build.add_argument('--lists', type=int, default=None, help='Number of centroids (default 4 * sqrt(rows))')
+    build.add_argument('--iterations', type=int, default=10, help='k-means iterations')
+    args = parser.parse_args()
+
+    stores = EmbeddingStores(args.dir)
+    if args.command == 'build-index':
+        if args.version not in stores.versions():
+            raise SystemExit(f"No embeddings for version '{args.version}' in {args.dir}")
+        store = stores.get(args.version)
+        if len(store) < args.min_rows:
+            print(f"{args.version}: {len(store)} rows, below --min-rows {args.min_rows}; not indexed")
+        else:
+            lists = store.build_index(nlist=args.lists, iterations=args.iterations)
+            print(f"{args.version}: indexed {len(store)} rows into {lists} lists")
+
+    for version in stores.versions():
+        stats = stores.get(version).stats()
+        index = f"{stats['index_lists']} lists over {stats['index_rows']} rows" if stats['index_lists'] else 'none'
+        print(f"{version:<40} {stats['rows']:>10} rows  {stats['dim']}-d {stats['dtype']:<8} "
+              f"{stats['bytes'] / 1024 / 1024:>8.1f} MB  index: {index}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""
+Export the trained Keras model to lightweight inference formats.
+Produces TFLite and/or ONNX artifacts (optionally int8 quantized, calibrated
+on FER2013 training samples) that app.py can serve without TensorFlow, and
+reports the accuracy delta and per-image CPU latency of each backend
+against the Keras baseline.
+
+Usage:
+    python export_model.py --formats tflite onnx --int8 --evaluate
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from inference_backends import DEFAULT_MODEL_PATHS, load_backend, takes_raw_pixels
+from preprocessing import preprocess_batch
+
+
+def load_fer2013_samples(csv_path='fer2013.csv', usage='Training', num_samples=500, seed=42):
+    """
+    Load a random subset of FER2013 rows for one usage split.
+    Returns raw uint8 images of shape (n, 48, 48, 1) and integer labels.
+    """
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError(
+            f"FER2013 CSV file not found at {csv_path}\n"
+            "Please download fer2013.csv from Kaggle and place it in the project root."
+        )
+    df = pd.read_csv(csv_path)
+    df = df[df['Usage'] == usage]
+    if num_samples and len(df) > num_samples:
+        df = df.sample(n=num_samples, random_state=seed)
+
+    pixels = np.array([np.array(p.split(), dtype=np.uint8) for p in df['pixels']])
+    images = pixels.reshape(-1, 48, 48, 1)
+    return images, df['emotion'].values.astype(np.int64)
+
+
+def exportable_model(model):
+    """
+    Return (model, input dtype) to export. Models with built-in preprocessing
+    are exported with a uint8 'pixels' input, so the runtimes take raw pixels;
+    older models keep their float32 input in [0, 1]. The exported input is
+    always 48x48, so the Resizing layer is left out: it would be a no-op, and
+    tf2onnx loses the static shape after it (the ONNX outputs drift).
+    """
+    if not takes_raw_pixels(model):
+        return model, 'float32'
+    from tensorflow import keras
+    pixels = keras.Input((48, 48, 1), dtype='uint8', name='pixels')
+    x = keras.ops.cast(pixels, 'float32')
+    for layer in model.layers:
+        if not isinstance(layer, keras.layers.Resizing):
+            x = layer(x)
+    return keras.Model(pixels, x), 'uint8'
+
+
+def export_tflite(model, output_path, calibration_images=None):
+    """
+    Convert a Keras model to TFLite. With calibration images (raw uint8),
+    apply full-integer post-training quantization (int8 weights, activations
+    and output; the input stays raw uint8 pixels for models that take them).
+    """
+    import tensorflow as tf
+
+    model, input_dtype = exportable_model(model)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if calibration_images is not None:
+        if input_dtype == 'float32':
+            calibration_images = preprocess_batch(calibration_images)
+
+        def representative_dataset():
+            for image in calibration_images:
+                yield [image[np.newaxis]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8 if input_dtype == 'uint8' else tf.int8
+        converter.inference_output_type = tf.int8
+
+    with open(output_path, 'wb') as f:
+        f.write(converter.convert())
+    print(f"Saved TFLite model to {output_path} ({os.path.getsize(output_path) / 1024:.0f} KB)")
+
+
+def export_onnx(model, output_path, calibration_images=None):
+    """
+    Convert a Keras model to ONNX (requires tf2onnx). With calibration images
+    (raw uint8), the float model is statically quantized to int8 with onnxruntime.
+    """
+    import tensorflow as tf
+
+    model, input_dtype = exportable_model(model)
+    float_path = output_path
+    if calibration_images is not None:
+        float_path = output_path + '.float.onnx'
+        if input_dtype == 'float32':
+            calibration_images = preprocess_batch(calibration_images)
+
+    # Keras needs one call to build the graph before export
+    model(np.zeros((1, 48, 48, 1), dtype=input_dtype))
+    model.export(
+        float_path,
+        format='onnx',
+        input_signature=[tf.TensorSpec([None, 48, 48, 1], input_dtype,
+                                       name='pixels' if input_dtype == 'uint8' else 'image')]
+    )
+
+    if calibration_images is not None:
+        from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+        class FER2013Reader(CalibrationDataReader):
+            def __init__(self, input_name):
+                self._samples = iter(calibration_images)
+                self._input_name = input_name
+
+            def get_next(self):
+                image = next(self._samples, None)
+                if image is None:
+                    return None
+                return {self._input_name: image[np.newaxis]}
+
+        import onnxruntime as ort
+        input_name = ort.InferenceSession(float_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+        quantize_static(
+            float_path, output_path, FER2013Reader(input_name),
+            activation_type=QuantType.QInt8, weight_type=QuantType.QInt8
+        )
+        os.remove(float_path)
+
+    print(f"Saved ONNX model to {output_path} ({os.path.getsize(output_path) / 1024:.0f} KB)")
+
+
+def measure_backend(backend, images, labels, latency_samples=200):
+    """Return accuracy, predictions and single-image CPU latency (ms) for a backend"""
+    predictions = []
+    for start in range(0, len(images), 64):
+        predictions.append(backend.predict(images[start:start + 64]))
+    predictions = np.concatenate(predictions).argmax(axis=1)
+    accuracy = float((predictions == labels).mean())
+
+    # Warm up, then time batch-of-one calls as served by detect_emotion
+    backend.predict(images[:1])
+    latencies = []
+    for image in images[:latency_samples]:
+        started = time.perf_counter()
+        backend.predict(image[np.newaxis])
+        latencies.append((time.perf_counter() - started) * 1000.0)
+
+    return {
+        'accuracy': accuracy,
+        'predictions': predictions,
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p99': float(np.percentile(latencies, 99)),
+    }
+
+
+def evaluate_backends(names, csv_path='fer2013.csv', num_samples=1000):
+    """Compare each exported backend with the Keras baseline on the FER2013 test split"""
+    images, labels = load_fer2013_samples(csv_path, usage='PrivateTest', num_samples=num_samples)
+    print(f"\nEvaluating on {len(images)} PrivateTest images...")
+
+    results = {}
+    for name in ['keras'] + [n for n in names if n != 'keras']:
+        if not os.path.exists(DEFAULT_MODEL_PATHS[name]):
+            print(f"Skipping {name}: {DEFAULT_MODEL_PATHS[name]} not found")
+            continue
+        results[name] = measure_backend(load_backend(name), images, labels)
+
+    baseline = results['keras']
+    print("\n" + "=" * 72)
+    print(f"{'Backend':<14}{'Accuracy':>10}{'Delta':>10}{'Agreement':>12}{'p50 ms':>10}{'p99 ms':>10}{'Size KB':>10}")
+    print("=" * 72)
+    for name, result in results.items():
+        delta = result['accuracy'] - baseline['accuracy']
+        agreement = float((result['predictions'] == baseline['predictions']).mean())
+        size_kb = os.path.getsize(DEFAULT_MODEL_PATHS[name]) / 1024
+        print(f"{name:<14}{result['accuracy']:>10.4f}{delta:>+10.4f}{agreement:>12.2%}"
+              f"{result['latency_ms_p50']:>10.2f}{result['latency_ms_p99']:>10.2f}{size_kb:>10.0f}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export face_emotionModel.h5 to TFLite/ONNX')
+    parser.add_argument('--model', default=DEFAULT_MODEL_PATHS['keras'], help='Trained Keras model')
+    parser.add_argument('--formats', nargs='+', choices=['tflite', 'onnx'], default=['tflite'])
+    parser.add_argument('--int8', action='store_true', help='Also export int8 post-training quantized models')
+    parser.add_argument('--csv', default='fer2013.csv', help='FER2013 CSV used for calibration and evaluation')
+    parser.add_argument('--calibration-samples', type=int, default=500)
+    parser.add_argument('--evaluate', action='store_true', help='Report accuracy delta and latency per backend')
+    parser.add_argument('--eval-samples', type=int, default=1000)
+    args = parser.parse_args()
+
+    from tensorflow import keras
+
+    print(f"Loading Keras model from {args.model}...")
+    model = keras.models.load_model(args.model, compile=False)
+
+    calibration = None
+    if args.int8:
+        print(f"Loading {args.calibration_samples} FER2013 training samples for calibration...")
+        calibration, _ = load_fer2013_samples(args.csv, usage='Training', num_samples=args.calibration_samples)
+
+    exported = []
+    for fmt in args.formats:
+        exporter = export_tflite if fmt == 'tflite' else export_onnx
+        exporter(model, DEFAULT_MODEL_PATHS[fmt])
+        exported.append(fmt)
+        if calibration is not None:
+            exporter(model, DEFAULT_MODEL_PATHS[f'{fmt}-int8'], calibration_images=calibration)
+            exported.append(f'{fmt}-int8')
+
+    if args.evaluate:
+        evaluate_backends(exported, args.csv, args.eval_samples)
+
+    print("\nServe an exported model with e.g. MODEL_BACKEND=tflite python app.py")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Face localization stage that runs before the emotion classifier.
+Uses OpenCV's bundled Haar cascade on a downscaled copy of the image and
+maps the boxes back to full resolution, so each face can be cropped and
+classified at the model's 48x48 input size.
+"""
+
+import os
+import threading
+
+import cv2
+
+# Bundled with the opencv-python wheels; override with the cascade_path argument
+_CASCADE_DIR = getattr(getattr(cv2, 'data', None), 'haarcascades', '')
+DEFAULT_CASCADE = os.path.join(_CASCADE_DIR, 'haarcascade_frontalface_default.xml')
+
+
+class FaceDetector:
+    """
+    Haar cascade face detector.
+
+    Detection runs on a copy whose longest side is at most detect_max_side
+    pixels; returned boxes are (x, y, w, h) in full-resolution coordinates.
+    """
+
+    def __init__(self, cascade_path=DEFAULT_CASCADE, detect_max_side=480,
+                 scale_factor=1.1, min_neighbors=5, min_face_size=24):
+        if not hasattr(cv2, 'CascadeClassifier'):
+            raise ImportError("This OpenCV build has no CascadeClassifier (install opencv-python 4.x)")
+        if not os.path.exists(cascade_path):
+            raise FileNotFoundError(f"Face cascade '{cascade_path}' not found")
+        self.cascade_path = cascade_path
+        self.detect_max_side = detect_max_side
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_face_size = min_face_size
+        # CascadeClassifier is not safe to share between threads
+        self._local = threading.local()
+
+    def _cascade(self):
+        cascade = getattr(self._local, 'cascade', None)
+        if cascade is None:
+            cascade = cv2.CascadeClassifier(self.cascade_path)
+            self._local.cascade = cascade
+        return cascade
+
+    def detect(self, gray):
+        """Return face boxes (x, y, w, h), largest first, for a grayscale image"""
+        height, width = gray.shape[:2]
+        scale = min(1.0, self.detect_max_side / float(max(height, width)))
+        small = gray
+        if scale < 1.0:
+            small = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        small = cv2.equalizeHist(small)
+
+        min_size = max(1, int(self.min_face_size * scale))
+        found = self._cascade().detectMultiScale(
+            small,
+            scaleFactor=self.scale_factor,
+            minNeighbors=self.min_neighbors,
+            minSize=(min_size, min_size)
+        )
+
+        boxes = []
+        for (x, y, w, h) in found:
+            # Map back to full resolution and clip to the image bounds
+            x0 = max(0, int(round(x / scale)))
+            y0 = max(0, int(round(y / scale)))
+            x1 = min(width, int(round((x + w) / scale)))
+            y1 = min(height, int(round((y + h) / scale)))
+            if x1 > x0 and y1 > y0:
+                boxes.append((x0, y0, x1 - x0, y1 - y0))
+
+        boxes.sort(key=lambda box: box[2] * box[3], reverse=True)
+        return boxes
+
+
+def crop_faces(gray, boxes):
+    """Return the full-resolution crop for each (x, y, w, h) box"""
+    return [gray[y:y + h, x:x + w] for (x, y, w, h) in boxes]
@@ -0,0 +1,45 @@
+"""
+Gunicorn settings for fast cold starts.
+The app is imported once in the master (preload_app), so library code and
+fork-safe models (TFLite/ONNX) are shared copy-on-write by every worker.
+Each worker then runs app.warm_up() before it accepts traffic; /health
+answers 503 until that has finished.
+
+Usage:
+    gunicorn app:app -c gunicorn.conf.py
+"""
+
+import gc
+import os
+import time
+
+# Read by app.py at import: defer work that is not fork-safe to the workers
+os.environ.setdefault('PREFORK', '1')
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+# One thread per request that admission control lets run at once, plus a few
+# spares. A request waiting in the admission queue blocks a spare thread (WSGI
+# handlers cannot yield one), so the spares hold that queue, which app.py keeps
+# short, and answer /health and /metrics. Bursts beyond them are not worth a
+# thread each: they wait in gunicorn until a thread is free
+_in_flight = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 4)) or 4
+threads = int(os.environ.get('GUNICORN_THREADS', 0)) or _in_flight + int(os.environ.get('GUNICORN_SPARE_THREADS', 4))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1').lower() not in ('0', 'false', 'no')
+
+
+def when_ready(server):
+    # Move everything imported so far out of the GC's reach: collections would
+    # otherwise write to every object header and unshare the pages after fork
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+
+
+def post_worker_init(worker):
+    # Runs in the worker after the app is loaded and before it accepts requests
+    import app
+    app.warm_up(process_started=getattr(worker, 'forked_at', None))
@@ -0,0 +1,95 @@
+"""
+Iterate images in directories or packed in zip or tar archives.
+Archive members are read one at a time, with limits on image count,
+per-image size and total uncompressed bytes so a malicious archive cannot
+exhaust memory.
+"""
+
+import os
+import tarfile
+import zipfile
+
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+ARCHIVE_SUFFIXES = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tar.xz')
+
+
+class ArchiveError(ValueError):
+    """Raised when an archive cannot be read"""
+
+
+class ArchiveLimitError(ArchiveError):
+    """Raised when an archive exceeds one of the configured limits"""
+
+
+def is_archive(filename):
+    return filename.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+def is_image_name(name):
+    return '.' in name and name.rsplit('.', 1)[1].lower() in IMAGE_EXTENSIONS
+
+
+def _read_limited(fileobj, limit, name):
+    data = fileobj.read(limit + 1)
+    if len(data) > limit:
+        raise ArchiveLimitError(f"'{name}' is larger than {limit} bytes")
+    return data
+
+
+def iter_archive_images(fileobj, filename, max_images=256, max_image_bytes=16 * 1024 * 1024,
+                        max_total_bytes=64 * 1024 * 1024):
+    """
+    Yield (member_name, image_bytes) for every image in a zip or tar archive.
+    fileobj must be seekable for zip archives; tar archives are streamed.
+    Non-image members and directories are skipped. Corrupt archives raise
+    ArchiveError and exceeded limits raise ArchiveLimitError.
+    """
+    count = 0
+    total = 0
+
+    def check(name, size):
+        nonlocal count, total
+        count += 1
+        total += size
+        if count > max_images:
+            raise ArchiveLimitError(f"Archive contains more than {max_images} images")
+        if total > max_total_bytes:
+            raise ArchiveLimitError(f"Archive expands to more than {max_total_bytes} bytes")
+
+    try:
+        if filename.lower().endswith('.zip'):
+            with zipfile.ZipFile(fileobj) as archive:
+                for info in archive.infolist():
+                    if info.is_dir() or not is_image_name(info.filename):
+                        continue
+                    if info.file_size > max_image_bytes:
+                        raise ArchiveLimitError(f"'{info.filename}' is larger than {max_image_bytes} bytes")
+                    with archive.open(info) as member:
+                        data = _read_limited(member, max_image_bytes, info.filename)
+                    check(info.filename, len(data))
+                    yield info.filename, data
+        else:
+            # 'r|*' streams the tar sequentially and auto-detects compression
+            with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+                for member in archive:
+                    if not member.isfile() or not is_image_name(member.name):
+                        continue
+                    if member.size > max_image_bytes:
+                        raise ArchiveLimitError(f"'{member.name}' is larger than {max_image_bytes} bytes")
+                    data = _read_limited(archive.extractfile(member), max_image_bytes, member.name)
+                    check(member.name, len(data))
+                    yield member.name, data
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError) as e:
+        raise ArchiveError(f"Could not read archive '{filename}': {e}")
+
+
+def iter_directory_images(root):
+    """
+    Yield the path of every image file under root, recursively, in a stable
+    (sorted) order so a run can be resumed by position. Files are not read.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if is_image_name(filename):
+                yield os.path.join(dirpath, filename)
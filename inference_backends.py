@@ -0,0 +1,260 @@
+"""
+Pluggable inference backends for the emotion model.
+Every backend takes a batch of raw grayscale pixels of shape (n, 48, 48, 1)
+(uint8, 0-255) and returns softmax outputs of shape (n, 7). Current models
+rescale their input themselves and get the pixels as they are; models
+trained or exported before that get preprocess_batch() applied here. Only
+the Keras backend imports TensorFlow; TFLite and ONNX run on their
+lightweight runtimes. The Keras backend can also return each image's
+embedding (see embedding_layer) next to its softmax outputs.
+
+fork_safe tells a preforking server whether a loaded model can be shared
+with forked workers: TensorFlow's runtime deadlocks in a child forked after
+it has started, so Keras models must be loaded in each worker instead.
+"""
+
+import os
+
+import numpy as np
+
+from preprocessing import preprocess_batch
+
+# Default artifact for each backend (see export_model.py)
+DEFAULT_MODEL_PATHS = {
+    'keras': 'face_emotionModel.h5',
+    'tflite': 'face_emotionModel.tflite',
+    'tflite-int8': 'face_emotionModel_int8.tflite',
+    'onnx': 'face_emotionModel.onnx',
+    'onnx-int8': 'face_emotionModel_int8.onnx',
+}
+
+
+def takes_raw_pixels(model):
+    """True if a Keras model starts with its own preprocessing layers (see create_model)"""
+    return any(type(layer).__name__ in ('Rescaling', 'Resizing') for layer in model.layers[:2])
+
+
+def embedding_layer(model):
+    """
+    Layer whose output serves as the image embedding: the last hidden Dense
+    layer (256-d in create_model), or for models with a single Dense
+    classifier (the distilled students) the last layer feeding it
+    """
+    dense = [layer for layer in model.layers if type(layer).__name__ == 'Dense']
+    if len(dense) >= 2:
+        return dense[-2]
+    hidden = model.layers[:model.layers.index(dense[-1])] if dense else []
+    hidden = [layer for layer in hidden if type(layer).__name__ != 'Dropout']
+    return hidden[-1] if hidden else None
+
+
+class KerasBackend:
+    """Full Keras model (TensorFlow runtime)"""
+    name = 'keras'
+    fork_safe = False
+
+    @staticmethod
+    def import_runtime():
+        # Importing TensorFlow starts no threads, so it is safe before fork
+        os.environ.setdefault('TF_CPP_MIN_LOG_LEVEL', '2')  # Suppress TensorFlow warnings
+        import tensorflow as tf
+        from tensorflow import keras
+        return tf, keras
+
+    def __init__(self, model_path, num_threads=1):
+        tf, keras = self.import_runtime()
+        self._tf = tf
+
+        # Disable GPU if available to save memory on free tier
+        try:
+            gpus = tf.config.list_physical_devices('GPU')
+            if gpus:
+                try:
+                    for gpu in gpus:
+                        tf.config.experimental.set_memory_growth(gpu, True)
+                except RuntimeError as e:
+                    print(f"GPU configuration error: {e}")
+        except Exception as e:
+            print(f"GPU check failed: {e}")
+
+        # Limit TensorFlow to use only necessary memory and threads
+        try:
+            tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+            tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        except Exception as e:
+            print(f"Threading config error: {e}")
+
+        # Don't compile on load - we only need inference, not training
+        with tf.device('/CPU:0'):  # Use CPU to avoid GPU memory issues on free tier
+            self.model = keras.models.load_model(model_path, compile=False)
+        self.raw_pixels = takes_raw_pixels(self.model)
+        self._embedder = None
+
+    @property
+    def embedding_dim(self):
+        layer = embedding_layer(self.model)
+        return int(layer.output.shape[-1]) if layer is not None else None
+
+    def predict_with_embeddings(self, images):
+        """Softmax outputs (n, 7) and embeddings (n, embedding_dim) from one forward pass"""
+        if self._embedder is None:
+            keras = self.import_runtime()[1]
+            model = self.model
+            self._embedder = keras.Model(model.inputs, [model.outputs[0], embedding_layer(model).output])
+        if not self.raw_pixels:
+            images = preprocess_batch(images)
+        with self._tf.device('/CPU:0'):
+            probabilities, embeddings = self._embedder.predict_on_batch(images)
+        return np.asarray(probabilities), np.asarray(embeddings, dtype=np.float32)
+
+    def predict(self, images):
+        if not self.raw_pixels:
+            images = preprocess_batch(images)
+        with self._tf.device('/CPU:0'):  # Force CPU usage to avoid GPU memory issues
+            try:
+                # Use predict_on_batch - more memory efficient than predict()
+                return np.asarray(self.model.predict_on_batch(images))
+            except Exception as pred_error:
+                print(f"Prediction error: {pred_error}")
+                import traceback
+                print(traceback.format_exc())
+                # Try alternative prediction method
+                try:
+                    return self.model(images, training=False).numpy()
+                except Exception:
+                    raise pred_error
+
+
+def _load_tflite_interpreter():
+    """Return the first available TFLite Interpreter class, preferring standalone runtimes"""
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+    except ImportError:
+        raise ImportError(
+            "No TFLite runtime found. Install 'ai-edge-litert' (or 'tflite-runtime') to use the tflite backend."
+        )
+
+
+class TFLiteBackend:
+    """TFLite flatbuffer, float32 or full-integer (int8) quantized; raw uint8 input for current exports"""
+    name = 'tflite'
+    fork_safe = True
+
+    @staticmethod
+    def import_runtime():
+        return _load_tflite_interpreter()
+
+    def __init__(self, model_path, num_threads=1):
+        Interpreter = self.import_runtime()
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch_size = int(self._input['shape'][0])
+        # A uint8 input without quantization parameters takes the raw pixels
+        self.raw_pixels = self._input['dtype'] == np.uint8 and not self._input['quantization'][0]
+        self.quantized = not self.raw_pixels and self._input['dtype'] in (np.int8, np.uint8)
+
+    def _resize(self, batch_size):
+        if batch_size != self._batch_size:
+            self.interpreter.resize_tensor_input(self._input['index'], [batch_size, 48, 48, 1])
+            self.interpreter.allocate_tensors()
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._batch_size = batch_size
+
+    def predict(self, images):
+        images = np.asarray(images)
+        self._resize(len(images))
+
+        if self.raw_pixels:
+            images = images.astype(np.uint8, copy=False)
+        else:
+            images = preprocess_batch(images)
+        if self.quantized:
+            scale, zero_point = self._input['quantization']
+            info = np.iinfo(self._input['dtype'])
+            images = np.clip(np.round(images / scale + zero_point), info.min, info.max)
+            images = images.astype(self._input['dtype'])
+
+        self.interpreter.set_tensor(self._input['index'], images)
+        self.interpreter.invoke()
+        outputs = self.interpreter.get_tensor(self._output['index'])
+
+        if self._output['dtype'] in (np.int8, np.uint8):
+            scale, zero_point = self._output['quantization']
+            outputs = (outputs.astype(np.float32) - zero_point) * scale
+        return outputs
+
+
+class OnnxBackend:
+    """ONNX model on onnxruntime"""
+    name = 'onnx'
+    fork_safe = True
+
+    @staticmethod
+    def import_runtime():
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("onnxruntime is not installed. Install 'onnxruntime' to use the onnx backend.")
+        return ort
+
+    def __init__(self, model_path, num_threads=1):
+        ort = self.import_runtime()
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self._input_name = self.session.get_inputs()[0].name
+        self.raw_pixels = self.session.get_inputs()[0].type == 'tensor(uint8)'
+
+    def predict(self, images):
+        if self.raw_pixels:
+            images = np.asarray(images).astype(np.uint8, copy=False)
+        else:
+            images = preprocess_batch(images)
+        return self.session.run(None, {self._input_name: images})[0]
+
+
+BACKENDS = {
+    'keras': KerasBackend,
+    'tflite': TFLiteBackend,
+    'tflite-int8': TFLiteBackend,
+    'onnx': OnnxBackend,
+    'onnx-int8': OnnxBackend,
+}
+
+
+def load_backend(name='keras', model_path=None, num_threads=1):
+    """
+    Load the named backend. model_path defaults to the artifact that
+    export_model.py writes for that backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'. Choose from: {', '.join(BACKENDS)}")
+    model_path = model_path or DEFAULT_MODEL_PATHS[name]
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model file '{model_path}' not found for backend '{name}'")
+    backend = BACKENDS[name](model_path, num_threads=num_threads)
+    backend.name = name
+    backend.model_path = model_path
+    return backend
+
+
+def preload_runtime(name='keras'):
+    """Import a backend's runtime libraries without loading a model (safe before fork)"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{name}'. Choose from: {', '.join(BACKENDS)}")
+    BACKENDS[name].import_runtime()
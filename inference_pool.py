@@ -0,0 +1,367 @@
+"""
+Multi-process inference pool.
+N worker processes, separate from the web workers, each load the model with
+a configurable number of threads. Every worker owns a small ring of slots in
+two multiprocessing.shared_memory blocks (inputs and softmax outputs); only
+(sequence, slot, count) tuples go through the worker's pipe, the tensors are
+never pickled. A monitor thread pings idle workers and kills hung ones, and
+crashed workers are restarted automatically.
+
+InferencePool has the same predict(images) interface as the backends in
+inference_backends.py, so it can stand in for one anywhere.
+"""
+
+import atexit
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+IMAGE_SHAPE = (48, 48, 1)
+# Input slots hold raw pixels; the backend (or the model itself) rescales them
+IMAGE_DTYPE = np.uint8
+NUM_CLASSES = 7
+
+
+def _attach(name):
+    """Attach to a shared memory block owned by the pool process"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 always registers the block, but spawned workers share the
+        # parent's resource tracker, so the parent's unlink still cleans it up once
+        return shared_memory.SharedMemory(name=name)
+
+
+def _worker_main(backend_name, model_path, num_threads, input_name, output_name, depth, capacity, conn):
+    """Worker process: load the model, then serve slots until told to stop"""
+    from inference_backends import load_backend
+
+    input_block = _attach(input_name)
+    output_block = _attach(output_name)
+    inputs = np.ndarray((depth, capacity) + IMAGE_SHAPE, dtype=IMAGE_DTYPE, buffer=input_block.buf)
+    outputs = np.ndarray((depth, capacity, NUM_CLASSES), dtype=np.float32, buffer=output_block.buf)
+    try:
+        backend = load_backend(backend_name, model_path, num_threads=num_threads)
+        backend.predict(np.zeros((1,) + IMAGE_SHAPE, dtype=IMAGE_DTYPE))  # Trace before reporting ready
+        conn.send(('ready', os.getpid(), None, None))
+
+        while True:
+            try:
+                kind, seq, slot, count = conn.recv()
+            except EOFError:
+                break
+            if kind == 'stop':
+                break
+            if kind == 'ping':
+                conn.send(('pong', seq, None, None))
+                continue
+            try:
+                outputs[slot, :count] = backend.predict(inputs[slot, :count])
+                conn.send(('done', seq, slot, None))
+            except Exception as e:
+                conn.send(('error', seq, slot, f'{type(e).__name__}: {e}'))
+    finally:
+        del inputs, outputs
+        input_block.close()
+        output_block.close()
+
+
+class _Task:
+    __slots__ = ('slot', 'count', 'started', 'done', 'error')
+
+    def __init__(self, slot, count):
+        self.slot = slot
+        self.count = count
+        self.started = time.monotonic()
+        self.done = threading.Event()
+        self.error = None
+
+
+class _Worker:
+    """Parent-side state of one worker process and its shared memory ring"""
+
+    def __init__(self, index, depth, capacity):
+        self.index = index
+        self.depth = depth
+        self.input_block = shared_memory.SharedMemory(
+            create=True, size=depth * capacity * int(np.prod(IMAGE_SHAPE)) * np.dtype(IMAGE_DTYPE).itemsize)
+        self.output_block = shared_memory.SharedMemory(create=True, size=depth * capacity * NUM_CLASSES * 4)
+        self.inputs = np.ndarray((depth, capacity) + IMAGE_SHAPE, dtype=IMAGE_DTYPE, buffer=self.input_block.buf)
+        self.outputs = np.ndarray((depth, capacity, NUM_CLASSES), dtype=np.float32, buffer=self.output_block.buf)
+        self.free_slots = list(range(depth))
+        self.inflight = {}
+        self.process = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.ready = False
+        self.pid = None
+        self.restarts = 0
+        self.tasks = 0
+        self.errors = 0
+        self.last_seen = time.monotonic()
+        self.ping_sent = None
+
+    def send(self, message, conn=None):
+        """Send on conn (a connection seen earlier) or the current one"""
+        with self.send_lock:
+            (conn or self.conn).send(message)
+
+    def release(self):
+        del self.inputs, self.outputs
+        for block in (self.input_block, self.output_block):
+            block.close()
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class InferencePool:
+    """
+    Pool of model-serving processes.
+
+    predict() splits a batch into chunks of at most slot_capacity images,
+    copies each chunk into a free slot of the least busy ready worker and
+    blocks until the worker has written the outputs back. Each worker has
+    ring_depth slots, so it can have that many chunks queued. Processes are
+    started lazily on first use (and again after a fork, like the scheduler).
+    """
+
+    def __init__(self, backend_name, model_path, num_workers=2, threads_per_worker=1, slot_capacity=32,
+                 ring_depth=2, task_timeout=30.0, health_interval=5.0, start_timeout=120.0):
+        self.name = backend_name
+        self.model_path = model_path
+        self.num_workers = max(1, int(num_workers))
+        self.threads_per_worker = max(1, int(threads_per_worker))
+        self.slot_capacity = max(1, int(slot_capacity))
+        self.ring_depth = max(1, int(ring_depth))
+        self.task_timeout = task_timeout
+        self.health_interval = health_interval
+        self.start_timeout = start_timeout
+
+        # spawn: the web process may already hold threads or a TensorFlow runtime
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = []
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._closed = False
+        atexit.register(self.close)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            if self._closed:
+                raise RuntimeError('Inference pool is closed')
+            # After a fork the parent's processes, pipes and threads are not ours
+            self._workers = [_Worker(i, self.ring_depth, self.slot_capacity) for i in range(self.num_workers)]
+            self._pid = os.getpid()
+            for worker in self._workers:
+                self._spawn(worker)
+                threading.Thread(target=self._read_loop, args=(worker,), name=f'inference-pool-reader-{worker.index}',
+                                 daemon=True).start()
+            threading.Thread(target=self._monitor, name='inference-pool-monitor', daemon=True).start()
+
+            deadline = time.monotonic() + self.start_timeout
+            with self._cond:
+                while not any(worker.ready for worker in self._workers):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or all(w.restarts > 3 for w in self._workers):
+                        raise RuntimeError('No inference worker became ready; check the model file and backend')
+                    self._cond.wait(min(remaining, 1.0))
+
+    def _spawn(self, worker):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(self.name, self.model_path, self.threads_per_worker, worker.input_block.name,
+                  worker.output_block.name, self.ring_depth, self.slot_capacity, child_conn),
+            name=f'inference-worker-{worker.index}',
+            daemon=True
+        )
+        process.start()
+        child_conn.close()
+        worker.process = process
+        worker.conn = parent_conn
+        worker.last_seen = time.monotonic()
+        worker.ping_sent = None
+
+    def _read_loop(self, worker):
+        """Receive results from one worker; restart it whenever its pipe breaks"""
+        while not self._closed:
+            try:
+                kind, seq, slot, error = worker.conn.recv()
+            except (EOFError, OSError):
+                self._handle_exit(worker)
+                if self._closed:
+                    return
+                continue
+
+            worker.last_seen = time.monotonic()
+            with self._cond:
+                if kind == 'ready':
+                    worker.ready = True
+                    worker.pid = seq
+                    self._cond.notify_all()
+                elif kind == 'pong':
+                    worker.ping_sent = None
+                else:
+                    task = worker.inflight.pop(seq, None)
+                    if task is not None:
+                        worker.tasks += 1
+                        if kind == 'error':
+                            worker.errors += 1
+                            task.error = RuntimeError(f'Inference worker {worker.index} failed: {error}')
+                        task.done.set()
+
+    def _handle_exit(self, worker):
+        """Fail the dead worker's tasks and start a replacement (with backoff if it keeps dying)"""
+        worker.process.join(5.0)
+        exitcode = worker.process.exitcode
+        with self._cond:
+            worker.ready = False
+            for task in worker.inflight.values():
+                task.error = RuntimeError(f'Inference worker {worker.index} exited (code {exitcode})')
+                task.done.set()
+            worker.inflight.clear()
+        worker.conn.close()
+        if self._closed:
+            return
+        print(f"Inference worker {worker.index} (pid {worker.pid}) exited with code {exitcode}; restarting")
+        time.sleep(min(30.0, 0.5 * 2 ** min(worker.restarts, 6)))
+        if self._closed:
+            return
+        worker.restarts += 1
+        self._spawn(worker)
+
+    def _monitor(self):
+        """Health checks: ping idle workers, kill ones that are hung or stop answering"""
+        while not self._closed and self._pid == os.getpid():
+            time.sleep(self.health_interval)
+            now = time.monotonic()
+            for worker in self._workers:
+                with self._cond:
+                    if not worker.ready:
+                        continue
+                    oldest = min((task.started for task in worker.inflight.values()), default=None)
+                    idle = oldest is None
+                if oldest is not None and now - oldest > self.task_timeout:
+                    print(f"Inference worker {worker.index} hung for {now - oldest:.0f}s; killing it")
+                    worker.process.kill()
+                elif worker.ping_sent is not None and now - worker.ping_sent > 3 * self.health_interval:
+                    print(f"Inference worker {worker.index} stopped answering health checks; killing it")
+                    worker.process.kill()
+                elif idle and worker.ping_sent is None:
+                    try:
+                        worker.ping_sent = now
+                        worker.send(('ping', next(self._seq), None, None))
+                    except OSError:
+                        pass  # The reader thread handles the broken pipe
+
+    def _acquire(self, count):
+        """
+        Reserve a free slot on the least busy ready worker and register its
+        task there, so a worker that exits from now on fails the task
+        """
+        deadline = time.monotonic() + self.task_timeout
+        with self._cond:
+            while True:
+                candidates = [w for w in self._workers if w.ready and w.free_slots]
+                if candidates:
+                    worker = min(candidates, key=lambda w: len(w.inflight))
+                    seq = next(self._seq)
+                    task = worker.inflight[seq] = _Task(worker.free_slots.pop(), count)
+                    return worker, seq, task
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('No inference worker available')
+                self._cond.wait(remaining)
+
+    def _run_chunk(self, images):
+        count = len(images)
+        worker, seq, task = self._acquire(count)
+        slot = task.slot
+        try:
+            worker.inputs[slot, :count] = images
+            with self._cond:
+                # Not ready: it exited while the inputs were copied (and failed the task)
+                conn = worker.conn if worker.ready else None
+                if conn is None:
+                    worker.inflight.pop(seq, None)
+            if conn is None:
+                raise task.error or RuntimeError(f'Inference worker {worker.index} is not available')
+            try:
+                # The connection checked above: a replacement process never gets this task
+                worker.send(('predict', seq, slot, count), conn)
+            except OSError:
+                pass  # Worker died; the reader thread fails the task
+            if not task.done.wait(self.task_timeout + self.health_interval):
+                # Kill it so a late write cannot land in a slot that is reused
+                worker.process.kill()
+                raise TimeoutError(f'Inference worker {worker.index} timed out')
+            if task.error is not None:
+                raise task.error
+            return worker.outputs[slot, :count].copy()
+        finally:
+            with self._cond:
+                worker.free_slots.append(slot)
+                self._cond.notify()
+
+    def predict(self, images):
+        """Return softmax outputs (n, 7) for a uint8 batch of raw pixels (n, 48, 48, 1)"""
+        images = np.asarray(images, dtype=IMAGE_DTYPE)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+        self._ensure_started()
+        chunks = [self._run_chunk(images[i:i + self.slot_capacity])
+                  for i in range(0, len(images), self.slot_capacity)]
+        return chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+
+    def stats(self):
+        with self._cond:
+            workers = [{
+                'index': w.index,
+                'pid': w.pid,
+                'ready': w.ready,
+                'inflight': len(w.inflight),
+                'tasks': w.tasks,
+                'errors': w.errors,
+                'restarts': w.restarts,
+                'last_seen_s': round(time.monotonic() - w.last_seen, 3)
+            } for w in self._workers] if self._pid == os.getpid() else []
+        return {
+            'workers': self.num_workers,
+            'threads_per_worker': self.threads_per_worker,
+            'slot_capacity': self.slot_capacity,
+            'ring_depth': self.ring_depth,
+            'ready_workers': sum(1 for w in workers if w['ready']),
+            'processes': workers
+        }
+
+    def close(self, timeout=5.0):
+        """Stop the workers and free the shared memory (only in the process that started them)"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._pid != os.getpid():
+            return
+        for worker in self._workers:
+            try:
+                worker.send(('stop', None, None, None))
+            except (OSError, AttributeError):
+                pass
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.kill()
+            worker.release()
@@ -0,0 +1,308 @@
+"""
+Dynamic micro-batching scheduler for emotion inference.
+Concurrent callers hand in (n, 48, 48, 1) arrays of raw pixels; a background
+thread groups them into one batch (bounded by a maximum batch size and a
+maximum wait) and runs one forward pass per batch. With concurrency > 1,
+several threads take turns collecting batches so that many batches can be
+in flight at once (e.g. one per process of an inference pool). Requests
+whose deadline has passed, or whose caller stopped waiting, are dropped
+before they reach the model. A closed scheduler's threads exit once its
+queue has drained, releasing predict_fn (and the model behind it).
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Upper bounds (in milliseconds) of the queue wait histogram buckets
+QUEUE_WAIT_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+# Queued by close(), one per batching thread
+_STOP = object()
+
+
+class DeadlineExceeded(TimeoutError):
+    """The request's deadline passed before its predictions were ready"""
+
+
+class _PendingRequest:
+    """A group of images from one caller waiting to be scheduled"""
+    __slots__ = ('images', 'enqueued_at', 'deadline', 'done', 'result', 'error', 'abandoned',
+                 'started', 'finished', 'batch_size')
+
+    def __init__(self, images, deadline=None):
+        self.images = images
+        self.enqueued_at = time.perf_counter()
+        self.deadline = deadline
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+        self.started = None
+        self.finished = None
+        self.batch_size = None
+
+    def expired(self):
+        """True if nobody will read the result (caller gave up or deadline passed)"""
+        if self.abandoned or (self.deadline is not None and time.monotonic() >= self.deadline):
+            self.error = DeadlineExceeded('Inference deadline exceeded before the batch ran')
+            self.done.set()
+            return True
+        return False
+
+
+class BatchScheduler:
+    """
+    Collects concurrent prediction requests into batches.
+
+    predict_fn receives a uint8 array of shape (batch, 48, 48, 1) and must
+    return the softmax outputs of shape (batch, num_classes), or a tuple of
+    arrays with one row per image (e.g. outputs and embeddings), which is
+    split between the callers the same way. Images from a single caller are
+    never split across batches. predict_fn is called from
+    up to concurrency threads at once.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=16, max_wait_ms=5.0, concurrency=1):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.concurrency = max(1, int(concurrency))
+
+        self._queue = queue.Queue()
+        self._carry = None
+        self._workers = []
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+        self._collect_lock = threading.Lock()
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._requests = 0
+        self._images = 0
+        self._errors = 0
+        self._expired = 0
+        self._batch_sizes = {}
+        self._wait_buckets = [0] * (len(QUEUE_WAIT_BUCKETS_MS) + 1)
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._recent_waits = deque(maxlen=2048)
+
+    def _workers_running(self):
+        return (self._worker_pid == os.getpid() and len(self._workers) == self.concurrency
+                and all(worker.is_alive() for worker in self._workers))
+
+    def _ensure_worker(self):
+        """Start the batching threads (again, if we are in a forked child)"""
+        if self._workers_running():
+            return
+        with self._start_lock:
+            if self._workers_running():
+                return
+            if self._worker_pid != os.getpid():
+                # Threads do not survive fork(); drop anything inherited from the parent
+                self._queue = queue.Queue()
+                self._carry = None
+                self._collect_lock = threading.Lock()
+                self._workers = []
+            self._worker_pid = os.getpid()
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self.concurrency:
+                worker = threading.Thread(target=self._run, name=f'inference-batcher-{len(self._workers)}',
+                                          daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def predict(self, images, timeout=None, deadline=None, timings=None):
+        """
+        Queue images for inference and block until their predictions are ready.
+        Returns an array of softmax outputs, one row per input image.
+        deadline is a time.monotonic() value; past it the request is dropped
+        from the queue and DeadlineExceeded is raised. A timings dict, if
+        given, receives the time.perf_counter() values at which the request
+        was queued and its batch started and finished, and the batch size.
+        """
+        if self._closed:
+            raise RuntimeError('Scheduler is closed')
+        images = np.asarray(images, dtype=np.uint8)
+        if images.ndim == 3:
+            images = images[np.newaxis]
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded('Inference deadline exceeded before queueing')
+            timeout = remaining if timeout is None else min(timeout, remaining)
+
+        self._ensure_worker()
+        pending = _PendingRequest(images, deadline)
+        self._queue.put(pending)
+
+        if not pending.done.wait(timeout):
+            # Still queued: let the collector drop it instead of running it for nobody
+            pending.abandoned = True
+            if deadline is not None:
+                raise DeadlineExceeded('Inference deadline exceeded while waiting for a batch')
+            raise TimeoutError('Timed out waiting for inference batch')
+        if timings is not None and pending.started is not None:
+            timings.update(enqueued=pending.enqueued_at, started=pending.started, finished=pending.finished,
+                           batch_size=pending.batch_size)
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _next_live(self, block=True, timeout=None):
+        """Next queued request that someone is still waiting for"""
+        while True:
+            pending = self._queue.get(block, timeout)
+            if pending is _STOP or not pending.expired():
+                return pending
+            with self._stats_lock:
+                self._expired += 1
+
+    def _collect_batch(self):
+        """Block for the first request, then gather more until full or max wait expires"""
+        first = None
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+            if first.expired():
+                with self._stats_lock:
+                    self._expired += 1
+                first = None
+        if first is None:
+            first = self._next_live()
+            if first is _STOP:
+                return None
+        batch = [first]
+        size = len(first.images)
+        deadline = first.enqueued_at + self.max_wait
+
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                if remaining <= 0:
+                    pending = self._next_live(block=False)
+                else:
+                    pending = self._next_live(timeout=remaining)
+            except queue.Empty:
+                break
+            if pending is _STOP:
+                self._queue.put(pending)  # Run what was collected, stop on the next round
+                break
+            if size + len(pending.images) > self.max_batch_size:
+                # Keep the group whole; it opens the next batch
+                self._carry = pending
+                break
+            batch.append(pending)
+            size += len(pending.images)
+
+        return batch
+
+    def _run(self):
+        while True:
+            # One thread collects at a time; the forward passes run concurrently
+            with self._collect_lock:
+                batch = self._collect_batch()
+            if batch is None:
+                return
+            started = time.perf_counter()
+            size = sum(len(pending.images) for pending in batch)
+
+            try:
+                if len(batch) == 1:
+                    inputs = batch[0].images
+                else:
+                    inputs = np.concatenate([pending.images for pending in batch], axis=0)
+                outputs = self.predict_fn(inputs)
+                if isinstance(outputs, tuple):
+                    outputs = tuple(np.asarray(output) for output in outputs)
+                else:
+                    outputs = np.asarray(outputs)
+                error = None
+            except Exception as e:
+                outputs = None
+                error = e
+            finished = time.perf_counter()
+
+            offset = 0
+            for pending in batch:
+                count = len(pending.images)
+                pending.started, pending.finished, pending.batch_size = started, finished, size
+                if error is None and isinstance(outputs, tuple):
+                    pending.result = tuple(output[offset:offset + count] for output in outputs)
+                elif error is None:
+                    pending.result = outputs[offset:offset + count]
+                else:
+                    pending.error = error
+                offset += count
+                pending.done.set()
+
+            self._record(batch, offset, started, error is not None)
+
+    def _record(self, batch, size, started, failed):
+        with self._stats_lock:
+            self._batches += 1
+            self._requests += len(batch)
+            self._images += size
+            if failed:
+                self._errors += 1
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+
+            for pending in batch:
+                wait_ms = (started - pending.enqueued_at) * 1000.0
+                self._wait_total += wait_ms
+                self._wait_max = max(self._wait_max, wait_ms)
+                self._recent_waits.append(wait_ms)
+                for i, bound in enumerate(QUEUE_WAIT_BUCKETS_MS):
+                    if wait_ms <= bound:
+                        self._wait_buckets[i] += 1
+                        break
+                else:
+                    self._wait_buckets[-1] += 1
+
+    def stats(self):
+        """Return batch size distribution and queue wait counters"""
+        with self._stats_lock:
+            recent = np.array(self._recent_waits) if self._recent_waits else None
+            buckets = {f'le_{bound}ms': count for bound, count in zip(QUEUE_WAIT_BUCKETS_MS, self._wait_buckets)}
+            buckets['gt_{}ms'.format(QUEUE_WAIT_BUCKETS_MS[-1])] = self._wait_buckets[-1]
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.0,
+                'concurrency': self.concurrency,
+                'batches': self._batches,
+                'requests': self._requests,
+                'images': self._images,
+                'errors': self._errors,
+                'expired_requests': self._expired,
+                'mean_batch_size': self._images / self._batches if self._batches else 0.0,
+                'batch_size_distribution': dict(sorted(self._batch_sizes.items())),
+                'queue_wait_ms': {
+                    'mean': self._wait_total / self._requests if self._requests else 0.0,
+                    'max': self._wait_max,
+                    'p50': float(np.percentile(recent, 50)) if recent is not None else 0.0,
+                    'p99': float(np.percentile(recent, 99)) if recent is not None else 0.0,
+                    'buckets': buckets,
+                },
+                'queue_depth': self._queue.qsize(),
+            }
+
+    def queue_depth(self):
+        return self._queue.qsize() + (1 if self._carry is not None else 0)
+
+    def close(self):
+        """Stop the batching threads after the requests already queued; predict() then fails"""
+        self._closed = True
+        for _ in self._workers:
+            self._queue.put(_STOP)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._reset_stats()
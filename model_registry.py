@@ -0,0 +1,519 @@
+"""
+Versioned model registry and zero-downtime model switching.
+A registry is a directory with one subdirectory per version, holding the
+model artifact and a metadata.json (backend, checksum, notes, metrics),
+plus registry.json naming the active version, an optional shadow version
+and the history that rollback returns to.
+
+ModelManager keeps the serving models of a process in sync with the
+registry: a new version is loaded and warmed up in the background while
+the current one keeps serving, then swapped in atomically. Requests hold
+the version they started on until they finish, and a replaced version is
+closed once its last request is done.
+
+Usage:
+    python model_registry.py register face_emotionModel.h5 --notes "retrained on v2 data" --activate
+    python model_registry.py list
+    python model_registry.py activate v3
+    python model_registry.py rollback
+    python model_registry.py shadow v4        # score traffic on v4 without serving it
+    python model_registry.py shadow --off
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: registry updates are not locked between processes
+    fcntl = None
+
+from prediction_cache import ModelFileVersion
+
+STATE_FILE = 'registry.json'
+METADATA_FILE = 'metadata.json'
+# Previous active versions kept for rollback
+MAX_HISTORY = 20
+
+VERSION_PATTERN = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._-]{0,63}$')
+
+# Backend of an artifact, by file name
+_BACKEND_SUFFIXES = (
+    ('_int8.tflite', 'tflite-int8'),
+    ('.tflite', 'tflite'),
+    ('_int8.onnx', 'onnx-int8'),
+    ('.onnx', 'onnx'),
+    ('.h5', 'keras'),
+    ('.keras', 'keras'),
+)
+
+
+def guess_backend(artifact_path):
+    name = artifact_path.lower()
+    for suffix, backend in _BACKEND_SUFFIXES:
+        if name.endswith(suffix):
+            return backend
+    raise ValueError(f"Cannot tell the backend of '{artifact_path}'; pass --backend")
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_json_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class ModelRegistry:
+    """
+    Directory of versioned model artifacts. Versions are immutable once
+    registered; only registry.json (active, shadow, history) changes, and it
+    is replaced atomically so readers never see a partial update.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    @property
+    def state_path(self):
+        return os.path.join(self.root, STATE_FILE)
+
+    def state(self):
+        """Return {'active', 'shadow', 'history', 'updated_at'}"""
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            state = {}
+        state.setdefault('active', None)
+        state.setdefault('shadow', None)
+        state.setdefault('history', [])
+        state.setdefault('updated_at', None)
+        return state
+
+    def versions(self):
+        """Metadata of every registered version, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for name in os.listdir(self.root):
+            if os.path.exists(os.path.join(self.root, name, METADATA_FILE)):
+                found.append(self.get(name))
+        return sorted(found, key=lambda metadata: (metadata['created_at'], metadata['version']))
+
+    def get(self, version):
+        """Metadata of one version, with 'path' set to its artifact; ValueError if unknown"""
+        if not version or not VERSION_PATTERN.match(version):
+            raise ValueError(f"Invalid model version '{version}'")
+        directory = os.path.join(self.root, version)
+        try:
+            with open(os.path.join(directory, METADATA_FILE)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"Unknown model version '{version}'")
+        metadata['path'] = os.path.join(directory, metadata['artifact'])
+        return metadata
+
+    def verify(self, metadata):
+        """Raise ValueError if an artifact no longer matches its registered checksum"""
+        if file_sha256(metadata['path']) != metadata['sha256']:
+            raise ValueError(f"Artifact of model version {metadata['version']} does not match its checksum")
+
+    def _next_version(self):
+        numbers = [int(name[1:]) for name in os.listdir(self.root) if re.match(r'^v\d+$', name)]
+        return f'v{max(numbers, default=0) + 1}'
+
+    def register(self, artifact_path, backend=None, version=None, notes=None, metrics=None):
+        """Copy an artifact into the registry as a new version and return its metadata"""
+        backend = backend or guess_backend(artifact_path)
+        os.makedirs(self.root, exist_ok=True)
+        version = version or self._next_version()
+        if not VERSION_PATTERN.match(version):
+            raise ValueError(f"Invalid model version '{version}'")
+        directory = os.path.join(self.root, version)
+        os.makedirs(directory)  # Fails if the version already exists
+
+        artifact = os.path.basename(artifact_path)
+        shutil.copyfile(artifact_path, os.path.join(directory, artifact))
+        metadata = {
+            'version': version,
+            'backend': backend,
+            'artifact': artifact,
+            'sha256': file_sha256(os.path.join(directory, artifact)),
+            'size': os.path.getsize(os.path.join(directory, artifact)),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'source': os.path.abspath(artifact_path),
+            'notes': notes,
+            'metrics': metrics or {}
+        }
+        # Written last: a version becomes visible only once its artifact is complete
+        _write_json_atomic(os.path.join(directory, METADATA_FILE), metadata)
+        return self.get(version)
+
+    def _update(self, change):
+        """Apply change(state) to registry.json under an exclusive lock"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.state()
+            change(state)
+            state['history'] = state['history'][-MAX_HISTORY:]
+            state['updated_at'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            _write_json_atomic(self.state_path, state)
+        return state
+
+    def activate(self, version):
+        """Serve version from now on; the current one is remembered for rollback"""
+        self.get(version)
+
+        def change(state):
+            if state['active'] == version:
+                return
+            if state['active']:
+                state['history'].append(state['active'])
+            state['active'] = version
+            if state['shadow'] == version:
+                state['shadow'] = None  # A promoted shadow is now the active version
+
+        return self._update(change)
+
+    def rollback(self):
+        """Serve the previously active version again"""
+        def change(state):
+            if not state['history']:
+                raise ValueError('No previous model version to roll back to')
+            state['active'] = state['history'].pop()
+            if state['shadow'] == state['active']:
+                state['shadow'] = None
+
+        return self._update(change)
+
+    def set_shadow(self, version):
+        """Mirror traffic to version without serving it (None turns shadow mode off)"""
+        if version is not None:
+            self.get(version)
+
+        def change(state):
+            if version is not None and version == state['active']:
+                raise ValueError(f"Model version '{version}' is already active")
+            state['shadow'] = version
+
+        return self._update(change)
+
+
+class ServingModel:
+    """
+    One loaded model version; predictions go through its own batch
+    scheduler. Requests acquire() it for their duration. Once retired
+    (replaced) it is closed when the last of them calls release().
+    embeddings tells whether the scheduler also returns embeddings.
+    """
+
+    def __init__(self, version, model, scheduler, metadata=None, embeddings=False):
+        self.version = version
+        self.model = model
+        self.scheduler = scheduler
+        self.metadata = metadata or {}
+        self.embeddings = embeddings
+        self.loaded_at = time.time()
+        self._lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+
+    @property
+    def backend(self):
+        return self.metadata.get('backend')
+
+    def predict(self, images, deadline=None, with_embeddings=False, timings=None):
+        """
+        Softmax outputs for a batch; with_embeddings returns (outputs,
+        embeddings), embeddings being None unless the scheduler captures them.
+        timings is passed on to BatchScheduler.predict().
+        """
+        outputs = self.scheduler.predict(images, deadline=deadline, timings=timings)
+        if isinstance(outputs, tuple):
+            return outputs if with_embeddings else outputs[0]
+        return (outputs, None) if with_embeddings else outputs
+
+    def acquire(self):
+        """Hold this version for a request; False if it has already been replaced"""
+        with self._lock:
+            if self._retired:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            close = self._retired and self._users == 0
+        if close:
+            self._close()
+
+    def retire(self):
+        with self._lock:
+            self._retired = True
+            close = self._users == 0
+        if close:
+            self._close()
+
+    def _close(self):
+        self.scheduler.close()
+        if hasattr(self.model, 'close'):
+            self.model.close()
+        print(f"Model {self.version} unloaded")
+
+    def info(self):
+        return {
+            'version': self.version,
+            'backend': self.backend,
+            'sha256': self.metadata.get('sha256'),
+            'source': self.metadata.get('source'),
+            'loaded_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.loaded_at)),
+            'embeddings': self.embeddings,
+            'in_use': self._users
+        }
+
+
+class ModelManager:
+    """
+    Keeps the active and shadow ServingModels of this process in sync with
+    a registry. load_fn(metadata) returns a ServingModel; warm_fn(serving)
+    exercises it before it takes traffic. Both run before the swap, so the
+    current version keeps serving while they do.
+
+    Without an active registry version, fallback_path (served with
+    fallback_backend) is used and reloaded whenever the file changes.
+    """
+
+    def __init__(self, registry, load_fn, warm_fn=None, fallback_path=None, fallback_backend='keras',
+                 poll_interval=5.0, on_swap=None):
+        self.registry = registry
+        self.load_fn = load_fn
+        self.warm_fn = warm_fn
+        self.fallback_path = fallback_path
+        self.fallback_backend = fallback_backend
+        self.poll_interval = poll_interval
+        self.on_swap = on_swap
+
+        self.active = None
+        self.shadow = None
+        self._fallback_version = ModelFileVersion(fallback_path) if fallback_path else None
+        self._sync_lock = threading.Lock()
+        self._failed = {}
+        self._poller_pid = None
+        self.loading = None
+        self.last_error = None
+        self.swaps = 0
+
+    def _fallback_metadata(self):
+        version = self._fallback_version() if self._fallback_version else None
+        if version is None:
+            return None
+        return {
+            'version': f'{os.path.basename(self.fallback_path)}@{version[:12]}',
+            'backend': self.fallback_backend,
+            'path': self.fallback_path,
+            'source': 'MODEL_PATH'
+        }
+
+    def desired(self):
+        """Metadata of the versions that should be active and shadow right now"""
+        state = self.registry.state() if self.registry is not None else {}
+        active = self.registry.get(state['active']) if state.get('active') else self._fallback_metadata()
+        shadow = self.registry.get(state['shadow']) if state.get('shadow') else None
+        return active, shadow
+
+    def planned_backends(self):
+        """Backends the next sync() would load (active first; empty if there is nothing to load)"""
+        try:
+            return [metadata['backend'] for metadata in self.desired() if metadata is not None]
+        except (OSError, ValueError):
+            return []
+
+    def active_version(self):
+        serving = self.active
+        return serving.version if serving is not None else None
+
+    def _acquire(self, slot):
+        while True:
+            serving = getattr(self, slot)
+            if serving is None or serving.acquire():
+                return serving
+
+    def acquire(self):
+        """The active ServingModel, held until its release() (None if no model is loaded)"""
+        return self._acquire('active')
+
+    def acquire_shadow(self):
+        return self._acquire('shadow')
+
+    def _load(self, metadata, warm):
+        key = (metadata['version'], metadata.get('sha256'))
+        if key in self._failed:
+            return None  # Not retried until the registry points somewhere else
+        self.loading = metadata['version']
+        try:
+            if 'sha256' in metadata:
+                self.registry.verify(metadata)
+            serving = self.load_fn(metadata)
+            if warm and self.warm_fn is not None:
+                self.warm_fn(serving)
+            return serving
+        except Exception as e:
+            self._failed[key] = str(e)
+            self.last_error = f"{metadata['version']}: {e}"
+            print(f"Could not load model {metadata['version']}, keeping the current one: {e}")
+            return None
+        finally:
+            self.loading = None
+
+    def _swap(self, role, serving):
+        previous = getattr(self, role)
+        setattr(self, role, serving)
+        if role == 'active' and serving is not None:
+            self.swaps += 1
+        print(f"{role.capitalize()} model: {previous.version if previous else None} -> "
+              f"{serving.version if serving else None}")
+        if self.on_swap is not None:
+            self.on_swap(role, previous, serving)
+        if previous is not None and previous is not self.active and previous is not self.shadow:
+            previous.retire()
+
+    def sync(self, warm=True):
+        """
+        Load, warm up and swap in whatever the registry (or the fallback
+        file) names. Returns once this process serves it, or the load failed.
+        """
+        with self._sync_lock:
+            try:
+                active, shadow = self.desired()
+            except (OSError, ValueError) as e:
+                self.last_error = str(e)
+                print(f"Model registry unreadable, keeping the current models: {e}")
+                return
+
+            if active is None:
+                if self.active is not None:
+                    print("No model configured; keeping the current one")
+            elif self.active is None or self.active.version != active['version']:
+                if self.shadow is not None and self.shadow.version == active['version']:
+                    self._swap('active', self.shadow)  # Already loaded and warm
+                    self._swap('shadow', None)
+                else:
+                    serving = self._load(active, warm)
+                    if serving is not None:
+                        self._swap('active', serving)
+
+            current = self.shadow.version if self.shadow else None
+            wanted = shadow['version'] if shadow else None
+            if wanted != current:
+                serving = self._load(shadow, warm) if shadow else None
+                if serving is not None or shadow is None:
+                    self._swap('shadow', serving)
+
+    def sync_in_background(self):
+        threading.Thread(target=self.sync, name='model-sync', daemon=True).start()
+
+    def start_polling(self):
+        """Follow registry changes made by other processes (once per process)"""
+        if self.poll_interval <= 0 or self._poller_pid == os.getpid():
+            return
+        self._poller_pid = os.getpid()
+        threading.Thread(target=self._poll_loop, name='model-registry-poll', daemon=True).start()
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.sync()
+            except Exception as e:
+                print(f"Model sync failed: {e}")
+
+    def status(self):
+        return {
+            'active': self.active.info() if self.active else None,
+            'shadow': self.shadow.info() if self.shadow else None,
+            'loading': self.loading,
+            'swaps': self.swaps,
+            'last_error': self.last_error,
+            'failed_versions': sorted(version for version, _ in self._failed)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the versioned model registry')
+    parser.add_argument('--registry', default=os.environ.get('MODEL_REGISTRY_DIR', 'models'),
+                        help='Registry directory (default: MODEL_REGISTRY_DIR or models/)')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    register = commands.add_parser('register', help='Add a model artifact as a new version')
+    register.add_argument('artifact', help='.h5/.keras, .tflite or .onnx file')
+    register.add_argument('--version', default=None, help='Version name (default: next vN)')
+    register.add_argument('--backend', default=None, help='Backend (default: from the file name)')
+    register.add_argument('--notes', default=None)
+    register.add_argument('--metric', action='append', default=[], metavar='NAME=VALUE',
+                          help='Evaluation result to record, e.g. --metric test_accuracy=0.64')
+    register.add_argument('--activate', action='store_true', help='Serve it right away')
+
+    commands.add_parser('list', help='Show registered versions and the registry state')
+    activate = commands.add_parser('activate', help='Serve a registered version')
+    activate.add_argument('version')
+    commands.add_parser('rollback', help='Serve the previously active version again')
+    shadow = commands.add_parser('shadow', help='Score traffic on a version without serving it')
+    shadow.add_argument('version', nargs='?')
+    shadow.add_argument('--off', action='store_true', help='Turn shadow mode off')
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.registry)
+    try:
+        if args.command == 'register':
+            metrics = {}
+            for item in args.metric:
+                name, _, value = item.partition('=')
+                try:
+                    metrics[name] = float(value)
+                except ValueError:
+                    metrics[name] = value
+            metadata = registry.register(args.artifact, backend=args.backend, version=args.version,
+                                         notes=args.notes, metrics=metrics)
+            print(f"Registered {metadata['version']} ({metadata['backend']}, {metadata['size']} bytes)")
+            if args.activate:
+                registry.activate(metadata['version'])
+        elif args.command == 'activate':
+            registry.activate(args.version)
+        elif args.command == 'rollback':
+            registry.rollback()
+        elif args.command == 'shadow':
+            if not args.off and not args.version:
+                parser.error('give a version or --off')
+            registry.set_shadow(None if args.off else args.version)
+    except ValueError as e:
+        raise SystemExit(str(e))
+
+    state = registry.state()
+    for metadata in registry.versions():
+        role = {state['active']: 'active', state['shadow']: 'shadow'}.get(metadata['version'], '')
+        print(f"{metadata['version']:<12} {role:<7} {metadata['backend']:<12} {metadata['created_at']}  "
+              f"{metadata['sha256'][:12]}  {metadata.get('notes') or ''}")
+    print(f"active: {state['active']}, shadow: {state['shadow']}, history: {state['history']}")
+
+
+if __name__ == '__main__':
+    main()
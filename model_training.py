@@ -2,29 +2,143 @@
 Facial Emotion Recognition Model Training Script
 This script trains a CNN model on the FER2013 dataset to recognize emotions.
 Emotions: 0=Angry, 1=Disgust, 2=Fear, 3=Happy, 4=Sad, 5=Surprise, 6=Neutral
+
+With --distill it instead distills the trained model into smaller
+depthwise-separable students (optionally magnitude-pruned) and reports
+size, CPU latency and test accuracy for each candidate.
+
+Models embed their own preprocessing (resize to 48x48 and rescale to
+[0, 1]), so training and serving both feed them raw uint8 pixels.
+--check-preprocessing verifies on real test images that the two paths agree
+bit for bit (tests/test_preprocessing.py does so on synthetic ones).
 """
 
+import argparse
+import gzip
+import io
+import json
+import time
+import tracemalloc
 import numpy as np
 import pandas as pd
+import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Conv2D, MaxPooling2D, Flatten, Dense, Dropout, BatchNormalization
+from tensorflow.keras.layers import (Conv2D, MaxPooling2D, Flatten, Dense, Dropout, BatchNormalization,
+                                     SeparableConv2D, GlobalAveragePooling2D, Activation, Resizing, Rescaling)
 from tensorflow.keras.utils import to_categorical
-from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping
+from tensorflow.keras.callbacks import Callback, EarlyStopping
 import os
 
-# Emotion labels mapping
-EMOTION_LABELS = {
-    0: 'Angry',
-    1: 'Disgust',
-    2: 'Fear',
-    3: 'Happy',
-    4: 'Sad',
-    5: 'Surprise',
-    6: 'Neutral'
+from inference_backends import takes_raw_pixels
+from preprocessing import EMOTION_LABELS
+
+# Filters per block of the depthwise-separable student candidates
+STUDENT_ARCHITECTURES = {
+    'ds-tiny': (16, 32, 64),
+    'ds-small': (32, 64, 128),
+    'ds-wide': (48, 96, 192),
 }
 
-def load_fer2013_data(csv_path='fer2013.csv'):
+# FER2013 'Usage' values, in the order the splits are stored in the cache
+SPLITS = ('Training', 'PublicTest', 'PrivateTest')
+DATASET_CACHE_DIR = 'fer2013_cache'
+
+def parse_pixels(pixel_strings, image_size=48):
+    """
+    Parse FER2013 'pixels' strings into a uint8 array of shape (n, 48, 48).
+    All rows are joined and parsed by NumPy in one call instead of a
+    Python loop over every pixel.
+    """
+    pixel_strings = list(pixel_strings)
+    if not pixel_strings:
+        return np.empty((0, image_size, image_size), dtype=np.uint8)
+    # loadtxt's C parser rejects ragged rows and values outside 0-255
+    pixels = np.loadtxt(io.StringIO('\n'.join(pixel_strings)), dtype=np.uint8, ndmin=2)
+    if pixels.shape != (len(pixel_strings), image_size * image_size):
+        raise ValueError(f"Expected {len(pixel_strings)} rows of {image_size * image_size} pixel values, "
+                         f"parsed {pixels.shape}; is the CSV corrupt?")
+    return pixels.reshape(-1, image_size, image_size)
+
+def build_dataset_cache(csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR):
+    """
+    One-time conversion of fer2013.csv into a compact binary cache:
+    - pixels.npy: uint8 (n, 48, 48), rows grouped by split
+    - labels.npy: uint8 (n,) emotion indices
+    - meta.json: split offsets and the source CSV's size/mtime
+    """
+    if not os.path.exists(csv_path):
+        raise FileNotFoundError(
+            f"FER2013 CSV file not found at {csv_path}\n"
+            "Please download fer2013.csv from Kaggle and place it in the project root."
+        )
+    
+    print(f"Building FER2013 cache from {csv_path}...")
+    start = time.perf_counter()
+    df = pd.read_csv(csv_path, usecols=['emotion', 'pixels', 'Usage'])
+    
+    # Group rows by split so each split is a contiguous (zero-copy) slice of the cache
+    order = {usage: i for i, usage in enumerate(SPLITS)}
+    df = df[df['Usage'].isin(order)]
+    df = df.iloc[np.argsort(df['Usage'].map(order).values, kind='stable')]
+    
+    pixels = parse_pixels(df['pixels'])
+    labels = df['emotion'].values.astype(np.uint8)
+    counts = df['Usage'].value_counts()
+    
+    splits = {}
+    offset = 0
+    for usage in SPLITS:
+        count = int(counts.get(usage, 0))
+        splits[usage] = [offset, offset + count]
+        offset += count
+    
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(os.path.join(cache_dir, 'pixels.npy'), pixels)
+    np.save(os.path.join(cache_dir, 'labels.npy'), labels)
+    st = os.stat(csv_path)
+    with open(os.path.join(cache_dir, 'meta.json'), 'w') as f:
+        json.dump({
+            'source': os.path.abspath(csv_path),
+            'source_size': st.st_size,
+            'source_mtime': st.st_mtime,
+            'splits': splits
+        }, f, indent=2)
+    
+    print(f"Cached {len(pixels)} images to {cache_dir}/ in {time.perf_counter() - start:.1f}s "
+          f"({pixels.nbytes / (1024 * 1024):.0f} MB uint8)")
+
+def _cache_is_fresh(csv_path, cache_dir):
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return False
+    if not os.path.exists(csv_path):
+        return True  # The cache is all we have
+    with open(meta_path) as f:
+        meta = json.load(f)
+    st = os.stat(csv_path)
+    return meta.get('source_size') == st.st_size and meta.get('source_mtime') == st.st_mtime
+
+def load_fer2013_cached(csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR, mmap=True):
+    """
+    Load FER2013 from the binary cache, building it first if it is missing
+    or older than the CSV. Returns {usage: (pixels, labels)} where pixels is
+    a uint8 (n, 48, 48, 1) view into the memory-mapped cache; normalize per
+    batch rather than converting a whole split to float32.
+    """
+    if not _cache_is_fresh(csv_path, cache_dir):
+        build_dataset_cache(csv_path, cache_dir)
+    
+    mmap_mode = 'r' if mmap else None
+    pixels = np.load(os.path.join(cache_dir, 'pixels.npy'), mmap_mode=mmap_mode)
+    labels = np.load(os.path.join(cache_dir, 'labels.npy'))
+    with open(os.path.join(cache_dir, 'meta.json')) as f:
+        splits = json.load(f)['splits']
+    
+    pixels = pixels.reshape(-1, 48, 48, 1)
+    return {usage: (pixels[start:end], labels[start:end]) for usage, (start, end) in splits.items()}
+
+def load_fer2013_data(csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR):
     """
     Load and preprocess FER2013 dataset from CSV file.
     
@@ -32,77 +146,170 @@ def load_fer2013_data(csv_path='fer2013.csv'):
     - emotion: 0-6 (Angry, Disgust, Fear, Happy, Sad, Surprise, Neutral)
     - pixels: space-separated pixel values (48x48 grayscale image)
     - Usage: 'Training', 'PublicTest', or 'PrivateTest'
+    
+    Returns raw uint8 images (the models rescale them) with one-hot labels.
+    Training uses load_fer2013_cached() instead, which memory-maps the images.
     """
     print("Loading FER2013 dataset...")
+    data = load_fer2013_cached(csv_path, cache_dir)
     
-    if not os.path.exists(csv_path):
-        raise FileNotFoundError(
-            f"FER2013 CSV file not found at {csv_path}\n"
-            "Please download fer2013.csv from Kaggle and place it in the project root."
-        )
+    result = []
+    for usage in SPLITS:
+        X, y = data[usage]
+        result.append((np.array(X), to_categorical(y, num_classes=7)))
     
-    # Read CSV
-    df = pd.read_csv(csv_path)
+    print(f"Training samples: {len(result[0][0])}")
+    print(f"Validation samples: {len(result[1][0])}")
+    print(f"Test samples: {len(result[2][0])}")
     
-    # Split by usage
-    train_df = df[df['Usage'] == 'Training']
-    val_df = df[df['Usage'] == 'PublicTest']
-    test_df = df[df['Usage'] == 'PrivateTest']
+    return tuple(result)
+
+def make_dataset(images, labels, batch_size=64, training=False, augment=False,
+                 cache_path=None, shuffle_buffer=4096, chunk_size=1024, seed=None):
+    """
+    Build a streaming tf.data pipeline over uint8 FER2013 arrays.
     
-    # Convert pixel strings to numpy arrays
-    def pixels_to_array(pixel_str):
-        return np.array([int(pixel) for pixel in pixel_str.split()], dtype=np.float32)
+    Rows are read from the (memory-mapped) arrays in chunks, optionally cached
+    to disk, shuffled, batched, and then one-hot encoded and augmented
+    (random flips, shifts and rotations) per batch with parallel map and
+    prefetch. Images stay raw 0-255 pixels (uint8 unless augmented): the
+    model rescales them itself, exactly as it does when serving.
+    With a seed, the sample order and augmentations are reproducible.
+    """
+    num_samples = len(images)
+    rng = np.random.RandomState(seed) if seed is not None else np.random
     
-    # Process training data
-    print("Processing training data...")
-    X_train = np.array([pixels_to_array(pixels) for pixels in train_df['pixels']])
-    y_train = train_df['emotion'].values
+    def chunks():
+        starts = np.arange(0, num_samples, chunk_size)
+        if training and not cache_path:
+            # Visit chunks in a new order each epoch; the shuffle buffer mixes within them
+            rng.shuffle(starts)
+        for start in starts:
+            yield images[start:start + chunk_size], labels[start:start + chunk_size]
     
-    # Process validation data
-    print("Processing validation data...")
-    X_val = np.array([pixels_to_array(pixels) for pixels in val_df['pixels']])
-    y_val = val_df['emotion'].values
+    dataset = tf.data.Dataset.from_generator(
+        chunks,
+        output_signature=(
+            tf.TensorSpec(shape=(None, 48, 48, 1), dtype=tf.uint8),
+            tf.TensorSpec(shape=(None,), dtype=tf.uint8)
+        )
+    ).unbatch()
+    dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_samples))
     
-    # Process test data
-    print("Processing test data...")
-    X_test = np.array([pixels_to_array(pixels) for pixels in test_df['pixels']])
-    y_test = test_df['emotion'].values
+    if cache_path:
+        # The cache is filled in the source's fixed order, so every epoch (resumed
+        # or not) reads the same rows; chunks are shuffled after it instead. That
+        # shuffle buffer holds every chunk, i.e. the whole split in memory
+        dataset = dataset.cache(cache_path)
+        if training:
+            num_chunks = -(-num_samples // chunk_size)
+            dataset = dataset.batch(chunk_size).shuffle(num_chunks, seed=seed).unbatch()
+            dataset = dataset.apply(tf.data.experimental.assert_cardinality(num_samples))
+    if training:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
     
-    # Reshape to (samples, 48, 48, 1) for CNN input
-    X_train = X_train.reshape(-1, 48, 48, 1)
-    X_val = X_val.reshape(-1, 48, 48, 1)
-    X_test = X_test.reshape(-1, 48, 48, 1)
+    augmentation = None
+    if augment:
+        augmentation = keras.Sequential([
+            keras.layers.RandomFlip('horizontal', seed=seed),
+            keras.layers.RandomTranslation(0.1, 0.1, fill_mode='nearest', seed=seed),
+            keras.layers.RandomRotation(0.05, fill_mode='nearest', seed=seed)
+        ])
     
-    # Normalize pixel values to [0, 1]
-    X_train = X_train / 255.0
-    X_val = X_val / 255.0
-    X_test = X_test / 255.0
+    def prepare(X, y):
+        # One-hot encode labels per batch; rescaling is part of the model
+        if augmentation is not None:
+            X = augmentation(tf.cast(X, tf.float32), training=True)
+        return X, tf.one_hot(tf.cast(y, tf.int32), 7)
     
-    # One-hot encode labels
-    y_train = to_categorical(y_train, num_classes=7)
-    y_val = to_categorical(y_val, num_classes=7)
-    y_test = to_categorical(y_test, num_classes=7)
+    dataset = dataset.map(prepare, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+class ThroughputLogger(Callback):
+    """Reports training throughput (images/sec) at the end of every epoch"""
+    
+    def __init__(self, num_samples):
+        super().__init__()
+        self.num_samples = num_samples
+        self._epoch_start = None
+        self.elapsed = None
     
-    print(f"Training samples: {len(X_train)}")
-    print(f"Validation samples: {len(X_val)}")
-    print(f"Test samples: {len(X_test)}")
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
     
-    return (X_train, y_train), (X_val, y_val), (X_test, y_test)
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.perf_counter() - self._epoch_start
+        self.elapsed = elapsed
+        images_per_sec = self.num_samples / elapsed
+        print(f"Epoch {epoch + 1}: {elapsed:.1f}s, {images_per_sec:.0f} images/sec")
+        if logs is not None:
+            logs['images_per_sec'] = images_per_sec
 
-def create_model(input_shape=(48, 48, 1), num_classes=7):
+def benchmark_loading(csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR):
+    """Print wall time and peak traced memory for CSV parsing versus cache loading"""
+    def measure(label, fn):
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<36}{elapsed:>10.2f}s{peak / (1024 * 1024):>12.1f} MB peak")
+        return result
+    
+    def legacy_csv():
+        # The original per-pixel Python loop, kept only as a baseline
+        df = pd.read_csv(csv_path)
+        return np.array([
+            np.array([int(pixel) for pixel in pixels.split()], dtype=np.float32)
+            for pixels in df['pixels']
+        ]) / 255.0
+    
+    def cached_float32():
+        return [X.astype(np.float32) / 255.0 for X, _ in load_fer2013_cached(csv_path, cache_dir).values()]
+    
+    print("=" * 60)
+    print(f"{'Loader':<36}{'Time':>11}{'Memory':>20}")
+    print("=" * 60)
+    measure("CSV, per-pixel Python loop", legacy_csv)
+    measure("Build cache (vectorized parse)", lambda: build_dataset_cache(csv_path, cache_dir))
+    measure("Load cache (memory-mapped uint8)", lambda: load_fer2013_cached(csv_path, cache_dir))
+    measure("Load cache + full float32 copies", cached_float32)
+
+def preprocessing_layers(image_size=48):
+    """
+    Input and preprocessing layers shared by every architecture: grayscale
+    images of any size with raw 0-255 pixels, resized to image_size and
+    rescaled to [0, 1] inside the graph
+    """
+    return [
+        keras.Input(shape=(None, None, 1)),
+        Resizing(image_size, image_size),
+        Rescaling(1.0 / 255)
+    ]
+
+def with_preprocessing(model):
+    """Wrap a model trained on [0, 1] inputs (before preprocessing was embedded) to take raw pixels"""
+    if takes_raw_pixels(model):
+        return model
+    return Sequential(preprocessing_layers() + [model])
+
+def create_model(num_classes=7):
     """
     Create a CNN model for emotion recognition.
     
     Architecture:
+    - Preprocessing layers (resize to 48x48, rescale to [0, 1])
     - Conv2D layers with increasing filters
     - MaxPooling after each conv block
     - BatchNormalization for stability
     - Dropout to prevent overfitting
     - Dense layers for classification
     """
-    model = Sequential([
+    model = Sequential(preprocessing_layers() + [
         # First Conv Block
-        Conv2D(32, (3, 3), activation='relu', input_shape=input_shape, padding='same'),
+        Conv2D(32, (3, 3), activation='relu', padding='same'),
         BatchNormalization(),
         Conv2D(32, (3, 3), activation='relu', padding='same'),
         MaxPooling2D(pool_size=(2, 2)),
@@ -130,79 +337,538 @@ def create_model(input_shape=(48, 48, 1), num_classes=7):
         Dense(256, activation='relu'),
         BatchNormalization(),
         Dropout(0.5),
-        Dense(num_classes, activation='softmax')
+        # Softmax in float32 also under a mixed precision policy
+        Dense(num_classes, activation='softmax', dtype='float32')
     ])
     
     return model
 
-def train_model():
+def create_student_model(filters=(32, 64, 128), num_classes=7):
+    """
+    Create a small student model for distillation.
+    
+    Architecture:
+    - The same preprocessing layers as create_model
+    - One regular Conv2D stem
+    - Per block: two SeparableConv2D (depthwise + pointwise) layers and MaxPooling
+    - GlobalAveragePooling instead of the Flatten -> 512 -> 256 dense head
+    """
+    layers = preprocessing_layers() + [
+        Conv2D(filters[0], (3, 3), padding='same', use_bias=False),
+        BatchNormalization(),
+        Activation('relu')
+    ]
+    for block_filters in filters:
+        for _ in range(2):
+            layers += [
+                SeparableConv2D(block_filters, (3, 3), padding='same', use_bias=False),
+                BatchNormalization(),
+                Activation('relu')
+            ]
+        layers.append(MaxPooling2D(pool_size=(2, 2)))
+    layers += [
+        GlobalAveragePooling2D(),
+        Dropout(0.3),
+        Dense(num_classes, activation='softmax')
+    ]
+    return Sequential(layers)
+
+class Distiller(keras.Model):
+    """
+    Trains a student on a mix of the hard labels and the teacher's softened
+    predictions: alpha * CE(labels) + (1 - alpha) * T^2 * KL(teacher_T || student_T).
+    Both models end in softmax, so their log-probabilities serve as logits.
+    """
+    
+    def __init__(self, student, teacher, alpha=0.1, temperature=4.0):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher
+        self.teacher.trainable = False
+        self.alpha = alpha
+        self.temperature = temperature
+    
+    def call(self, x, training=False):
+        return self.student(x, training=training)
+    
+    def compute_loss(self, x=None, y=None, y_pred=None, sample_weight=None, training=True):
+        teacher_probs = self.teacher(x, training=False)
+        soft_teacher = tf.nn.softmax(tf.math.log(teacher_probs + 1e-7) / self.temperature)
+        soft_student = tf.nn.softmax(tf.math.log(y_pred + 1e-7) / self.temperature)
+        kl = tf.reduce_sum(soft_teacher * (tf.math.log(soft_teacher + 1e-7) - tf.math.log(soft_student + 1e-7)), axis=-1)
+        soft_loss = kl * self.temperature ** 2
+        hard_loss = keras.losses.categorical_crossentropy(y, y_pred)
+        return tf.reduce_mean(self.alpha * hard_loss + (1 - self.alpha) * soft_loss)
+
+def _prunable_weights(model):
+    """Convolution and dense kernels, except the final classifier"""
+    weights = []
+    for layer in model.layers[:-1]:
+        for attr in ('kernel', 'depthwise_kernel', 'pointwise_kernel'):
+            weight = getattr(layer, attr, None)
+            if weight is not None:
+                weights.append(weight)
+    return weights
+
+class MagnitudePruning(Callback):
+    """
+    Gradual magnitude pruning without extra dependencies: at the start of
+    each epoch the smallest weights of every kernel are masked, with sparsity
+    ramping up to target_sparsity (cubic schedule), and the masks are
+    re-applied after every batch so pruned weights stay zero.
+    """
+    
+    def __init__(self, model, target_sparsity, ramp_epochs):
+        super().__init__()
+        self.pruned_model = model  # The student; the model being fit may wrap it
+        self.target_sparsity = target_sparsity
+        self.ramp_epochs = max(1, ramp_epochs)
+        self._masks = []
+    
+    def on_epoch_begin(self, epoch, logs=None):
+        progress = min(1.0, (epoch + 1) / self.ramp_epochs)
+        sparsity = self.target_sparsity * (1 - (1 - progress) ** 3)
+        self._masks = []
+        for weight in _prunable_weights(self.pruned_model):
+            values = weight.numpy()
+            threshold = np.quantile(np.abs(values), sparsity)
+            self._masks.append((weight, (np.abs(values) > threshold).astype(values.dtype)))
+        self._apply()
+        print(f"Epoch {epoch + 1}: pruning to {sparsity:.0%} sparsity")
+    
+    def on_train_batch_end(self, batch, logs=None):
+        self._apply()
+    
+    def _apply(self):
+        for weight, mask in self._masks:
+            weight.assign(weight.numpy() * mask)
+
+def model_sparsity(model):
+    """Fraction of exactly-zero weights in the prunable kernels"""
+    weights = [w.numpy() for w in _prunable_weights(model)]
+    total = sum(w.size for w in weights)
+    return float(sum((w == 0).sum() for w in weights) / total) if total else 0.0
+
+def gzipped_size(path):
+    """Size of the file after gzip; pruned (sparse) weights only shrink compressed"""
+    with open(path, 'rb') as f:
+        return len(gzip.compress(f.read(), 6))
+
+def measure_candidate(name, model_path, images, labels, teacher_predictions=None):
+    """Parameter count, file size, single-image CPU latency and test accuracy of a saved model"""
+    from types import SimpleNamespace
+    from export_model import measure_backend
+    
+    # Same call as the keras serving backend (TensorFlow threads are already configured here)
+    model = keras.models.load_model(model_path, compile=False)
+    serving = with_preprocessing(model)
+    backend = SimpleNamespace(predict=lambda batch: np.asarray(serving.predict_on_batch(batch)))
+    measured = measure_backend(backend, images, labels)
+    report = {
+        'name': name,
+        'path': model_path,
+        'params': int(model.count_params()),
+        'size_kb': os.path.getsize(model_path) / 1024,
+        'gzip_kb': gzipped_size(model_path) / 1024,
+        'sparsity': model_sparsity(model),
+        'latency_ms_p50': measured['latency_ms_p50'],
+        'latency_ms_p99': measured['latency_ms_p99'],
+        'accuracy': measured['accuracy'],
+        'agreement_with_teacher': None
+    }
+    if teacher_predictions is not None:
+        report['agreement_with_teacher'] = float((measured['predictions'] == teacher_predictions).mean())
+    return report, measured['predictions']
+
+def distill_students(teacher_path='face_emotionModel.h5', students=tuple(STUDENT_ARCHITECTURES),
+                     csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR, output_dir='students',
+                     epochs=30, alpha=0.1, temperature=4.0, prune=0.0, prune_epochs=10,
+                     latency_budget_ms=None, augment=True):
+    """
+    Distill the trained model into each student architecture (and, with
+    prune > 0, a magnitude-pruned copy of each), save them to output_dir and
+    write output_dir/report.json comparing every candidate with the teacher.
+    """
+    print("=" * 60)
+    print("KNOWLEDGE DISTILLATION")
+    print("=" * 60)
+    os.makedirs(output_dir, exist_ok=True)
+    data = load_fer2013_cached(csv_path, cache_dir)
+    val_batches = make_dataset(*data['PublicTest'], batch_size=64)
+    test_images = np.array(data['PrivateTest'][0])
+    test_labels = data['PrivateTest'][1].astype(np.int64)
+    
+    # Students take raw pixels; so must the teacher, whichever way it was trained
+    teacher = with_preprocessing(keras.models.load_model(teacher_path, compile=False))
+    reports = []
+    teacher_report, teacher_predictions = measure_candidate('teacher', teacher_path, test_images, test_labels)
+    reports.append(teacher_report)
+    
+    for name in students:
+        print(f"\nDistilling {name} {STUDENT_ARCHITECTURES[name]}...")
+        student = create_student_model(STUDENT_ARCHITECTURES[name])
+        distiller = Distiller(student, teacher, alpha=alpha, temperature=temperature)
+        distiller.compile(optimizer='adam', metrics=['accuracy'])
+        train_batches = make_dataset(*data['Training'], batch_size=64, training=True, augment=augment)
+        distiller.fit(
+            train_batches,
+            epochs=epochs,
+            validation_data=val_batches,
+            callbacks=[EarlyStopping(monitor='val_accuracy', mode='max', patience=5, restore_best_weights=True)],
+            verbose=2
+        )
+        student_path = os.path.join(output_dir, f'{name}.h5')
+        student.save(student_path)
+        report, _ = measure_candidate(name, student_path, test_images, test_labels, teacher_predictions)
+        reports.append(report)
+        
+        if prune > 0:
+            print(f"\nPruning {name} to {prune:.0%} sparsity...")
+            pruned_path = os.path.join(output_dir, f'{name}-pruned{int(prune * 100)}.h5')
+            distiller.compile(optimizer=keras.optimizers.Adam(1e-4), metrics=['accuracy'])
+            distiller.fit(
+                train_batches,
+                epochs=prune_epochs,
+                validation_data=val_batches,
+                callbacks=[MagnitudePruning(student, prune, ramp_epochs=max(1, prune_epochs - 2))],
+                verbose=2
+            )
+            student.save(pruned_path)
+            report, _ = measure_candidate(f'{name}-pruned{int(prune * 100)}', pruned_path,
+                                          test_images, test_labels, teacher_predictions)
+            reports.append(report)
+    
+    for report in reports:
+        report['within_budget'] = (latency_budget_ms is None or report['latency_ms_p50'] <= latency_budget_ms)
+    eligible = [r for r in reports if r['within_budget'] and r['name'] != 'teacher']
+    best = max(eligible, key=lambda r: r['accuracy']) if eligible else None
+    
+    print("\n" + "=" * 100)
+    print(f"{'Candidate':<20}{'Params':>10}{'Size KB':>10}{'Gzip KB':>10}{'Sparsity':>10}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'Accuracy':>10}{'Agree':>8}{'Budget':>8}")
+    print("=" * 100)
+    for r in reports:
+        agreement = f"{r['agreement_with_teacher']:.0%}" if r['agreement_with_teacher'] is not None else '-'
+        print(f"{r['name']:<20}{r['params']:>10,}{r['size_kb']:>10.0f}{r['gzip_kb']:>10.0f}{r['sparsity']:>10.0%}"
+              f"{r['latency_ms_p50']:>9.2f}{r['latency_ms_p99']:>9.2f}{r['accuracy']:>10.4f}{agreement:>8}"
+              f"{'yes' if r['within_budget'] else 'no':>8}")
+    if best is not None:
+        print(f"\nMost accurate student within budget: {best['name']} ({best['path']}). To serve it:")
+        print(f"  cp {best['path']} face_emotionModel.h5 && python export_model.py --formats tflite --evaluate")
+    else:
+        print(f"\nNo student meets the {latency_budget_ms} ms latency budget")
+    
+    report_path = os.path.join(output_dir, 'report.json')
+    with open(report_path, 'w') as f:
+        json.dump({
+            'teacher': teacher_path,
+            'latency_budget_ms': latency_budget_ms,
+            'alpha': alpha,
+            'temperature': temperature,
+            'candidates': reports,
+            'recommended': best['name'] if best else None
+        }, f, indent=2)
+    print(f"Report written to {report_path}")
+    return reports
+
+def check_preprocessing(model_path='face_emotionModel.h5', csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR,
+                        samples=256):
+    """
+    Check that training and serving feed the model the same inputs. Test rows
+    go through make_dataset() as in training, and through the app's path as
+    PNG uploads (decode_image, prepare_face). The raw pixels, their rescaled
+    values (model layers vs preprocess_batch) and the predictions of the
+    keras serving backend vs model.predict must all match. Returns True if
+    they do.
+    """
+    import cv2
+    from inference_backends import load_backend
+    from preprocessing import decode_image, prepare_face, preprocess_batch
+    
+    images, labels = load_fer2013_cached(csv_path, cache_dir)['PrivateTest']
+    images, labels = images[:samples], labels[:samples]
+    model = with_preprocessing(keras.models.load_model(model_path, compile=False))
+    
+    training_inputs = np.concatenate([X.numpy() for X, _ in make_dataset(images, labels, batch_size=64)])
+    serving_inputs = np.stack([
+        prepare_face(decode_image(cv2.imencode('.png', image)[1].tobytes())) for image in images
+    ])
+    rescale = Sequential(model.layers[:2])  # Resizing, Rescaling
+    graph_rescaled = rescale(training_inputs.astype(np.float32)).numpy()
+    
+    backend = load_backend('keras', model_path)
+    checks = {
+        'raw pixels (make_dataset vs decode_image + prepare_face)':
+            np.array_equal(training_inputs, serving_inputs),
+        'rescaled pixels (model layers vs preprocess_batch)':
+            np.array_equal(graph_rescaled, preprocess_batch(serving_inputs)),
+        'predictions (model.predict vs keras serving backend)':
+            np.allclose(model.predict(make_dataset(images, labels, batch_size=64), verbose=0),
+                        backend.predict(serving_inputs), atol=1e-5),
+    }
+    print(f"Preprocessing parity on {len(images)} test images ({model_path}):")
+    for name, ok in checks.items():
+        print(f"  {'OK  ' if ok else 'FAIL'} {name}")
+    return all(checks.values())
+
+def cpu_supports_bf16():
+    """True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)"""
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def configure_training(intra_op_threads=0, inter_op_threads=0, mixed_precision=False):
+    """
+    Set TensorFlow thread pools (0 keeps TensorFlow's default) and the Keras
+    precision policy. Must run before TensorFlow executes any op.
+    Returns the policy name in use.
+    """
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    policy = 'float32'
+    if mixed_precision:
+        if cpu_supports_bf16() or tf.config.list_physical_devices('GPU'):
+            policy = 'mixed_bfloat16'
+        else:
+            print("This CPU has no native bfloat16 support (AVX512-BF16/AMX); training in float32")
+    keras.mixed_precision.set_global_policy(policy)
+    return policy
+
+def save_serving_model(model, path):
+    """
+    Save a float32 copy of the model as .h5 (the app never runs in mixed
+    precision). Saving a copy also keeps the training model's compile config:
+    an .h5 save drops its optimizer, which the next state checkpoint needs.
+    """
+    policy = keras.mixed_precision.global_policy().name
+    keras.mixed_precision.set_global_policy('float32')
+    try:
+        serving = create_model()
+        serving.set_weights(model.get_weights())
+        serving.save(path)
+    finally:
+        keras.mixed_precision.set_global_policy(policy)
+
+def _all_layers(model, seen=None):
+    """Every layer of a model, those of nested models included, depth first"""
+    seen = set() if seen is None else seen
+    for layer in model.layers:
+        if id(layer) in seen:
+            continue
+        seen.add(id(layer))
+        yield layer
+        if hasattr(layer, 'layers'):
+            yield from _all_layers(layer, seen)
+
+def reseed_model(model, seed):
+    """
+    Reset the random state of the model's Dropout layers. Their seed
+    generators are not part of a saved model, so a resumed run reseeds them
+    at every epoch exactly like an uninterrupted one.
+    """
+    index = 0
+    for layer in _all_layers(model):
+        generator = getattr(layer, 'seed_generator', None)
+        if generator is not None:
+            generator.state.assign(np.array([seed * 1000 + index, 0], dtype=generator.state.dtype))
+            index += 1
+
+def _write_json_atomic(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+def train_model(csv_path='fer2013.csv', cache_dir=DATASET_CACHE_DIR, augment=True, data_cache=None,
+                epochs=50, batch_size=64, grad_accum_steps=1, intra_op_threads=0, inter_op_threads=0,
+                mixed_precision=False, checkpoint_dir='training_checkpoint', checkpoint_every=1,
+                resume=False, seed=42, output_path='face_emotionModel.h5'):
     """
     Main training function.
     Loads data, creates model, trains, and saves the model.
+    Training batches are streamed through a tf.data pipeline with on-the-fly
+    augmentation; data_cache optionally caches decoded samples on disk.
+    
+    Every checkpoint_every epochs the full training state (weights, optimizer
+    slots and accumulators, epoch, early-stopping counters) is saved to
+    checkpoint_dir. Each epoch's shuffle order and augmentations are seeded
+    from (seed, epoch), so resume=True continues exactly where it stopped.
+    Gradients are accumulated over grad_accum_steps batches, for an
+    effective batch of batch_size * grad_accum_steps.
     """
     print("=" * 60)
     print("FACIAL EMOTION RECOGNITION MODEL TRAINING")
     print("=" * 60)
     
-    # Load data
-    (X_train, y_train), (X_val, y_val), (X_test, y_test) = load_fer2013_data()
+    # Before any TensorFlow op runs
+    policy = configure_training(intra_op_threads, inter_op_threads, mixed_precision)
+    print(f"Threads: intra-op {intra_op_threads or 'default'}, inter-op {inter_op_threads or 'default'}; "
+          f"precision policy: {policy}; effective batch size: {batch_size * grad_accum_steps}")
+    
+    # Load data as uint8 from the binary cache; batches are normalized on the fly
+    print("Loading FER2013 dataset...")
+    data = load_fer2013_cached(csv_path, cache_dir)
+    val_batches = make_dataset(*data['PublicTest'], batch_size=batch_size)
+    test_batches = make_dataset(*data['PrivateTest'], batch_size=batch_size)
+    num_train = len(data['Training'][0])
+    print(f"Training samples: {num_train}")
+    print(f"Validation samples: {len(data['PublicTest'][0])}")
+    print(f"Test samples: {len(data['PrivateTest'][0])}")
     
-    # Create model
-    print("\nCreating CNN model...")
-    model = create_model()
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    state_model_path = os.path.join(checkpoint_dir, 'state.keras')
+    state_path = os.path.join(checkpoint_dir, 'state.json')
+    log_path = os.path.join(checkpoint_dir, 'epochs.jsonl')
     
-    # Compile model
-    model.compile(
-        optimizer='adam',
-        loss='categorical_crossentropy',
-        metrics=['accuracy']
-    )
+    state = {'epoch': 0, 'seed': seed, 'best_val_accuracy': None, 'best_val_loss': None, 'wait': 0}
+    if resume and os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        print(f"\nResuming from {checkpoint_dir} after epoch {state['epoch']}...")
+        model = keras.models.load_model(state_model_path)
+        if not takes_raw_pixels(model):
+            raise SystemExit(f"The checkpoint in {checkpoint_dir} predates embedded preprocessing; "
+                             f"train from scratch instead of --resume")
+    else:
+        if resume:
+            print(f"\nNo checkpoint in {checkpoint_dir}; starting from scratch")
+        elif os.path.exists(log_path):
+            os.remove(log_path)
+        # Create model
+        print("\nCreating CNN model...")
+        keras.utils.set_random_seed(seed)
+        model = create_model()
+        
+        # Compile model
+        model.compile(
+            optimizer=keras.optimizers.Adam(
+                gradient_accumulation_steps=grad_accum_steps if grad_accum_steps > 1 else None
+            ),
+            loss='categorical_crossentropy',
+            metrics=['accuracy']
+        )
     
     print("\nModel Architecture:")
     model.summary()
     
-    # Callbacks
-    checkpoint = ModelCheckpoint(
-        'face_emotionModel.h5',
-        monitor='val_accuracy',
-        save_best_only=True,
-        mode='max',
-        verbose=1
-    )
-    
-    early_stop = EarlyStopping(
-        monitor='val_loss',
-        patience=10,
-        restore_best_weights=True,
-        verbose=1
-    )
-    
     # Train model
     print("\n" + "=" * 60)
     print("Starting training...")
     print("=" * 60)
     
-    history = model.fit(
-        X_train, y_train,
-        batch_size=64,
-        epochs=50,
-        validation_data=(X_val, y_val),
-        callbacks=[checkpoint, early_stop],
-        verbose=1
-    )
+    patience = 10
+    for epoch in range(state['epoch'], epochs):
+        # Reseed per epoch: the order and augmentations of epoch n do not depend on a restart
+        keras.utils.set_random_seed(state['seed'] + epoch)
+        reseed_model(model, state['seed'] + epoch)
+        train_batches = make_dataset(*data['Training'], batch_size=batch_size, training=True,
+                                     augment=augment, cache_path=data_cache, seed=state['seed'] + epoch)
+        throughput = ThroughputLogger(num_train)
+        history = model.fit(
+            train_batches,
+            initial_epoch=epoch,
+            epochs=epoch + 1,
+            validation_data=val_batches,
+            callbacks=[throughput],
+            verbose=1
+        )
+        logs = {name: float(values[-1]) for name, values in history.history.items()}
+        
+        # Best-model checkpoint (val_accuracy) and early stopping (val_loss), as before
+        if state['best_val_accuracy'] is None or logs['val_accuracy'] > state['best_val_accuracy']:
+            print(f"Epoch {epoch + 1}: val_accuracy improved to {logs['val_accuracy']:.4f}, saving {output_path}")
+            state['best_val_accuracy'] = logs['val_accuracy']
+            save_serving_model(model, output_path)
+        if state['best_val_loss'] is None or logs['val_loss'] < state['best_val_loss']:
+            state['best_val_loss'] = logs['val_loss']
+            state['wait'] = 0
+        else:
+            state['wait'] += 1
+        state['epoch'] = epoch + 1
+        
+        with open(log_path, 'a') as f:
+            f.write(json.dumps(dict(logs, epoch=epoch + 1, seconds=throughput.elapsed)) + '\n')
+        if state['epoch'] % checkpoint_every == 0 or state['epoch'] == epochs or state['wait'] >= patience:
+            model.save(state_model_path + '.tmp.keras')
+            os.replace(state_model_path + '.tmp.keras', state_model_path)
+            _write_json_atomic(state_path, state)
+        if state['wait'] >= patience:
+            print(f"Epoch {epoch + 1}: early stopping (val_loss has not improved for {patience} epochs)")
+            break
     
     # Evaluate on test set
     print("\n" + "=" * 60)
     print("Evaluating on test set...")
     print("=" * 60)
-    model.load_weights('face_emotionModel.h5')
-    test_loss, test_accuracy = model.evaluate(X_test, y_test, verbose=1)
+    best = keras.models.load_model(output_path, compile=False)
+    best.compile(loss='categorical_crossentropy', metrics=['accuracy'])
+    test_loss, test_accuracy = best.evaluate(test_batches, verbose=1)
     print(f"\nTest Accuracy: {test_accuracy:.4f} ({test_accuracy*100:.2f}%)")
     
     print("\n" + "=" * 60)
-    print("Training completed! Model saved as 'face_emotionModel.h5'")
+    print(f"Training completed! Model saved as '{output_path}'")
     print("=" * 60)
 
 if __name__ == '__main__':
-    train_model()
+    parser = argparse.ArgumentParser(description='Train the FER2013 emotion recognition model')
+    parser.add_argument('--csv', default='fer2013.csv', help='Path to fer2013.csv')
+    parser.add_argument('--cache-dir', default=DATASET_CACHE_DIR, help='Binary dataset cache directory')
+    parser.add_argument('--build-cache', action='store_true', help='Only convert the CSV to the binary cache')
+    parser.add_argument('--benchmark-loading', action='store_true',
+                        help='Compare CSV parsing with cache loading (time and peak memory)')
+    parser.add_argument('--no-augment', action='store_true', help='Disable random flips, shifts and rotations')
+    parser.add_argument('--data-cache', default=None,
+                        help='File prefix for an on-disk tf.data cache of training samples '
+                             '(shuffling the cached rows holds the training split in memory)')
+    parser.add_argument('--distill', action='store_true',
+                        help='Distill face_emotionModel.h5 into smaller students and report on them')
+    parser.add_argument('--teacher', default='face_emotionModel.h5', help='Teacher model for --distill')
+    parser.add_argument('--students', nargs='+', choices=list(STUDENT_ARCHITECTURES),
+                        default=list(STUDENT_ARCHITECTURES), help='Student architectures to distill')
+    parser.add_argument('--epochs', type=int, default=None, help='Training epochs (default 50; 30 per student)')
+    parser.add_argument('--batch-size', type=int, default=64, help='Batch size per step')
+    parser.add_argument('--grad-accum-steps', type=int, default=1,
+                        help='Accumulate gradients over this many batches per optimizer update')
+    parser.add_argument('--intra-op-threads', type=int, default=0, help='Threads per op (0: TensorFlow default)')
+    parser.add_argument('--inter-op-threads', type=int, default=0, help='Ops run in parallel (0: TensorFlow default)')
+    parser.add_argument('--mixed-precision', action='store_true',
+                        help='Train in bfloat16 mixed precision (CPUs with AVX512-BF16/AMX)')
+    parser.add_argument('--checkpoint-dir', default='training_checkpoint', help='Full training state for --resume')
+    parser.add_argument('--checkpoint-every', type=int, default=1, help='Epochs between training state checkpoints')
+    parser.add_argument('--resume', action='store_true', help='Continue from the state in --checkpoint-dir')
+    parser.add_argument('--seed', type=int, default=42, help='Seed for shuffling, augmentation and initialization')
+    parser.add_argument('--alpha', type=float, default=0.1, help='Weight of the hard-label loss')
+    parser.add_argument('--temperature', type=float, default=4.0, help='Softmax temperature')
+    parser.add_argument('--prune', type=float, default=0.0,
+                        help='Also fine-tune a magnitude-pruned copy of each student at this sparsity (e.g. 0.5)')
+    parser.add_argument('--prune-epochs', type=int, default=10, help='Fine-tuning epochs while pruning')
+    parser.add_argument('--latency-budget-ms', type=float, default=None,
+                        help='Single-image CPU latency budget (p50) for the recommended student')
+    parser.add_argument('--output-dir', default='students', help='Where students and report.json go')
+    parser.add_argument('--check-preprocessing', nargs='?', const='face_emotionModel.h5', default=None,
+                        metavar='MODEL', help='Check that training and serving preprocess images identically')
+    args = parser.parse_args()
+    
+    if args.check_preprocessing:
+        raise SystemExit(0 if check_preprocessing(args.check_preprocessing, args.csv, args.cache_dir) else 1)
+    elif args.distill:
+        distill_students(args.teacher, args.students, args.csv, args.cache_dir, args.output_dir,
+                         epochs=args.epochs or 30, alpha=args.alpha, temperature=args.temperature,
+                         prune=args.prune, prune_epochs=args.prune_epochs,
+                         latency_budget_ms=args.latency_budget_ms, augment=not args.no_augment)
+    elif args.build_cache:
+        build_dataset_cache(args.csv, args.cache_dir)
+    elif args.benchmark_loading:
+        benchmark_loading(args.csv, args.cache_dir)
+    else:
+        train_model(args.csv, args.cache_dir, augment=not args.no_augment, data_cache=args.data_cache,
+                    epochs=args.epochs or 50, batch_size=args.batch_size, grad_accum_steps=args.grad_accum_steps,
+                    intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads,
+                    mixed_precision=args.mixed_precision, checkpoint_dir=args.checkpoint_dir,
+                    checkpoint_every=args.checkpoint_every, resume=args.resume, seed=args.seed)
 
@@ -0,0 +1,232 @@
+"""
+Content-addressed prediction cache.
+Analysis results (per-face emotions and confidences) are keyed by the
+SHA-256 of the uploaded image bytes together with the model version, so
+re-submitted photos skip decode, face detection and the forward pass.
+An in-process LRU tier can be backed by a persistent tier stored in the
+SQLite database (see storage.py).
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+def hash_image(image_bytes):
+    """Return the hex SHA-256 digest identifying an uploaded image"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class ModelFileVersion:
+    """
+    Callable returning a version string for a model file.
+    The file is re-hashed only when its size or mtime changes, and stat()
+    is called at most once per check_interval seconds.
+    """
+
+    def __init__(self, model_path, check_interval=1.0):
+        self.model_path = model_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def __call__(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return self._version
+        with self._lock:
+            self._checked_at = now
+            try:
+                st = os.stat(self.model_path)
+            except OSError:
+                self._signature, self._version = None, None
+                return None
+            signature = (st.st_size, st.st_mtime_ns)
+            if signature != self._signature:
+                digest = hashlib.sha256()
+                with open(self.model_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+                self._signature = signature
+                self._version = digest.hexdigest()[:16]
+            return self._version
+
+
+class PredictionCache:
+    """
+    Two-tier (memory LRU + optional SQLite) cache of JSON-serializable
+    analysis results.
+
+    version_fn returns the current model version; when it changes, the memory
+    tier is cleared and persistent rows from other versions are deleted.
+    """
+
+    def __init__(self, version_fn, max_entries=1024, ttl_seconds=3600, storage=None):
+        self.version_fn = version_fn
+        self.max_entries = int(max_entries)
+        self.ttl = float(ttl_seconds)
+        self.storage = storage
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._stats = {
+            'hits': 0,
+            'memory_hits': 0,
+            'persistent_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+        }
+
+        if self.storage is not None:
+            self._init_persistent()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _init_persistent(self):
+        conn = self.storage.connection()
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(prediction_cache)')]
+        if columns and 'result' not in columns:
+            # Older layout stored only emotion/confidence; it is just a cache, so rebuild it
+            conn.execute('DROP TABLE prediction_cache')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS prediction_cache (
+                image_hash TEXT NOT NULL,
+                model_version TEXT NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (image_hash, model_version)
+            )
+        ''')
+        conn.commit()
+
+    def _current_version(self):
+        """Return the model version, invalidating the cache if it changed"""
+        version = self.version_fn()
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    if self._version is not None:
+                        self._stats['invalidations'] += 1
+                        print(f"Model changed ({self._version} -> {version}); prediction cache invalidated")
+                    self._entries.clear()
+                    self._version = version
+            if self.storage is not None and version is not None:
+                self._purge_persistent(version)
+        return version
+
+    def _purge_persistent(self, version):
+        self.storage.execute_async([
+            ('DELETE FROM prediction_cache WHERE model_version != ?', (version,))
+        ])
+
+    def get(self, image_hash):
+        """Return a copy of the cached result for an image hash, or None"""
+        if not self.enabled:
+            return None
+        version = self._current_version()
+        if version is None:
+            return None
+
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(image_hash)
+            if entry is not None:
+                result, created_at = entry
+                if now - created_at <= self.ttl:
+                    self._entries.move_to_end(image_hash)
+                    self._stats['hits'] += 1
+                    self._stats['memory_hits'] += 1
+                    return json.loads(result)
+                del self._entries[image_hash]
+                self._stats['expirations'] += 1
+
+        if self.storage is not None:
+            row = self._get_persistent(image_hash, version, now)
+            if row is not None:
+                result, created_at = row
+                with self._lock:
+                    self._stats['hits'] += 1
+                    self._stats['persistent_hits'] += 1
+                    self._insert(image_hash, (result, created_at))
+                return json.loads(result)
+
+        with self._lock:
+            self._stats['misses'] += 1
+        return None
+
+    def _get_persistent(self, image_hash, version, now):
+        try:
+            row = self.storage.connection().execute(
+                'SELECT result, created_at FROM prediction_cache '
+                'WHERE image_hash = ? AND model_version = ? AND created_at >= ?',
+                (image_hash, version, now - self.ttl)
+            ).fetchone()
+            return row
+        except sqlite3.Error as e:
+            print(f"Prediction cache lookup failed: {e}")
+            return None
+
+    def put(self, image_hash, result, version=None):
+        """
+        Store a result for an image hash under the current model version.
+        A result computed by another version (given as version) is not stored.
+        """
+        if not self.enabled:
+            return
+        current = self._current_version()
+        if current is None or (version is not None and version != current):
+            return
+        version = current
+
+        # Stored serialized so callers can never mutate a cached entry
+        result = json.dumps(result)
+        created_at = time.time()
+        with self._lock:
+            self._insert(image_hash, (result, created_at))
+
+        if self.storage is not None:
+            # Written by the storage writer thread, batched with other inserts
+            self.storage.execute_async([(
+                'INSERT OR REPLACE INTO prediction_cache '
+                '(image_hash, model_version, result, created_at) VALUES (?, ?, ?, ?)',
+                (image_hash, version, result, created_at)
+            )])
+
+    def _insert(self, image_hash, entry):
+        """Insert into the LRU tier (caller holds the lock)"""
+        self._entries[image_hash] = entry
+        self._entries.move_to_end(image_hash)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.storage is not None:
+            self.storage.execute_async([('DELETE FROM prediction_cache', ())])
+
+    def stats(self):
+        """Return hit/miss/eviction counters and current size"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(
+                self._stats,
+                hit_rate=self._stats['hits'] / lookups if lookups else 0.0,
+                size=len(self._entries),
+                max_entries=self.max_entries,
+                ttl_seconds=self.ttl,
+                persistent=self.storage is not None,
+                model_version=self._version,
+            )
@@ -0,0 +1,159 @@
+"""
+Image preprocessing shared by the web app and offline tools.
+Uploads are decoded straight from memory and cropped faces are resized to
+the 48x48 grayscale uint8 input the emotion model expects; rescaling to
+[0, 1] happens inside the model (see create_model in model_training.py),
+or in preprocess_batch() for models trained before it did. Uploads are
+also re-encoded at a bounded resolution (plus a thumbnail) for storage.
+Large JPEGs can be decoded at reduced scale, which libjpeg does for a
+fraction of the cost of a full decode.
+"""
+
+import struct
+
+import cv2
+import numpy as np
+
+# Model input size (FER2013 images are 48x48 grayscale)
+IMAGE_SIZE = 48
+# Class index of each model output, in FER2013's order; the app, the video
+# timeline, bulk scoring and training all use this one mapping
+EMOTION_LABELS = {
+    0: 'Angry',
+    1: 'Disgust',
+    2: 'Fear',
+    3: 'Happy',
+    4: 'Sad',
+    5: 'Surprise',
+    6: 'Neutral'
+}
+# Raw pixels are multiplied by this: the same float32 op as the models' Rescaling layer
+PIXEL_SCALE = np.float32(1.0 / 255.0)
+
+_JPEG_MAGIC = b'\xff\xd8\xff'
+_PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+# Reduced-scale decode flags, largest reduction first
+_REDUCED_FLAGS = {
+    cv2.IMREAD_GRAYSCALE: ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8), (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)),
+    cv2.IMREAD_COLOR: ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                       (2, cv2.IMREAD_REDUCED_COLOR_2)),
+}
+
+
+def _jpeg_size(data):
+    """(width, height) from the first SOF segment of a JPEG"""
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:  # Markers without a length
+            offset += 2
+            continue
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>HH', data[offset + 5:offset + 9])
+            return width, height
+        offset += 2 + struct.unpack('>H', data[offset + 2:offset + 4])[0]
+    return None
+
+
+def image_size(image_bytes):
+    """
+    (width, height) of a JPEG, PNG, GIF or BMP read from its header,
+    without decoding the pixels. None for other or truncated data.
+    """
+    if not image_bytes:
+        return None
+    try:
+        if image_bytes.startswith(_JPEG_MAGIC):
+            return _jpeg_size(image_bytes)
+        if image_bytes.startswith(_PNG_MAGIC) and len(image_bytes) >= 24:
+            return struct.unpack('>II', image_bytes[16:24])
+        if image_bytes[:6] in (b'GIF87a', b'GIF89a') and len(image_bytes) >= 10:
+            return struct.unpack('<HH', image_bytes[6:10])
+        if image_bytes.startswith(b'BM') and len(image_bytes) >= 26:
+            width, height = struct.unpack('<ii', image_bytes[18:26])
+            return width, abs(height)
+    except struct.error:
+        pass
+    return None
+
+
+def decode_image(image_bytes, flags=cv2.IMREAD_GRAYSCALE, min_side=None, size=None):
+    """
+    Decode encoded image bytes (PNG, JPG, BMP, ...) without touching disk.
+    Returns a uint8 array, or None if the bytes are not a valid image.
+    With min_side, a JPEG at least twice that size is decoded at 1/2, 1/4
+    or 1/8 scale, keeping its longest side at least min_side. size is the
+    (width, height) from image_size(), if the caller already has it.
+    """
+    if not image_bytes:
+        return None
+    if min_side and flags in _REDUCED_FLAGS and image_bytes.startswith(_JPEG_MAGIC):
+        size = size or image_size(image_bytes)
+        if size is not None:
+            for factor, reduced_flags in _REDUCED_FLAGS[flags]:
+                if max(size) >= min_side * factor:
+                    flags = reduced_flags
+                    break
+    buffer = np.frombuffer(image_bytes, dtype=np.uint8)
+    return cv2.imdecode(buffer, flags)
+
+
+def prepare_face(gray):
+    """
+    Resize a grayscale (or BGR) image to 48x48.
+    Returns the raw uint8 pixels as an array of shape (48, 48, 1).
+    """
+    if gray.ndim == 3 and gray.shape[2] == 3:
+        gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+    img = cv2.resize(gray, (IMAGE_SIZE, IMAGE_SIZE))
+    return img.reshape(IMAGE_SIZE, IMAGE_SIZE, 1)
+
+
+def preprocess_batch(images):
+    """
+    Rescale a batch of raw 0-255 pixels, shape (n, 48, 48, 1), to float32 in
+    [0, 1] in one vectorized step, bit-for-bit like the Rescaling layer.
+    Only for models that do not embed their preprocessing.
+    """
+    return np.asarray(images).astype(np.float32) * PIXEL_SCALE
+
+
+def _encode_jpeg(img, max_side, quality):
+    height, width = img.shape[:2]
+    scale = min(1.0, max_side / float(max(height, width)))
+    if scale < 1.0:
+        img = cv2.resize(img, (max(1, int(width * scale)), max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError('Could not encode image')
+    return buffer.tobytes(), scale < 1.0
+
+
+def normalize_image(image_bytes, max_side=1024, quality=90, thumbnail_side=128):
+    """
+    Re-encode an upload for storage: a JPEG at most max_side pixels on its
+    longest side plus a thumbnail_side thumbnail. The original is kept when
+    it is already within bounds and re-encoding would not make it smaller.
+    Returns (image_bytes, thumbnail_bytes), or None for invalid images.
+    """
+    size = image_size(image_bytes)
+    keep = image_bytes.startswith(_JPEG_MAGIC) and size is not None and max(size) <= max_side
+    # Large JPEGs decode at reduced scale; a JPEG that is kept only needs enough pixels for the thumbnail
+    img = decode_image(image_bytes, cv2.IMREAD_COLOR, min_side=thumbnail_side if keep else max_side, size=size)
+    if img is None:
+        return None
+    if keep:
+        data = image_bytes  # Re-encoding a JPEG within bounds only loses quality
+    else:
+        data, resized = _encode_jpeg(img, max_side, quality)
+        if not resized and len(data) >= len(image_bytes):
+            data = image_bytes
+    thumbnail, _ = _encode_jpeg(img, thumbnail_side, 80)
+    return data, thumbnail
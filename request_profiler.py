@@ -0,0 +1,259 @@
+"""
+On-demand request profiling.
+A Trace records timed spans for the stages of one request (decode, face
+detection, resize, queue wait, forward pass, ...), a cProfile of the
+request thread and, optionally, a TensorFlow profiler trace of the forward
+pass. The active trace lives in a context variable: when a request is not
+profiled, current() is None and instrumented code skips its bookkeeping.
+ProfileStore keeps the most recent traces on disk as a bounded ring, one
+directory per trace.
+"""
+
+import contextvars
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import shutil
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+TRACE_FILE = 'trace.json'
+CPROFILE_FILE = 'profile.prof'
+TF_TRACE_DIR = 'tf'
+
+# Functions listed (by cumulative time) in a trace's cProfile summary
+CPROFILE_TOP = 30
+
+_current = contextvars.ContextVar('request_trace', default=None)
+_NOOP = nullcontext()
+
+# The TensorFlow profiler is process-wide: one trace at a time
+_tf_lock = threading.Lock()
+_ids = itertools.count()
+
+
+def current():
+    """The trace of the request being handled, or None when it is not profiled"""
+    return _current.get()
+
+
+def span(name, **attrs):
+    """Time a block as a span of the current trace (a no-op when not profiling)"""
+    trace = _current.get()
+    return trace.span(name, **attrs) if trace is not None else _NOOP
+
+
+class Trace:
+    """
+    Spans and profiles for one request. start() makes it the current trace
+    and starts cProfile in the calling thread; finish() stops it. Span
+    times are time.perf_counter() values, so spans can be added from other
+    threads (e.g. the inference scheduler's timings).
+    """
+
+    def __init__(self, reason, cprofile=True, tensorflow=False):
+        self.id = '{}-{}-{}'.format(datetime.now().strftime('%Y%m%dT%H%M%S%f'), os.getpid(), next(_ids))
+        self.reason = reason
+        self.tensorflow = tensorflow
+        self.info = {}
+        self.spans = []
+        self.started_at = datetime.now().isoformat(timespec='milliseconds')
+        self.started = time.perf_counter()
+        self.finished = None
+        self.tf_logdir = None
+        self.tf_status = 'off' if not tensorflow else 'not_run'
+        self._profile = cProfile.Profile() if cprofile else None
+        self._token = None
+
+    def start(self):
+        self._token = _current.set(self)
+        if self._profile is not None:
+            try:
+                self._profile.enable()
+            except ValueError:
+                self._profile = None  # Another profiler is active in this thread
+        return self
+
+    def finish(self):
+        if self._profile is not None:
+            self._profile.disable()
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:
+                _current.set(None)  # Finished from another context (e.g. after a streamed body)
+            self._token = None
+        self.finished = time.perf_counter()
+
+    def add(self, name, started, finished, **attrs):
+        """Record a span from two time.perf_counter() values"""
+        self.spans.append(dict(attrs, name=name, start_ms=(started - self.started) * 1000.0,
+                               duration_ms=(finished - started) * 1000.0))
+
+    @contextmanager
+    def span(self, name, **attrs):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.perf_counter(), **attrs)
+
+    @contextmanager
+    def tensorflow_trace(self, logdir):
+        """
+        Capture a TensorFlow profiler trace into logdir while the block runs,
+        if this trace asked for one. It covers every TensorFlow op in the
+        process meanwhile, so concurrent requests' batches show up too.
+        Skipped when another trace holds the profiler or TensorFlow is not loaded.
+        """
+        tf = sys.modules.get('tensorflow')
+        if not self.tensorflow or self.tf_logdir is not None:
+            yield
+            return
+        if tf is None:
+            self.tf_status = 'unavailable'
+            yield
+            return
+        if not _tf_lock.acquire(blocking=False):
+            self.tf_status = 'busy'
+            yield
+            return
+        try:
+            started = time.perf_counter()
+            try:
+                tf.profiler.experimental.start(logdir)
+            except Exception as e:
+                self.tf_status = f'failed: {e}'
+                yield
+                return
+            self.add('tf_profiler_start', started, time.perf_counter())
+            try:
+                yield
+            finally:
+                stopped = time.perf_counter()
+                tf.profiler.experimental.stop()
+                self.add('tf_profiler_stop', stopped, time.perf_counter())
+                self.tf_logdir = logdir
+                self.tf_status = 'captured'
+        finally:
+            _tf_lock.release()
+
+    def total_ms(self):
+        finished = self.finished if self.finished is not None else time.perf_counter()
+        return (finished - self.started) * 1000.0
+
+    def summary(self):
+        return dict(self.info, id=self.id, reason=self.reason, started_at=self.started_at,
+                    total_ms=self.total_ms(), tensorflow=self.tf_status,
+                    cprofile=self._profile is not None)
+
+    def to_dict(self):
+        """Summary, spans in start order and the cProfile hot spots"""
+        data = self.summary()
+        data['spans'] = sorted(self.spans, key=lambda s: s['start_ms'])
+        data['cprofile_top'] = self._cprofile_top() if self._profile is not None else None
+        return data
+
+    def _cprofile_top(self):
+        stats = pstats.Stats(self._profile, stream=io.StringIO())
+        top = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            top.append({
+                'function': '{}:{}({})'.format('/'.join(filename.split(os.sep)[-2:]), line, function),
+                'calls': calls,
+                'tottime_ms': tottime * 1000.0,
+                'cumtime_ms': cumtime * 1000.0
+            })
+        top.sort(key=lambda entry: entry['cumtime_ms'], reverse=True)
+        return top[:CPROFILE_TOP]
+
+    def dump_cprofile(self, path):
+        if self._profile is None:
+            return False
+        self._profile.dump_stats(path)
+        return True
+
+
+class ProfileStore:
+    """
+    The max_traces most recent traces, one directory each under directory:
+    trace.json, profile.prof (open with pstats or snakeviz) and tf/ (a
+    TensorBoard log directory) when a TensorFlow trace was captured.
+    Trace ids start with their timestamp, so they sort oldest first.
+    """
+
+    def __init__(self, directory, max_traces=50):
+        self.directory = directory
+        self.max_traces = max(1, int(max_traces))
+
+    def path(self, trace_id, filename=None):
+        """Directory (or a file in it) of a stored trace; None for an invalid id"""
+        if not trace_id or trace_id.startswith('.') or os.sep in trace_id or '/' in trace_id:
+            return None
+        path = os.path.join(self.directory, trace_id)
+        return os.path.join(path, filename) if filename else path
+
+    def tf_logdir(self, trace):
+        """Where a trace's TensorFlow profile is written before save()"""
+        return os.path.join(self.directory, f'.{trace.id}.tmp', TF_TRACE_DIR)
+
+    def save(self, trace):
+        """Write a finished trace, then evict the oldest beyond max_traces"""
+        staging = os.path.join(self.directory, f'.{trace.id}.tmp')
+        os.makedirs(staging, exist_ok=True)
+        data = trace.to_dict()
+        data['files'] = []
+        if trace.dump_cprofile(os.path.join(staging, CPROFILE_FILE)):
+            data['files'].append(CPROFILE_FILE)
+        if trace.tf_logdir is not None and os.path.isdir(trace.tf_logdir):
+            data['files'].append(TF_TRACE_DIR)
+        with open(os.path.join(staging, TRACE_FILE), 'w') as f:
+            json.dump(data, f, indent=1)
+        # Appears in listings only once complete
+        os.rename(staging, self.path(trace.id))
+        self.prune()
+
+    def _trace_ids(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if not name.startswith('.'))
+
+    def prune(self):
+        for trace_id in self._trace_ids()[:-self.max_traces]:
+            shutil.rmtree(self.path(trace_id), ignore_errors=True)
+
+    def load(self, trace_id):
+        """A stored trace as a dict, or None"""
+        path = self.path(trace_id, TRACE_FILE)
+        if path is None:
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None  # Evicted meanwhile
+
+    def list(self, limit=None):
+        """Summaries (without spans and cProfile entries) of stored traces, newest first"""
+        traces = []
+        for trace_id in reversed(self._trace_ids()):
+            if limit is not None and len(traces) >= limit:
+                break
+            data = self.load(trace_id)
+            if data is None:
+                continue
+            data.pop('cprofile_top', None)
+            spans = data.pop('spans', [])
+            data['stages_ms'] = {}
+            for entry in spans:
+                data['stages_ms'][entry['name']] = data['stages_ms'].get(entry['name'], 0.0) + entry['duration_ms']
+            traces.append(data)
+        return traces
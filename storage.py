@@ -0,0 +1,687 @@
+"""
+SQLite storage layer for submissions.
+Each worker keeps long-lived connections in WAL mode, and a background
+writer thread groups queued inserts into batched transactions, so
+concurrent requests no longer pay one fsync each or hit
+"database is locked". Image bytes are stored once in a content-addressed
+blobs table (keyed by the SHA-256 of the original upload) instead of being
+copied into every users row; see normalize_image in preprocessing.py for
+the bounded-resolution copy and thumbnail that are stored.
+
+Analytics read from emotion_rollup, hourly counts per emotion and
+confidence bucket that a trigger keeps up to date in the same transaction
+as every users insert, so dashboards never scan the users table.
+"""
+
+import atexit
+import hashlib
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# Applied to every connection; WAL lets readers proceed while the writer commits
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+    'PRAGMA foreign_keys=ON',
+)
+
+# Confidence is bucketed into tenths; -1 holds rows without a confidence
+CONFIDENCE_BUCKETS = 10
+
+# Period label for each query granularity, computed from the hourly bucket_start
+GRANULARITIES = {
+    'hour': 'bucket_start',
+    'day': 'substr(bucket_start, 1, 10)',
+    'week': "strftime('%Y-W%W', bucket_start)",
+    'month': 'substr(bucket_start, 1, 7)',
+    'total': "'total'",
+}
+
+_ROLLUP_BUCKET = "strftime('%Y-%m-%d %H:00:00', {date})"
+_ROLLUP_CONFIDENCE = f'COALESCE(MIN(CAST({{confidence}} * {CONFIDENCE_BUCKETS} AS INTEGER), {CONFIDENCE_BUCKETS - 1}), -1)'
+_ROLLUP_EMOTION = "COALESCE({emotion}, 'Unknown')"
+
+_STOP = object()
+
+
+def prune_directory(folder, max_age_days=None, max_bytes=None):
+    """
+    Apply the same retention policy to a folder of saved uploads: delete
+    files older than max_age_days, then the oldest until at most max_bytes
+    remain. Returns the number of files deleted and bytes freed.
+    """
+    if not os.path.isdir(folder):
+        return {'files_deleted': 0, 'bytes_freed': 0}
+    entries = []
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort(reverse=True)  # Newest first
+
+    cutoff = time.time() - float(max_age_days) * 86400 if max_age_days else None
+    kept = 0
+    deleted = freed = 0
+    for mtime, size, path in entries:
+        if (cutoff is not None and mtime < cutoff) or (max_bytes and kept + size > max_bytes):
+            try:
+                os.remove(path)
+                deleted += 1
+                freed += size
+            except OSError as e:
+                print(f"Could not delete {path}: {e}")
+        else:
+            kept += size
+    return {'files_deleted': deleted, 'bytes_freed': freed}
+
+
+def _hour_floor(timestamp):
+    """'2024-05-01T13:45' -> '2024-05-01 13:00:00'; dates are left as they are"""
+    timestamp = timestamp.replace('T', ' ')
+    return timestamp[:13] + ':00:00' if len(timestamp) > 10 else timestamp
+
+
+def _submission(row):
+    submission_id, name, submission_date, emotion, confidence, image_hash, model_version = row
+    return {
+        'id': submission_id,
+        'name': name,
+        'submission_date': submission_date,
+        'emotion': emotion,
+        'confidence': confidence,
+        'image_hash': image_hash,
+        'model_version': model_version
+    }
+
+
+class _Flush:
+    """Marker queued by flush(); set once everything before it is committed"""
+    __slots__ = ('done',)
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class _BlobWrite(list):
+    """Statements that store an image; has_blob() counts it as stored until they are written"""
+    __slots__ = ('image_hash', 'blob_statement')
+
+
+class Storage:
+    """
+    Long-lived connections plus a background batch writer for one database.
+
+    Reads use a per-thread connection from connection(). Writes are queued
+    with execute_async() (or insert_submission()) and committed by the writer
+    thread in transactions of up to batch_size queued writes. The optional
+    on_commit(seconds, writes) and on_error(exception) hooks are called from
+    the writer thread after each committed transaction or failed write.
+    """
+
+    def __init__(self, db_path='database.db', batch_size=64, max_batch_delay_ms=20,
+                 on_commit=None, on_error=None):
+        self.db_path = db_path
+        self.on_commit = on_commit
+        self.on_error = on_error
+        self.batch_size = max(1, int(batch_size))
+        self.max_batch_delay = max(0.0, float(max_batch_delay_ms)) / 1000.0
+
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._writer_pid = None
+        self._start_lock = threading.Lock()
+        self._closed = False
+        # Images queued for the blobs table but not yet written:
+        # {hash: [queued writes, the INSERT statement that stores it]}
+        self._pending_lock = threading.Lock()
+        self._pending_blobs = {}
+
+        self._stats_lock = threading.Lock()
+        self._transactions = 0
+        self._writes = 0
+        self._errors = 0
+
+        atexit.register(self.close)
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, timeout=5.0, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def connection(self):
+        """Return this thread's long-lived connection (reopened after fork)"""
+        pid = os.getpid()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != pid:
+            conn = self._open()
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+    def init_schema(self):
+        """Create tables and migrate older users tables in place"""
+        conn = self.connection()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                submission_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                emotion_detected TEXT,
+                image_path TEXT,
+                image_blob BLOB
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                data BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # size is the stored bytes (image plus thumbnail), original_size the upload's;
+        # last_used is the latest submission of the image, which retention evicts by
+        blob_columns = {row[1] for row in conn.execute('PRAGMA table_info(blobs)')}
+        if 'thumbnail' not in blob_columns:
+            conn.execute('ALTER TABLE blobs ADD COLUMN thumbnail BLOB')
+        if 'original_size' not in blob_columns:
+            conn.execute('ALTER TABLE blobs ADD COLUMN original_size INTEGER')
+        if 'last_used' not in blob_columns:
+            conn.execute('ALTER TABLE blobs ADD COLUMN last_used TIMESTAMP')
+            conn.execute('UPDATE blobs SET last_used = created_at')
+        conn.execute('DROP INDEX IF EXISTS idx_blobs_created_at')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_blobs_last_used ON blobs (last_used)')
+
+        # Columns added after the original schema; image_blob stays for legacy rows
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(users)')}
+        if 'image_sha256' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN image_sha256 TEXT')
+        if 'confidence' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN confidence REAL')
+        if 'model_version' not in columns:
+            conn.execute('ALTER TABLE users ADD COLUMN model_version TEXT')
+
+        # Shadow-mode comparisons: the served prediction next to the candidate's, per face
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS shadow_predictions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                image_sha256 TEXT,
+                face_index INTEGER NOT NULL,
+                model_version TEXT NOT NULL,
+                emotion TEXT,
+                confidence REAL,
+                shadow_version TEXT NOT NULL,
+                shadow_emotion TEXT,
+                shadow_confidence REAL
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_shadow_versions '
+                     'ON shadow_predictions (shadow_version, model_version)')
+
+        # Time-range and per-emotion queries are answered from these (covering)
+        # indexes instead of row pages, which can still hold legacy image_blobs
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_submission_date '
+                     'ON users (submission_date, emotion_detected, confidence)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_emotion_date '
+                     'ON users (emotion_detected, submission_date)')
+        # Similarity search results are matched back to submissions by image hash
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_users_image_sha256 ON users (image_sha256)')
+        self._init_rollup(conn)
+        conn.commit()
+
+    def _init_rollup(self, conn):
+        """Create the hourly rollup and its insert trigger, backfilling existing rows once"""
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'emotion_rollup'"
+        ).fetchone()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS emotion_rollup (
+                bucket_start TEXT NOT NULL,
+                emotion TEXT NOT NULL,
+                confidence_bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                confidence_sum REAL NOT NULL,
+                PRIMARY KEY (bucket_start, emotion, confidence_bucket)
+            ) WITHOUT ROWID
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_rollup_emotion ON emotion_rollup (emotion, bucket_start)')
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS users_rollup_insert AFTER INSERT ON users
+            BEGIN
+                INSERT INTO emotion_rollup (bucket_start, emotion, confidence_bucket, count, confidence_sum)
+                VALUES ({_ROLLUP_BUCKET.format(date='NEW.submission_date')},
+                        {_ROLLUP_EMOTION.format(emotion='NEW.emotion_detected')},
+                        {_ROLLUP_CONFIDENCE.format(confidence='NEW.confidence')},
+                        1, COALESCE(NEW.confidence, 0))
+                ON CONFLICT (bucket_start, emotion, confidence_bucket) DO UPDATE SET
+                    count = count + 1,
+                    confidence_sum = confidence_sum + excluded.confidence_sum;
+            END
+        ''')
+        if not exists:
+            conn.execute(f'''
+                INSERT INTO emotion_rollup (bucket_start, emotion, confidence_bucket, count, confidence_sum)
+                SELECT {_ROLLUP_BUCKET.format(date='submission_date')} AS bucket,
+                       {_ROLLUP_EMOTION.format(emotion='emotion_detected')} AS emotion_label,
+                       {_ROLLUP_CONFIDENCE.format(confidence='confidence')} AS confidence_bucket,
+                       COUNT(*), COALESCE(SUM(confidence), 0)
+                FROM users
+                WHERE submission_date IS NOT NULL
+                GROUP BY bucket, emotion_label, confidence_bucket
+            ''')
+
+    def _ensure_writer(self):
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            return
+        with self._start_lock:
+            if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+                return
+            if self._writer_pid != os.getpid():
+                # Threads do not survive fork(); drop anything inherited from the parent
+                self._queue = queue.Queue()
+                self._pending_blobs = {}
+            self._writer_pid = os.getpid()
+            self._writer = threading.Thread(target=self._run, name='sqlite-writer', daemon=True)
+            self._writer.start()
+
+    def execute_async(self, statements):
+        """Queue a list of (sql, params) to be committed together in the next batch"""
+        if self._closed:
+            raise RuntimeError('Storage is closed')
+        self._ensure_writer()
+        self._queue.put(statements if isinstance(statements, _BlobWrite) else list(statements))
+
+    def insert_submission(self, name, emotion, image_path, image_bytes, image_hash=None, confidence=None,
+                          thumbnail=None, original_size=None, model_version=None):
+        """
+        Queue a users row; the image goes into the blobs table once per unique
+        content. image_hash identifies the original upload, image_bytes is
+        what gets stored (e.g. a normalized copy of it); without image_bytes
+        the row refers to an image that is already stored under image_hash.
+        model_version records which model produced the prediction.
+        """
+        statements = _BlobWrite()
+        statements.image_hash = statements.blob_statement = None
+        if image_bytes:
+            image_hash = image_hash or hashlib.sha256(image_bytes).hexdigest()
+            statements.blob_statement = (
+                'INSERT OR IGNORE INTO blobs (sha256, data, thumbnail, size, original_size, last_used) '
+                'VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                (image_hash, sqlite3.Binary(image_bytes), sqlite3.Binary(thumbnail) if thumbnail else None,
+                 len(image_bytes) + len(thumbnail or b''), original_size or len(image_bytes))
+            )
+        elif image_hash:
+            with self._pending_lock:
+                pending = self._pending_blobs.get(image_hash)
+            if pending is not None:
+                # has_blob() said it is stored because it is queued; should that write fail,
+                # this one stores it (a no-op otherwise)
+                statements.blob_statement = pending[1]
+        if statements.blob_statement is not None:
+            statements.image_hash = image_hash
+            statements.append(statements.blob_statement)
+        if image_hash:
+            statements.append(('UPDATE blobs SET last_used = CURRENT_TIMESTAMP WHERE sha256 = ?', (image_hash,)))
+        statements.append((
+            'INSERT INTO users (name, emotion_detected, confidence, image_path, image_sha256, model_version) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (name, emotion, confidence, image_path, image_hash, model_version)
+        ))
+        self._ensure_writer()  # Before tracking: starting it after a fork clears the pending set
+        self._track_blob(statements, 1)
+        try:
+            self.execute_async(statements)
+        except BaseException:
+            self._track_blob(statements, -1)
+            raise
+
+    def _track_blob(self, statements, delta):
+        image_hash = statements.image_hash
+        if image_hash is None:
+            return
+        with self._pending_lock:
+            pending = self._pending_blobs.setdefault(image_hash, [0, statements.blob_statement])
+            pending[0] += delta
+            if pending[0] <= 0:
+                del self._pending_blobs[image_hash]
+
+    def insert_shadow_predictions(self, rows):
+        """
+        Queue shadow comparisons: (image_hash, face_index, model_version, emotion,
+        confidence, shadow_version, shadow_emotion, shadow_confidence) tuples
+        """
+        self.execute_async([(
+            'INSERT INTO shadow_predictions (image_sha256, face_index, model_version, emotion, confidence, '
+            'shadow_version, shadow_emotion, shadow_confidence) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            row
+        ) for row in rows])
+
+    def get_submission(self, submission_id):
+        """Return one users row (without image data) as a dict, or None"""
+        row = self.connection().execute(
+            'SELECT id, name, submission_date, emotion_detected, confidence, image_sha256, model_version '
+            'FROM users WHERE id = ?', (submission_id,)
+        ).fetchone()
+        return _submission(row) if row else None
+
+    def submissions_by_hash(self, image_hashes):
+        """Return {image_hash: most recent users row with that image} for the given hashes"""
+        if not image_hashes:
+            return {}
+        cursor = self.connection().execute(
+            'SELECT id, name, submission_date, emotion_detected, confidence, image_sha256, model_version '
+            f"FROM users WHERE id IN (SELECT MAX(id) FROM users WHERE image_sha256 IN "
+            f"({', '.join('?' * len(image_hashes))}) GROUP BY image_sha256)",
+            list(image_hashes)
+        )
+        return {row[5]: _submission(row) for row in cursor}
+
+    def get_blob(self, image_hash):
+        """Return the stored bytes for an image hash, or None"""
+        row = self.connection().execute('SELECT data FROM blobs WHERE sha256 = ?', (image_hash,)).fetchone()
+        return bytes(row[0]) if row else None
+
+    def has_blob(self, image_hash):
+        """
+        True if an image with this hash is already stored, or queued to be
+        (identical uploads are kept once). A submission of a queued image
+        without its bytes repeats the queued write, so the image is stored
+        even if the first write fails.
+        """
+        if image_hash in self._pending_blobs:
+            return True
+        return self.connection().execute('SELECT 1 FROM blobs WHERE sha256 = ?', (image_hash,)).fetchone() is not None
+
+    def apply_retention(self, max_age_days=None, max_bytes=None):
+        """
+        Evict stored images not submitted for max_age_days, then the least
+        recently submitted ones until the blobs table holds at most max_bytes.
+        Submission rows (and the analytics rollup) are kept; their images are
+        simply gone. Returns the number of images evicted and bytes freed.
+        """
+        conn = self.connection()
+        with conn:
+            before = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+            legacy = 0
+            if max_age_days:
+                cutoff = f'-{float(max_age_days)} days'
+                conn.execute("DELETE FROM blobs WHERE last_used < datetime('now', ?)", (cutoff,))
+                legacy = conn.execute(
+                    "UPDATE users SET image_blob = NULL "
+                    "WHERE image_blob IS NOT NULL AND submission_date < datetime('now', ?)", (cutoff,)
+                ).rowcount
+            if max_bytes:
+                conn.execute('''
+                    DELETE FROM blobs WHERE sha256 IN (
+                        SELECT sha256 FROM (
+                            SELECT sha256, SUM(size) OVER (ORDER BY last_used DESC, sha256 DESC) AS kept
+                            FROM blobs
+                        ) WHERE kept > ?
+                    )
+                ''', (int(max_bytes),))
+            after = conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs').fetchone()
+        return {
+            'images_evicted': before[0] - after[0],
+            'bytes_freed': before[1] - after[1],
+            'legacy_images_cleared': legacy,
+            'bytes_stored': after[1]
+        }
+
+    def compact(self, normalize_fn, batch_size=100, vacuum=True):
+        """
+        Migrate existing data to the current layout, then VACUUM:
+        legacy users.image_blob bytes move into the blobs table, and blobs
+        stored before normalization are replaced by normalize_fn(bytes) ->
+        (image, thumbnail) or None (kept as they are). Runs in batches on
+        this thread's connection, so it can run next to a live app.
+        """
+        conn = self.connection()
+        file_size = os.path.getsize(self.db_path)
+        moved = normalized = 0
+
+        last_id = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, image_blob FROM users WHERE image_blob IS NOT NULL AND id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            with conn:
+                for row_id, blob in rows:
+                    blob = bytes(blob)
+                    image_hash = hashlib.sha256(blob).hexdigest()
+                    result = normalize_fn(blob)
+                    data, thumbnail = result if result is not None else (blob, None)
+                    conn.execute(
+                        'INSERT OR IGNORE INTO blobs (sha256, data, thumbnail, size, original_size, last_used) '
+                        'VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)',
+                        (image_hash, sqlite3.Binary(data), sqlite3.Binary(thumbnail) if thumbnail else None,
+                         len(data) + len(thumbnail or b''), len(blob))
+                    )
+                    conn.execute('UPDATE users SET image_sha256 = ?, image_blob = NULL WHERE id = ?',
+                                 (image_hash, row_id))
+            moved += len(rows)
+            last_id = rows[-1][0]
+
+        last_hash = ''
+        while True:
+            rows = conn.execute(
+                'SELECT sha256, data FROM blobs WHERE thumbnail IS NULL AND sha256 > ? ORDER BY sha256 LIMIT ?',
+                (last_hash, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            with conn:
+                for image_hash, blob in rows:
+                    blob = bytes(blob)
+                    result = normalize_fn(blob)
+                    if result is None:
+                        continue
+                    data, thumbnail = result
+                    conn.execute(
+                        'UPDATE blobs SET data = ?, thumbnail = ?, size = ?, '
+                        'original_size = COALESCE(original_size, ?) WHERE sha256 = ?',
+                        (sqlite3.Binary(data), sqlite3.Binary(thumbnail), len(data) + len(thumbnail),
+                         len(blob), image_hash)
+                    )
+                    normalized += 1
+            last_hash = rows[-1][0]
+
+        if vacuum:
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return {
+            'legacy_rows_migrated': moved,
+            'blobs_normalized': normalized,
+            'file_bytes_before': file_size,
+            'file_bytes_after': os.path.getsize(self.db_path)
+        }
+
+    def emotion_counts(self, start=None, end=None, granularity='day', emotions=None):
+        """
+        Emotion counts from the rollup for start <= submission_date < end
+        ('YYYY-MM-DD[ HH:MM:SS]' UTC strings, hour resolution), grouped by
+        period. Returns a list of rows ordered by period, each with the count,
+        mean confidence and counts per confidence bucket of one emotion.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity '{granularity}'. Choose from: {', '.join(GRANULARITIES)}")
+        conditions = []
+        params = []
+        if start:
+            conditions.append('bucket_start >= ?')
+            params.append(_hour_floor(start))
+        if end:
+            # The bucket holding `end` only counts if `end` is not on an hour boundary
+            conditions.append('bucket_start < ?')
+            params.append(end.replace('T', ' '))
+        if emotions:
+            conditions.append(f"emotion IN ({', '.join('?' * len(emotions))})")
+            params.extend(emotions)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        cursor = self.connection().execute(f'''
+            SELECT {GRANULARITIES[granularity]} AS period, emotion, confidence_bucket,
+                   SUM(count), SUM(confidence_sum)
+            FROM emotion_rollup {where}
+            GROUP BY period, emotion, confidence_bucket
+            ORDER BY period, emotion, confidence_bucket
+        ''', params)
+
+        rows = {}
+        for period, emotion, bucket, count, confidence_sum in cursor:
+            row = rows.get((period, emotion))
+            if row is None:
+                row = rows[(period, emotion)] = {
+                    'period': period, 'emotion': emotion, 'count': 0,
+                    'confidence_sum': 0.0, 'confidence_buckets': {}
+                }
+            row['count'] += count
+            row['confidence_sum'] += confidence_sum
+            label = 'unknown' if bucket < 0 else f'{bucket / CONFIDENCE_BUCKETS:.1f}-{(bucket + 1) / CONFIDENCE_BUCKETS:.1f}'
+            row['confidence_buckets'][label] = count
+
+        result = []
+        for row in rows.values():
+            known = row['count'] - row['confidence_buckets'].get('unknown', 0)
+            confidence_sum = row.pop('confidence_sum')
+            row['mean_confidence'] = confidence_sum / known if known else None
+            result.append(row)
+        return result
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been committed"""
+        if self._writer is None or self._writer_pid != os.getpid() or not self._writer.is_alive():
+            return True
+        marker = _Flush()
+        self._queue.put(marker)
+        return marker.done.wait(timeout)
+
+    def close(self, timeout=10.0):
+        """Flush pending writes and stop the writer thread"""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None and self._writer_pid == os.getpid() and self._writer.is_alive():
+            self._queue.put(_STOP)
+            self._writer.join(timeout)
+
+    def _collect_batch(self):
+        """Block for the first item, then gather more until full or the delay expires"""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.max_batch_delay
+        while len(items) < self.batch_size and items[-1] is not _STOP:
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        conn = self._open()
+        while True:
+            items = self._collect_batch()
+            groups = [item for item in items if isinstance(item, list)]
+            if groups:
+                self._commit(conn, groups)
+                for statements in groups:
+                    if isinstance(statements, _BlobWrite):
+                        # Written or failed: either way has_blob() now asks the database
+                        self._track_blob(statements, -1)
+            for item in items:
+                if isinstance(item, _Flush):
+                    item.done.set()
+            if items[-1] is _STOP:
+                conn.close()
+                return
+
+    def _committed(self, started, writes):
+        with self._stats_lock:
+            self._transactions += 1
+            self._writes += writes
+        if self.on_commit is not None:
+            self.on_commit(time.perf_counter() - started, writes)
+
+    def _commit(self, conn, groups):
+        started = time.perf_counter()
+        try:
+            with conn:
+                for statements in groups:
+                    for sql, params in statements:
+                        conn.execute(sql, params)
+            self._committed(started, len(groups))
+        except sqlite3.Error as e:
+            print(f"Batched write failed ({e}); retrying {len(groups)} write(s) individually")
+            # One bad write must not drop the rest of the batch
+            for statements in groups:
+                started = time.perf_counter()
+                try:
+                    with conn:
+                        for sql, params in statements:
+                            conn.execute(sql, params)
+                    self._committed(started, 1)
+                except sqlite3.Error as write_error:
+                    print(f"Database write failed: {write_error}")
+                    with self._stats_lock:
+                        self._errors += 1
+                    if self.on_error is not None:
+                        self.on_error(write_error)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'queued': self._queue.qsize(),
+                'transactions': self._transactions,
+                'writes': self._writes,
+                'errors': self._errors,
+                'mean_writes_per_transaction': self._writes / self._transactions if self._transactions else 0.0,
+            }
+
+
+def main():
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Database maintenance: compaction and retention')
+    parser.add_argument('--database', default=os.environ.get('DATABASE_PATH', 'database.db'))
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    compact_parser = commands.add_parser('compact', help='Migrate legacy images, normalize blobs and VACUUM')
+    compact_parser.add_argument('--max-side', type=int, default=int(os.environ.get('IMAGE_MAX_SIDE', 1024)))
+    compact_parser.add_argument('--quality', type=int, default=int(os.environ.get('IMAGE_JPEG_QUALITY', 90)))
+    compact_parser.add_argument('--no-vacuum', action='store_true')
+
+    prune_parser = commands.add_parser('prune', help='Evict stored images by age and total size')
+    prune_parser.add_argument('--max-age-days', type=float, default=float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0)))
+    prune_parser.add_argument('--max-mb', type=float, default=float(os.environ.get('RETENTION_MAX_MB', 0)))
+    prune_parser.add_argument('--uploads', default=None, help='Also prune this folder of saved uploads')
+    args = parser.parse_args()
+
+    storage = Storage(args.database)
+    storage.init_schema()
+    if args.command == 'compact':
+        from preprocessing import normalize_image
+        result = storage.compact(lambda data: normalize_image(data, max_side=args.max_side, quality=args.quality),
+                                 vacuum=not args.no_vacuum)
+    else:
+        max_bytes = int(args.max_mb * 1024 * 1024)
+        result = storage.apply_retention(args.max_age_days, max_bytes)
+        if args.uploads:
+            result['uploads'] = prune_directory(args.uploads, args.max_age_days, max_bytes)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
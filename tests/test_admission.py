@@ -0,0 +1,51 @@
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, Overloaded
+
+
+def test_admits_up_to_max_in_flight():
+    controller = AdmissionController(max_in_flight=2, max_queue=0)
+    tickets = [controller.acquire(), controller.acquire()]
+    assert controller.in_flight() == 2
+
+    with pytest.raises(Overloaded) as shed:
+        controller.acquire()
+    assert shed.value.reason == 'queue_full'
+    assert shed.value.retry_after >= 1
+
+    tickets[0].release()
+    tickets[0].release()  # Releasing twice frees one slot only
+    assert controller.in_flight() == 1
+    controller.acquire()
+    assert controller.stats()['shed'] == {'queue_full': 1}
+
+
+def test_queued_request_gets_the_next_free_slot():
+    controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=5.0)
+    ticket = controller.acquire()
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(controller.acquire()))
+    waiter.start()
+    while controller.queue_depth() == 0:
+        time.sleep(0.001)
+
+    # The queue holds one request; the next one is shed straight away
+    with pytest.raises(Overloaded):
+        controller.acquire()
+    ticket.release()
+    waiter.join(5.0)
+    assert len(admitted) == 1 and controller.in_flight() == 1 and controller.queue_depth() == 0
+
+
+def test_queue_timeout():
+    controller = AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=0.05)
+    controller.acquire()
+    started = time.monotonic()
+    with pytest.raises(Overloaded) as shed:
+        controller.acquire()
+    assert shed.value.reason == 'queue_timeout'
+    assert 0.05 <= time.monotonic() - started < 1.0
+    assert controller.queue_depth() == 0
@@ -0,0 +1,23 @@
+import warnings
+
+import numpy as np
+import pytest
+
+from model_training import parse_pixels
+
+
+def test_parse_pixels_round_trip():
+    images = np.random.default_rng(0).integers(0, 256, (3, 48, 48), dtype=np.uint8)
+    rows = [' '.join(map(str, image.ravel())) for image in images]
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        parsed = parse_pixels(rows)
+    assert parsed.dtype == np.uint8
+    np.testing.assert_array_equal(parsed, images)
+    assert parse_pixels([]).shape == (0, 48, 48)
+
+
+@pytest.mark.parametrize('row', ['1 2 3', ' '.join(['300'] * 48 * 48), ' '.join(['x'] * 48 * 48)])
+def test_parse_pixels_rejects_corrupt_rows(row):
+    with pytest.raises(ValueError):
+        parse_pixels([row])
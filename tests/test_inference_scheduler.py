@@ -0,0 +1,120 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from inference_scheduler import BatchScheduler, DeadlineExceeded
+
+
+def images(value, count=1):
+    return np.full((count, 48, 48, 1), value, dtype=np.uint8)
+
+
+def first_pixels(batch):
+    """A stand-in model: one output row per image, identifying it"""
+    return batch[:, 0, 0, :].astype(np.float32)
+
+
+@pytest.fixture
+def scheduler_factory():
+    schedulers = []
+
+    def make(predict_fn=first_pixels, **kwargs):
+        schedulers.append(BatchScheduler(predict_fn, **kwargs))
+        return schedulers[-1]
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.close()
+
+
+def test_concurrent_requests_share_a_batch(scheduler_factory):
+    batches = []
+
+    def predict_fn(batch):
+        batches.append(len(batch))
+        return first_pixels(batch)
+
+    scheduler = scheduler_factory(predict_fn, max_batch_size=8, max_wait_ms=200)
+    results = {}
+    callers = [threading.Thread(target=lambda i=i: results.setdefault(i, scheduler.predict(images(i, 2), timeout=5)))
+               for i in range(4)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join(5)
+
+    # Every caller gets back the rows of its own images
+    for i in range(4):
+        np.testing.assert_array_equal(results[i], [[i], [i]])
+    assert sum(batches) == 8 and len(batches) < 4
+    assert scheduler.stats()['requests'] == 4
+
+
+def test_groups_are_never_split(scheduler_factory):
+    batches = []
+
+    def predict_fn(batch):
+        batches.append(len(batch))
+        return first_pixels(batch)
+
+    scheduler = scheduler_factory(predict_fn, max_batch_size=4, max_wait_ms=100)
+    threads = [threading.Thread(target=scheduler.predict, args=(images(i, 3),), kwargs={'timeout': 5})
+               for i in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert batches == [3, 3, 3]
+
+
+def test_tuple_outputs_and_timings(scheduler_factory):
+    scheduler = scheduler_factory(lambda batch: (first_pixels(batch), first_pixels(batch) * 2), max_wait_ms=0)
+    timings = {}
+    outputs, embeddings = scheduler.predict(images(3, 2), timeout=5, timings=timings)
+    np.testing.assert_array_equal(embeddings, [[6], [6]])
+    assert timings['batch_size'] == 2
+    assert timings['enqueued'] <= timings['started'] <= timings['finished']
+
+
+def test_expired_requests_never_reach_the_model(scheduler_factory):
+    running = threading.Event()
+    release = threading.Event()
+    seen = []
+
+    def predict_fn(batch):
+        seen.extend(batch[:, 0, 0, 0])
+        running.set()
+        release.wait(5)
+        return first_pixels(batch)
+
+    scheduler = scheduler_factory(predict_fn, max_wait_ms=0)
+    blocker = threading.Thread(target=scheduler.predict, args=(images(1),), kwargs={'timeout': 5})
+    blocker.start()
+    running.wait(5)
+
+    with pytest.raises(DeadlineExceeded):
+        scheduler.predict(images(2), deadline=time.monotonic() + 0.05)
+    release.set()
+    blocker.join(5)
+    np.testing.assert_array_equal(scheduler.predict(images(3), timeout=5), [[3]])
+    assert seen == [1, 3]
+    assert scheduler.stats()['expired_requests'] == 1
+
+
+def test_errors_reach_every_caller_of_the_batch(scheduler_factory):
+    def predict_fn(batch):
+        raise RuntimeError('model failed')
+
+    scheduler = scheduler_factory(predict_fn)
+    with pytest.raises(RuntimeError, match='model failed'):
+        scheduler.predict(images(0), timeout=5)
+    assert scheduler.stats()['errors'] == 1
+
+
+def test_closed_scheduler_refuses_requests(scheduler_factory):
+    scheduler = scheduler_factory()
+    scheduler.close()
+    with pytest.raises(RuntimeError):
+        scheduler.predict(images(0))
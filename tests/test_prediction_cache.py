@@ -0,0 +1,80 @@
+import pytest
+
+from prediction_cache import PredictionCache, hash_image
+from storage import Storage
+
+RESULT = {'faces': [{'emotion': 'Happy', 'confidence': 0.9}]}
+
+
+class Version:
+    def __init__(self, value='v1'):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = Storage(str(tmp_path / 'database.db'))
+    storage.init_schema()
+    yield storage
+    storage.close()
+
+
+def test_keyed_by_image_content():
+    cache = PredictionCache(Version())
+    cache.put(hash_image(b'image one'), RESULT)
+
+    assert cache.get(hash_image(b'image one')) == RESULT
+    assert cache.get(hash_image(b'image two')) is None
+    assert hash_image(b'image one') == hash_image(bytes(bytearray(b'image one')))
+
+
+def test_results_are_copies():
+    cache = PredictionCache(Version())
+    key = hash_image(b'image')
+    cache.put(key, RESULT)
+    cache.get(key)['faces'].clear()
+    assert cache.get(key) == RESULT
+
+
+def test_model_change_invalidates():
+    version = Version('v1')
+    cache = PredictionCache(version)
+    key = hash_image(b'image')
+    cache.put(key, RESULT)
+
+    version.value = 'v2'
+    assert cache.get(key) is None
+    assert cache.stats()['invalidations'] == 1
+
+    # A result computed by the previous model is not stored under the new one
+    cache.put(key, RESULT, version='v1')
+    assert cache.get(key) is None
+    cache.put(key, RESULT, version='v2')
+    assert cache.get(key) == RESULT
+
+
+def test_lru_eviction():
+    cache = PredictionCache(Version(), max_entries=2)
+    keys = [hash_image(bytes([i])) for i in range(3)]
+    cache.put(keys[0], RESULT)
+    cache.put(keys[1], RESULT)
+    cache.get(keys[0])
+    cache.put(keys[2], RESULT)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) == RESULT
+    assert cache.stats()['evictions'] == 1
+
+
+def test_persistent_tier_is_keyed_by_version(storage):
+    key = hash_image(b'image')
+    PredictionCache(Version('v1'), storage=storage).put(key, RESULT)
+    storage.flush()
+
+    restarted = PredictionCache(Version('v1'), storage=storage)
+    assert restarted.get(key) == RESULT
+    assert restarted.stats()['persistent_hits'] == 1
+    assert PredictionCache(Version('v2'), storage=storage).get(key) is None
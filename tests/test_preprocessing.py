@@ -0,0 +1,74 @@
+"""
+Training/serving preprocessing parity on synthetic images: the serving path
+(decode_image, prepare_face, then preprocess_batch for models without
+embedded preprocessing) must feed the network exactly what the Resizing and
+Rescaling layers of create_model() do.
+"""
+
+import cv2
+import numpy as np
+import pytest
+from tensorflow import keras
+
+from model_training import create_model
+from preprocessing import IMAGE_SIZE, decode_image, prepare_face, preprocess_batch
+
+
+@pytest.fixture(scope='module')
+def model():
+    keras.utils.set_random_seed(0)
+    return create_model()
+
+
+@pytest.fixture
+def rng():
+    return np.random.default_rng(0)
+
+
+def embedded_preprocessing(model):
+    """The model's own Resizing and Rescaling layers"""
+    return keras.Sequential(model.layers[:2])
+
+
+def network_without_preprocessing(model):
+    """The layers after the embedded preprocessing, taking [0, 1] inputs"""
+    return keras.Sequential([keras.Input(shape=(IMAGE_SIZE, IMAGE_SIZE, 1))] + model.layers[2:])
+
+
+def test_create_model_takes_raw_pixels(model):
+    assert model.input_shape == (None, None, None, 1)
+    assert model.output_shape == (None, 7)
+    outputs = model.predict(np.zeros((2, IMAGE_SIZE, IMAGE_SIZE, 1), dtype=np.uint8), verbose=0)
+    np.testing.assert_allclose(outputs.sum(axis=1), 1.0, rtol=1e-5)
+
+
+@pytest.mark.parametrize('shape', [(IMAGE_SIZE, IMAGE_SIZE), (97, 61), (120, 160, 3)])
+def test_rescaling_matches_preprocess_batch(model, rng, shape):
+    faces = np.stack([prepare_face(rng.integers(0, 256, shape, dtype=np.uint8)) for _ in range(4)])
+    assert faces.shape == (4, IMAGE_SIZE, IMAGE_SIZE, 1) and faces.dtype == np.uint8
+
+    in_graph = embedded_preprocessing(model)(faces.astype(np.float32)).numpy()
+    np.testing.assert_array_equal(in_graph, preprocess_batch(faces))
+
+
+def test_predictions_match_with_either_preprocessing(model, rng):
+    faces = np.stack([prepare_face(rng.integers(0, 256, (70, 90), dtype=np.uint8)) for _ in range(4)])
+    embedded = model.predict(faces, verbose=0)
+    external = network_without_preprocessing(model).predict(preprocess_batch(faces), verbose=0)
+    np.testing.assert_allclose(embedded, external, rtol=1e-6, atol=1e-7)
+
+
+@pytest.mark.parametrize('extension', ['.jpg', '.png'])
+def test_encoded_upload_matches_decoded_pixels(model, rng, extension):
+    image = rng.integers(0, 256, (150, 130), dtype=np.uint8)
+    ok, encoded = cv2.imencode(extension, image)
+    assert ok
+    decoded = decode_image(encoded.tobytes())
+    face = prepare_face(decoded)[np.newaxis]
+
+    # The upload path sees exactly what cv2 decodes; lossy JPEG only changes which pixels those are
+    np.testing.assert_array_equal(face[0], prepare_face(cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE)))
+    if extension == '.png':
+        np.testing.assert_array_equal(face[0], prepare_face(image))
+    in_graph = embedded_preprocessing(model)(face.astype(np.float32)).numpy()
+    np.testing.assert_array_equal(in_graph, preprocess_batch(face))
@@ -0,0 +1,112 @@
+import sqlite3
+
+import pytest
+
+from storage import Storage
+
+
+@pytest.fixture
+def storage(tmp_path):
+    storage = Storage(str(tmp_path / 'database.db'))
+    storage.init_schema()
+    yield storage
+    storage.close()
+
+
+def store_image(storage, image_hash, size, age_days):
+    """Insert a stored image and its submission, age_days old"""
+    storage.insert_submission('user', 'Happy', None, b'x' * size, image_hash=image_hash)
+    storage.flush()
+    with storage.connection() as conn:
+        for table, column, key in (('blobs', 'last_used', 'sha256'), ('users', 'submission_date', 'image_sha256')):
+            conn.execute(f"UPDATE {table} SET {column} = datetime('now', ?) WHERE {key} = ?",
+                         (f'-{age_days} days', image_hash))
+
+
+def stored_hashes(storage):
+    return {row[0] for row in storage.connection().execute('SELECT sha256 FROM blobs')}
+
+
+def test_identical_uploads_are_stored_once(storage):
+    storage.insert_submission('a', 'Happy', None, b'same image')
+    storage.insert_submission('b', 'Sad', None, b'same image')
+    storage.flush()
+    conn = storage.connection()
+    assert conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0] == 1
+    assert conn.execute('SELECT COUNT(DISTINCT image_sha256) FROM users').fetchone()[0] == 1
+
+
+def test_retention_by_age_keeps_submissions(storage):
+    store_image(storage, 'old', 100, age_days=40)
+    store_image(storage, 'new', 100, age_days=1)
+
+    result = storage.apply_retention(max_age_days=30)
+    assert result['images_evicted'] == 1 and result['bytes_freed'] == 100
+    assert stored_hashes(storage) == {'new'}
+    assert storage.connection().execute('SELECT COUNT(*) FROM users').fetchone()[0] == 2
+    assert storage.get_blob('old') is None
+
+
+def test_retention_by_size_evicts_oldest_first(storage):
+    for age, image_hash in enumerate(['newest', 'middle', 'oldest']):
+        store_image(storage, image_hash, 100, age_days=age + 1)
+
+    result = storage.apply_retention(max_bytes=250)
+    assert stored_hashes(storage) == {'newest', 'middle'}
+    assert result['bytes_stored'] == 200
+    assert storage.apply_retention(max_bytes=250)['images_evicted'] == 0
+
+
+def test_resubmitted_image_is_evicted_last(storage):
+    for age, image_hash in enumerate(['newest', 'middle', 'oldest']):
+        store_image(storage, image_hash, 100, age_days=age + 1)
+    storage.insert_submission('again', 'Sad', None, None, image_hash='oldest')
+    storage.flush()
+
+    storage.apply_retention(max_bytes=250)
+    assert stored_hashes(storage) == {'oldest', 'newest'}
+    assert storage.apply_retention(max_age_days=0.5)['images_evicted'] == 1
+    assert stored_hashes(storage) == {'oldest'}
+
+
+def test_queued_image_is_stored_when_its_first_write_fails(tmp_path):
+    storage = Storage(str(tmp_path / 'database.db'), max_batch_delay_ms=200)
+    storage.init_schema()
+    with storage.connection() as conn:
+        conn.execute("CREATE TRIGGER reject BEFORE INSERT ON users WHEN NEW.name = 'rejected' "
+                     "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+    try:
+        storage.insert_submission('rejected', 'Happy', None, b'image', image_hash='abc')
+        # Counted as stored while queued, so the next upload of it sends no bytes
+        assert storage.has_blob('abc')
+        storage.insert_submission('accepted', 'Happy', None, None, image_hash='abc')
+        storage.flush()
+
+        assert storage.get_blob('abc') == b'image'
+        assert storage.stats()['errors'] == 1
+        assert storage.has_blob('abc')
+    finally:
+        storage.close()
+
+
+def test_failed_write_is_no_longer_pending(tmp_path):
+    storage = Storage(str(tmp_path / 'database.db'))
+    storage.init_schema()
+    with storage.connection() as conn:
+        conn.execute("CREATE TRIGGER reject BEFORE INSERT ON users BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+    try:
+        storage.insert_submission('rejected', 'Happy', None, b'image', image_hash='abc')
+        storage.flush()
+        assert not storage.has_blob('abc')
+    finally:
+        storage.close()
+
+
+def test_failed_write_does_not_drop_the_batch(storage):
+    errors = []
+    storage.on_error = errors.append
+    storage.execute_async([('INSERT INTO missing_table VALUES (1)', ())])
+    storage.insert_submission('user', 'Happy', None, b'image')
+    storage.flush()
+    assert len(errors) == 1 and isinstance(errors[0], sqlite3.Error)
+    assert storage.connection().execute('SELECT COUNT(*) FROM users').fetchone()[0] == 1
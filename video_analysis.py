@@ -0,0 +1,241 @@
+"""
+Emotion timeline for recorded videos.
+Frames are decoded one at a time with cv2.VideoCapture and sampled at a
+configurable rate. Near-duplicate frames reuse the previous prediction, and
+the sampled frames are classified in batches. Softmax outputs are smoothed
+with an exponential moving average and rolled up into one timeline entry
+per second, so memory use stays constant however long the video is.
+
+Usage:
+    python video_analysis.py session.mp4 --sample-fps 2 --output timeline.json
+"""
+
+import argparse
+import json
+import time
+
+import cv2
+import numpy as np
+
+from preprocessing import EMOTION_LABELS, prepare_face
+
+# Size of the thumbnail compared to spot near-duplicate frames
+_THUMB_SIZE = (16, 16)
+
+
+def _face_crop(gray, face_detector):
+    """Return the largest face in a frame, or the whole frame when none is found"""
+    if face_detector is not None:
+        boxes = face_detector.detect(gray)
+        if boxes:
+            x, y, w, h = boxes[0]
+            return gray[y:y + h, x:x + w], True
+    return gray, False
+
+
+def iter_video_timeline(path, classify_fn, sample_fps=2.0, batch_size=32, duplicate_threshold=2.0,
+                        ema_alpha=0.3, face_detector=None, progress_every=5.0, max_seconds=None):
+    """
+    Analyze a video file and yield events as processing goes:
+    - {'type': 'second', 'second': s, 'emotion', 'confidence', 'probabilities', 'samples', 'faces'}
+    - {'type': 'progress', 'position_s', 'duration_s', 'percent', 'fps'} every progress_every seconds
+    - {'type': 'summary', ...} once at the end
+
+    classify_fn receives a uint8 batch of shape (n, 48, 48, 1) and returns
+    softmax outputs (n, 7). A sampled frame whose 16x16 thumbnail differs
+    from the previous sample by less than duplicate_threshold (mean absolute
+    grey-level difference) reuses the previous prediction. With max_seconds,
+    only that much of the video is analyzed and the summary says it was
+    truncated.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video '{path}'")
+
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+    duration = total_frames / fps if total_frames else None
+    step = max(1, int(round(fps / sample_fps))) if sample_fps > 0 else 1
+
+    started = time.perf_counter()
+    last_progress = started
+    frames_read = 0
+    samples = 0
+    duplicates = 0
+    model_frames = 0
+    truncated = False
+
+    pending = []  # (timestamp, crop index or None for a duplicate, face found)
+    crops = []
+    last_thumb = None
+    last_face_found = False
+    last_probabilities = None
+    smoothed = None
+    second_index = None
+    second_sum = None
+    second_samples = 0
+    second_faces = 0
+
+    def close_second():
+        mean = second_sum / second_samples
+        idx = int(np.argmax(mean))
+        return {
+            'type': 'second',
+            'second': second_index,
+            'emotion': EMOTION_LABELS[idx],
+            'confidence': float(mean[idx]),
+            'probabilities': [round(float(p), 4) for p in mean],
+            'samples': second_samples,
+            'faces': second_faces
+        }
+
+    def flush():
+        """Classify queued crops and fold every pending sample into the timeline, in order"""
+        nonlocal pending, crops, last_probabilities, smoothed
+        nonlocal second_index, second_sum, second_samples, second_faces, model_frames
+        events = []
+        outputs = classify_fn(np.stack(crops)) if crops else None
+        model_frames += len(crops)
+        for timestamp, crop_index, face_found in pending:
+            if crop_index is not None:
+                last_probabilities = np.asarray(outputs[crop_index], dtype=np.float64)
+            if smoothed is None:
+                smoothed = last_probabilities.copy()
+            else:
+                smoothed = ema_alpha * last_probabilities + (1.0 - ema_alpha) * smoothed
+
+            second = int(timestamp)
+            if second_index is not None and second != second_index:
+                events.append(close_second())
+                second_sum = None
+            if second_sum is None:
+                second_index, second_sum, second_samples, second_faces = second, np.zeros_like(smoothed), 0, 0
+            second_sum += smoothed
+            second_samples += 1
+            second_faces += int(face_found)
+        pending, crops = [], []
+        return events
+
+    try:
+        while True:
+            # grab() advances without decoding; only sampled frames are decoded
+            if not capture.grab():
+                break
+            frame_number = frames_read
+            if max_seconds is not None and frame_number / fps >= max_seconds:
+                truncated = True
+                break
+            frames_read += 1
+            if frame_number % step:
+                continue
+
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+            samples += 1
+            timestamp = frame_number / fps
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+
+            thumb = cv2.resize(gray, _THUMB_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+            is_duplicate = (
+                last_thumb is not None
+                and (pending or last_probabilities is not None)
+                and float(np.mean(np.abs(thumb - last_thumb))) < duplicate_threshold
+            )
+            if is_duplicate:
+                duplicates += 1
+                pending.append((timestamp, None, last_face_found))
+            else:
+                last_thumb = thumb
+                face, face_found = _face_crop(gray, face_detector)
+                last_face_found = face_found
+                crops.append(prepare_face(face))
+                pending.append((timestamp, len(crops) - 1, face_found))
+
+            if len(crops) >= batch_size:
+                yield from flush()
+
+            now = time.perf_counter()
+            if progress_every and now - last_progress >= progress_every:
+                last_progress = now
+                yield {
+                    'type': 'progress',
+                    'position_s': round(timestamp, 2),
+                    'duration_s': round(duration, 2) if duration else None,
+                    'percent': round(100.0 * frames_read / total_frames, 1) if total_frames else None,
+                    'fps': round(frames_read / (now - started), 1)
+                }
+
+        yield from flush()
+        if second_sum is not None:
+            yield close_second()
+    finally:
+        capture.release()
+
+    elapsed = time.perf_counter() - started
+    yield {
+        'type': 'summary',
+        'frames': frames_read,
+        'sampled_frames': samples,
+        'duplicate_frames': duplicates,
+        'classified_frames': model_frames,
+        'video_fps': fps,
+        'duration_s': round(frames_read / fps, 2),
+        'elapsed_s': round(elapsed, 3),
+        'processing_fps': round(frames_read / elapsed, 1) if elapsed else None,
+        'realtime_factor': round((frames_read / fps) / elapsed, 2) if elapsed else None,
+        'truncated': truncated
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-second emotion timeline for a video file')
+    parser.add_argument('video', help='Video file to analyze')
+    parser.add_argument('--backend', default='keras', help='Inference backend (see inference_backends.py)')
+    parser.add_argument('--model', default=None, help='Model file (defaults to the backend artifact)')
+    parser.add_argument('--sample-fps', type=float, default=2.0, help='Frames sampled per second of video')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--ema-alpha', type=float, default=0.3, help='Smoothing factor for softmax outputs')
+    parser.add_argument('--duplicate-threshold', type=float, default=2.0)
+    parser.add_argument('--no-face-detection', action='store_true')
+    parser.add_argument('--output', default=None, help='Write the timeline as JSON lines to this file')
+    args = parser.parse_args()
+
+    from inference_backends import load_backend
+    backend = load_backend(args.backend, args.model)
+
+    face_detector = None
+    if not args.no_face_detection:
+        from face_detection import FaceDetector
+        try:
+            face_detector = FaceDetector()
+        except Exception as e:
+            print(f"Face detector unavailable, classifying whole frames: {e}")
+
+    output = open(args.output, 'w') if args.output else None
+    try:
+        for event in iter_video_timeline(
+            args.video, backend.predict,
+            sample_fps=args.sample_fps,
+            batch_size=args.batch_size,
+            duplicate_threshold=args.duplicate_threshold,
+            ema_alpha=args.ema_alpha,
+            face_detector=face_detector
+        ):
+            if event['type'] == 'progress':
+                print(f"{event['percent'] or 0:5.1f}%  {event['position_s']:.0f}s  {event['fps']} fps")
+            elif event['type'] == 'second':
+                print(f"{event['second']:>6}s  {event['emotion']:<9} {event['confidence']:.2%}")
+            else:
+                print(f"\nProcessed {event['frames']} frames in {event['elapsed_s']}s "
+                      f"({event['processing_fps']} fps, {event['realtime_factor']}x realtime); "
+                      f"{event['classified_frames']} classified, {event['duplicate_frames']} duplicates skipped")
+            if output:
+                output.write(json.dumps(event) + '\n')
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()